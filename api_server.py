@@ -0,0 +1,395 @@
+"""Headless HTTP API for Ashok 2.0.
+
+Serves the same library, retrieval and answers as the Streamlit app, without
+rerunning a script for every interaction. The embedding model is loaded once at
+start-up and requests are handled by a fixed pool of worker threads.
+
+Usage:
+    python api_server.py [--host 127.0.0.1] [--port 8080] [--workers 8] [--pdf book.pdf ...]
+    ASHOK_GEMINI_BACKEND=mock python api_server.py   # offline, no Gemini key needed
+
+Endpoints:
+    GET    /health
+    GET    /metrics                        Prometheus text format
+    GET    /books                          Library, with progress of books still ingesting
+    POST   /books?title=...&wait=1         Body: the PDF bytes
+    DELETE /books/<book_id>
+    POST   /search        {"query": ..., "k": 5, "book_ids": [...], "section": "chapter 3"}
+    POST   /answer        {"question": ..., "book_ids": [...], "use_cache": true, "stream": false,
+                           "history": [{"role": "user"|"assistant", "content": ...}, ...]}
+    POST   /answer/batch  {"questions": [...], "book_ids": [...], "use_cache": true}
+
+The Gemini key is taken from the X-Gemini-Key header, or GEMINI_API_KEY.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import ashok2
+
+API_WORKERS = int(os.environ.get("ASHOK_API_WORKERS", "8"))
+
+logger = logging.getLogger("ashok.api")
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class AshokService:
+    """One shared library and chatbot behind the HTTP endpoints"""
+
+    def __init__(self):
+        self.chatbot = ashok2.AshokChatbot()
+        self.index_cache = ashok2.get_index_cache()
+        self.registry = ashok2.get_vectorstore_registry()
+        self._lock = threading.Lock()  # Serializes library changes
+        self.ingestions = {}  # book_id -> pipeline, while a book is being ingested
+        self._finishers = {}  # book_id -> thread that caches and shares the book once ingested
+
+    def warm_up(self):
+        """Import dependencies, load the embedding model and start the answer engine before the first request"""
+        ashok2.warm_up()
+        ashok2.get_answer_engine()
+        ashok2.get_metrics()
+
+    # Library
+
+    def add_book(self, pdf_bytes, title=None, wait=False):
+        """Add a PDF to the library, reusing a shared or cached copy when there is one"""
+        if not pdf_bytes:
+            raise ApiError(400, "Request body must be the PDF file")
+        content_hash = ashok2.BookIndexCache.content_hash(pdf_bytes)
+        key = self.index_cache.make_key(content_hash)
+        book_id = ashok2.book_id_for(content_hash)
+        title = title or book_id
+
+        with self._lock:
+            if book_id in self.chatbot.books:
+                pipeline = self.ingestions.get(book_id)
+            elif self.chatbot.attach_shared_book(self.registry, key, book_id, title):
+                pipeline = None
+            elif self.index_cache.contains(key) and self.chatbot.load_from_cache(self.index_cache, key, book_id, title)[0]:
+                self.chatbot.share_book(self.registry, book_id)
+                pipeline = None
+            else:
+                pipeline = self.chatbot.start_pdf_ingestion(io.BytesIO(pdf_bytes), book_id, title, key)
+                self.ingestions[book_id] = pipeline
+                self._finishers[book_id] = threading.Thread(
+                    target=self._finish_ingestion, args=(book_id, pipeline, content_hash),
+                    name=f"ingest-finish-{book_id}", daemon=True,
+                )
+                self._finishers[book_id].start()
+            finisher = self._finishers.get(book_id)
+
+        if finisher is not None and wait:
+            finisher.join()
+        return self.book_info(book_id)
+
+    def _finish_ingestion(self, book_id, pipeline, content_hash):
+        pipeline.wait()
+        with self._lock:
+            if self.ingestions.get(book_id) is pipeline:
+                if pipeline.succeeded and self.chatbot.books.get(book_id, {}).get("chunks"):
+                    self.chatbot.save_to_cache(self.index_cache, book_id, content_hash)
+                    self.chatbot.share_book(self.registry, book_id)
+                else:
+                    self.chatbot.remove_book(self.registry, book_id)
+                    logger.warning(f"Ingestion of {book_id} failed: {pipeline.error or 'no extractable text'}")
+                del self.ingestions[book_id]
+            self._finishers.pop(book_id, None)
+
+    def book_info(self, book_id):
+        book = self.chatbot.books.get(book_id)
+        if book is None:
+            raise ApiError(404, f"No book {book_id} (ingestion may have failed)")
+        pipeline = self.ingestions.get(book_id)
+        info = {
+            "book_id": book_id,
+            "title": book["title"],
+            "status": "ingesting" if pipeline else "ready",
+            "chunks": len(book["chunks"]),
+            "pages": len(book["pages"]),
+        }
+        if pipeline:
+            info.update(
+                pages_done=pipeline.pages_done,
+                pages_total=pipeline.pages_total,
+                embedding_cache_hit_ratio=pipeline.stats()["embedding_cache_hit_ratio"],
+            )
+        return info
+
+    def books(self):
+        return {"books": [self.book_info(book_id) for book_id in list(self.chatbot.books)]}
+
+    def remove_book(self, book_id):
+        with self._lock:
+            self.ingestions.pop(book_id, None)
+            if not self.chatbot.remove_book(self.registry, book_id):
+                raise ApiError(404, f"No book {book_id}")
+        return {"removed": book_id}
+
+    # Retrieval and answers
+
+    def search(self, query, k=5, book_ids=None, section=None):
+        if not query or not isinstance(query, str):
+            raise ApiError(400, "'query' is required")
+        if isinstance(k, bool) or not isinstance(k, int) or k < 1:
+            raise ApiError(400, "'k' must be a positive integer")
+        if section is not None and not isinstance(section, str):
+            raise ApiError(400, "'section' must be a string")
+        return {"results": self.chatbot.search_book_content(
+            query, k=k, book_ids=self._book_ids(book_ids), section=section
+        )}
+
+    @staticmethod
+    def _book_ids(book_ids):
+        """The requested book ids as a set (a bare string would be matched as a substring)"""
+        if book_ids is None:
+            return None
+        if not isinstance(book_ids, list) or not all(isinstance(book_id, str) for book_id in book_ids):
+            raise ApiError(400, "'book_ids' must be a list of book id strings")
+        return set(book_ids)
+
+    def _check_key(self, api_key):
+        if not api_key:
+            raise ApiError(401, "Send the Gemini API key in the X-Gemini-Key header")
+        ok, message = self.chatbot.configure_gemini(api_key)
+        if not ok:
+            raise ApiError(401, message)
+
+    @staticmethod
+    def _memory(history):
+        """Conversation memory for the chat so far, sent by the client as a list of messages"""
+        if history is None:
+            return None
+        if not isinstance(history, list) or not all(isinstance(message, dict) for message in history):
+            raise ApiError(400, "'history' must be a list of {\"role\": ..., \"content\": ...} messages")
+        return ashok2.ConversationMemory.from_messages(history)
+
+    @staticmethod
+    def _question(question, name="question"):
+        if not question or not isinstance(question, str):
+            raise ApiError(400, f"'{name}' must be a non-empty string")
+        return question
+
+    def answer(self, question, api_key, book_ids=None, use_cache=True, history=None):
+        self._question(question)
+        self._check_key(api_key)
+        memory = self._memory(history)
+        engine = ashok2.get_answer_engine()
+        result = engine.run(engine.answer(self.chatbot, question, api_key, self._book_ids(book_ids), use_cache, memory))
+        return {
+            "answer": result["response"],
+            "cached": result["cached"],
+            "total_ms": result["trace"].get("total_ms"),
+        }
+
+    def stream_answer(self, question, api_key, book_ids=None, use_cache=True, history=None):
+        self._question(question)
+        self._check_key(api_key)
+        return self.chatbot.stream_response(
+            question, api_key, self._book_ids(book_ids), use_cache, self._memory(history)
+        )
+
+    def answer_batch(self, questions, api_key, book_ids=None, use_cache=True):
+        if not isinstance(questions, list) or not questions:
+            raise ApiError(400, "'questions' must be a non-empty list")
+        for question in questions:
+            self._question(question, "questions")
+        self._check_key(api_key)
+        return {"answers": self.chatbot.generate_responses(questions, api_key, self._book_ids(book_ids), use_cache)}
+
+
+class AshokRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, and chunked streaming responses
+    timeout = 30  # Idle keep-alive connections give their worker back
+    service = None  # Set by make_server
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    # Helpers
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, pieces):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            try:
+                for piece in pieces:
+                    self._write_chunk(piece.encode("utf-8"))
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                # The 200 is already sent, so the error ends the body instead of replacing it
+                logger.exception("Streamed answer failed")
+                self._write_chunk(f"\n\n[Error: {e}]".encode("utf-8"))
+            self.wfile.write(b"0\r\n\r\n")
+        finally:
+            close = getattr(pieces, "close", None)
+            if close:
+                close()  # Client went away mid-answer: stop generating
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json_body(self):
+        try:
+            payload = json.loads(self._body() or b"{}")
+        except ValueError:
+            raise ApiError(400, "Request body must be JSON")
+        if not isinstance(payload, dict):
+            raise ApiError(400, "Request body must be a JSON object")
+        return payload
+
+    def _api_key(self):
+        return self.headers.get("X-Gemini-Key") or os.environ.get("GEMINI_API_KEY")
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            self._route(method, url.path.rstrip("/") or "/", query)
+        except ApiError as e:
+            self._send_json(e.status, {"error": str(e)})
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            logger.exception("Request failed")
+            self._send_json(500, {"error": str(e)})
+
+    def _route(self, method, path, query):
+        service = self.service
+        if method == "GET" and path == "/health":
+            self._send_json(200, {"status": "ok", "books": len(service.chatbot.books)})
+        elif method == "GET" and path == "/metrics":
+            self._send_text(200, ashok2.get_metrics().prometheus_text(), "text/plain; version=0.0.4; charset=utf-8")
+        elif method == "GET" and path == "/books":
+            self._send_json(200, service.books())
+        elif method == "POST" and path == "/books":
+            info = service.add_book(self._body(), query.get("title"), wait=query.get("wait") in ("1", "true"))
+            self._send_json(200 if info["status"] == "ready" else 202, info)
+        elif method == "GET" and path.startswith("/books/"):
+            self._send_json(200, service.book_info(path[len("/books/"):]))
+        elif method == "DELETE" and path.startswith("/books/"):
+            self._send_json(200, service.remove_book(path[len("/books/"):]))
+        elif method == "POST" and path == "/search":
+            body = self._json_body()
+            args = (body.get("query"), body.get("k", 5), body.get("book_ids"), body.get("section"))
+            self._send_json(200, service.search(*args))
+        elif method == "POST" and path == "/answer":
+            body = self._json_body()
+            args = (
+                body.get("question"), self._api_key(), body.get("book_ids"), body.get("use_cache", True),
+                body.get("history"),
+            )
+            if body.get("stream"):
+                self._send_stream(service.stream_answer(*args))
+            else:
+                self._send_json(200, service.answer(*args))
+        elif method == "POST" and path == "/answer/batch":
+            body = self._json_body()
+            self._send_json(200, service.answer_batch(
+                body.get("questions"), self._api_key(), body.get("book_ids"), body.get("use_cache", True)
+            ))
+        else:
+            raise ApiError(404, f"No route for {method} {path}")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server whose connections are handled by a fixed pool of worker threads"""
+
+    def __init__(self, address, handler, workers=API_WORKERS):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ashok-api")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def make_server(service, host="127.0.0.1", port=8080, workers=API_WORKERS):
+    handler = type("BoundAshokRequestHandler", (AshokRequestHandler,), {"service": service})
+    return PooledHTTPServer((host, port), handler, workers=workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless HTTP API for Ashok 2.0")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="Request worker threads")
+    parser.add_argument("--pdf", nargs="*", default=[], help="Books to load before serving")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    service = AshokService()
+    service.warm_up()
+    for path in args.pdf:
+        with open(path, "rb") as f:
+            info = service.add_book(f.read(), os.path.splitext(os.path.basename(path))[0], wait=True)
+        logger.info(f"Loaded {info['title']}: {info['chunks']} chunks from {info['pages']} pages")
+
+    server = make_server(service, args.host, args.port, args.workers)
+    logger.info(f"Serving on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,172 +1,3119 @@
 import streamlit as st
-import google.generativeai as genai
-from PyPDF2 import PdfReader
 import os
 import re
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.schema import Document
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pdf_extraction import iter_pdf_pages, pdf_outline
+import numpy as np
+import hashlib
+import asyncio
+import bisect
+import contextvars
+import importlib
+import itertools
+import logging
+import math
+import mmap
+import json
+import platform
+import queue
+import resource
+import shutil
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import types
+import weakref
 import warnings
 warnings.filterwarnings('ignore')
 
 
+class LazyModule:
+    """Stand-in for a heavy module that is only imported on first attribute access.
 
-# Page configuration
-st.set_page_config(
-    page_title="Ashok 2.0 - Problem Solving Assistant",
-    page_icon="🧠",
-    layout="wide"
+    Streamlit runs this script on every cold start, and torch/transformers, the Gemini
+    SDK, FAISS and LangChain alone take seconds to import. None of them are needed
+    to render the first page, so they are loaded when first used (or by ``warm_up``
+    in the background).
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """Import the module now, if it is not already"""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+genai = LazyModule("google.generativeai")
+glm = LazyModule("google.ai.generativelanguage")
+google_exceptions = LazyModule("google.api_core.exceptions")
+faiss = LazyModule("faiss")
+text_splitters = LazyModule("langchain_text_splitters")
+hf_embeddings = LazyModule("langchain_huggingface.embeddings")
+sentence_transformers = LazyModule("sentence_transformers")
+
+# Custom CSS for better UI
+PAGE_CSS = """
+<style>
+    .main-header {
+        text-align: center;
+        color: #2E86AB;
+        font-size: 2.5em;
+        margin-bottom: 0.5em;
+    }
+    .sub-header {
+        text-align: center;
+        color: #A23B72;
+        font-size: 1.2em;
+        margin-bottom: 2em;
+    }
+    .chat-message {
+        padding: 1rem;
+        border-radius: 10px;
+        margin-bottom: 1rem;
+        border-left: 4px solid #2E86AB;
+    }
+    .user-message {
+        background-color: #E8F4FD;
+        border-left-color: #2E86AB;
+    }
+    .assistant-message {
+        background-color: #F0F8FF;
+        border-left-color: #A23B72;
+    }
+    .sidebar .element-container {
+        margin-bottom: 1rem;
+    }
+    .book-reference {
+        background-color: #f0f8ff;
+        padding: 10px;
+        border-left: 4px solid #2E86AB;
+        margin: 10px 0;
+        border-radius: 5px;
+    }
+</style>
+"""
+
+# Embedding and chunking parameters (all of these are part of the index cache key)
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 800  # Smaller chunks for better precision
+CHUNK_OVERLAP = 150  # More overlap for context
+CHUNK_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " ", ""]  # Better separators
+# "torch", or the model's ONNX export run by onnxruntime on CPU: "onnx" (fp32) or "onnx-int8" (quantized)
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.environ.get("ASHOK_EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_FILE = os.environ.get("ASHOK_EMBEDDING_ONNX_FILE")  # Overrides the ONNX file picked from the model repo
+# How the final index stores vectors: "float32", or scalar quantized to "float16" or "int8"
+VECTOR_STORAGE_TYPES = ("float32", "float16", "int8")
+VECTOR_STORAGE = os.environ.get("ASHOK_VECTOR_STORAGE", "float32")
+
+# On-disk index cache location and size budget
+INDEX_CACHE_DIR = os.environ.get(
+    "ASHOK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ashok", "indexes")
 )
+INDEX_CACHE_MAX_BYTES = int(os.environ.get("ASHOK_CACHE_MAX_MB", "2048")) * 1024 * 1024
+INDEX_CACHE_FORMAT = 4  # Bump when the on-disk layout or chunk metadata changes
+
+# Source id for books ingested without one (e.g. from scripts)
+DEFAULT_BOOK_ID = "book"
+
+# Vector index: "auto" picks by corpus size, or one of INDEX_BACKENDS
+INDEX_BACKENDS = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+INDEX_BACKEND = os.environ.get("ASHOK_INDEX_BACKEND", "auto")
+INDEX_NPROBE = int(os.environ.get("ASHOK_INDEX_NPROBE", "16"))  # IVF lists scanned per query
+INDEX_EF_SEARCH = int(os.environ.get("ASHOK_INDEX_EF_SEARCH", "64"))  # HNSW candidate list size
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+
+# Semantic answer cache: reuse an answer for a near-identical question over the same chunks
+RESPONSE_CACHE_ENABLED = os.environ.get("ASHOK_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get("ASHOK_RESPONSE_CACHE_THRESHOLD", "0.92"))  # Cosine similarity
+RESPONSE_CACHE_TTL = float(os.environ.get("ASHOK_RESPONSE_CACHE_TTL", str(24 * 3600)))  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("ASHOK_RESPONSE_CACHE_MAX", "1000"))
+
+# Hybrid retrieval: BM25 over the chunk texts fused with vector search by reciprocal rank
+HYBRID_SEARCH = os.environ.get("ASHOK_HYBRID_SEARCH", "1") != "0"
+HYBRID_CANDIDATES = 20  # Candidates taken from each retriever before fusion (at least k)
+RRF_K = 60  # Reciprocal rank fusion damping constant
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Reranking: a small cross-encoder rescores the first stage's best candidates before the top k are kept
+RERANK_ENABLED = os.environ.get("ASHOK_RERANK", "0") != "0"
+RERANK_MODEL_NAME = os.environ.get("ASHOK_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.environ.get("ASHOK_RERANK_CANDIDATES", "30"))  # First-stage results rescored
+RERANK_BATCH_SIZE = 16  # Question/chunk pairs per forward pass
+RERANK_MAX_TOKENS = 256  # Pairs are truncated to this length; a chunk is about 200 tokens
+RERANK_CACHE_ENTRIES = 20000  # (question, book, chunk) scores kept in memory
+# Skip reranking when the k nearest chunks lead the next one by this much squared L2 distance
+# (between unit vectors that is 2 - 2 * cosine, so 0.1 is a cosine gap of 0.05)
+RERANK_MARGIN = float(os.environ.get("ASHOK_RERANK_MARGIN", "0.1"))
+RERANK_LATENCY_BUDGET_MS = float(os.environ.get("ASHOK_RERANK_BUDGET_MS", "150"))  # Added p95 search latency
+
+# Book structure: chapters and sections from the PDF outline, or from headings carried forward across pages
+SECTION_SUMMARY_CHUNKS = 3  # Chunks nearest a section's mean embedding, used for "what does chapter X say"
+SECTION_BOOST = 1.0 / RRF_K  # Fusion bonus for chunks in a section the question names (one rank-1 hit)
+SECTION_TITLE_MIN_CHARS = 8  # Shorter titles are only matched as "chapter 3" style references
+
+# Answer engine: questions are answered on one asyncio loop, with bounded Gemini concurrency per key
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("ASHOK_GEMINI_CONCURRENCY", "4"))
+
+# Prompt context: retrieved passages are merged, deduplicated and packed into a token budget
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("ASHOK_CONTEXT_TOKENS", "600"))
+CONTEXT_CANDIDATES = 6  # Chunks retrieved before merging and packing
+CONTEXT_DEDUP_THRESHOLD = 0.8  # Word-shingle Jaccard similarity above which passages are duplicates
+
+# Conversation memory: recent turns verbatim, older ones folded into a bounded summary
+MEMORY_WINDOW_TURNS = int(os.environ.get("ASHOK_MEMORY_TURNS", "3"))  # Question/answer pairs kept verbatim
+MEMORY_TOKEN_BUDGET = int(os.environ.get("ASHOK_MEMORY_TOKENS", "500"))  # Summary plus recent turns, per prompt
+FOLLOW_UP_MAX_WORDS = 10  # Longer questions are taken to stand on their own
+CHAT_HISTORY_PAGE = 20  # Chat messages rendered per page; older ones behind "Show earlier messages"
+CHAT_HISTORY_MAX = 500  # Chat messages kept in the session (older turns live on in the memory summary)
+
+# Gemini: one validated client per API key, with retries on transient and rate-limit errors
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+GEMINI_BACKEND = os.environ.get("ASHOK_GEMINI_BACKEND", "gemini")  # "mock" answers offline, for local testing
+MOCK_GEMINI_LATENCY = float(os.environ.get("ASHOK_MOCK_GEMINI_LATENCY", "0.5"))  # Seconds per mock answer
+GEMINI_KEY_TTL = float(os.environ.get("ASHOK_GEMINI_KEY_TTL", "3600"))  # Seconds a validated key is trusted
+GEMINI_KEY_RETRY_TTL = 30.0  # Seconds before a rejected key is checked again
+GEMINI_MAX_RETRIES = int(os.environ.get("ASHOK_GEMINI_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = 1.0  # Seconds, doubled on every attempt
+GEMINI_BACKOFF_MAX = 30.0
+GEMINI_SDK_VERSIONS = ((0, 5), (0, 9))  # google-generativeai releases [from, to) whose client slots are pinned per key
+
+# Metrics: timing spans and counters, exported as Prometheus text and a JSON-lines log
+METRICS_LOG_FILE = os.environ.get("ASHOK_METRICS_LOG")  # One JSON object per request when set
+METRICS_PORT = int(os.environ.get("ASHOK_METRICS_PORT", "0"))  # Serve /metrics on this port when set
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+METRICS_RECENT_TRACES = 20  # Per-request breakdowns kept for the sidebar debug panel
+
+# Ingestion pipeline: chunks per embedding call and batches buffered between stages
+EMBED_BATCH_SIZE = int(os.environ.get("ASHOK_EMBED_BATCH", "64"))
+PIPELINE_QUEUE_SIZE = 4
+
+# Ingestion jobs: uploads queue for a process-wide worker pool and are checkpointed, so they survive refreshes and restarts
+INGESTION_WORKERS = int(os.environ.get("ASHOK_INGESTION_WORKERS", "2"))  # Books ingested at once
+INGESTION_JOBS_DIR = os.environ.get(
+    "ASHOK_JOBS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ashok", "jobs")
+)
+INGESTION_CHECKPOINT_PAGES = int(os.environ.get("ASHOK_CHECKPOINT_PAGES", "32"))  # Pages between checkpoints
+
+# Embedding inference: CPU threads, and dynamic batching of queries from concurrent sessions
+EMBEDDING_THREADS = int(os.environ.get("ASHOK_EMBEDDING_THREADS", "0"))  # Intra-op threads; 0 = library default
+EMBED_QUERY_BATCH = 32  # Queued queries embedded together in one forward pass
+EMBED_QUERY_WAIT_MS = float(os.environ.get("ASHOK_EMBED_QUERY_WAIT_MS", "0"))  # Wait for more queries to batch
+
+# Embedding cache: vectors by (model, normalized text hash), so unchanged chunks and repeated questions skip the model
+EMBEDDING_CACHE_ENABLED = os.environ.get("ASHOK_EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "ASHOK_EMBEDDING_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "ashok", "embeddings.sqlite3")
+)
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.environ.get("ASHOK_EMBEDDING_CACHE_MEMORY", "20000"))  # In-memory LRU
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("ASHOK_EMBEDDING_CACHE_MAX", "1000000"))  # On disk
+
+# Start-up: once the first page is rendered, heavy dependencies and the embedding model load in the background
+WARM_UP = os.environ.get("ASHOK_WARM_UP", "1") != "0"
+
+
+def join_page_texts(page_texts):
+    """Rebuild the full book text from per-page texts"""
+    return "".join(f"\n--- Page {p['page']} ---\n{p['text']}\n" for p in page_texts)
+
+
+def book_id_for(content_hash):
+    """Stable library id for a book, derived from its PDF content hash"""
+    return content_hash[:16]
+
+
+# One chunk of a book, as produced by the chunker and materialized by ChunkStore
+Chunk = namedtuple("Chunk", ["text", "page", "chapter", "chunk_id"])
+
+
+class ChunkStore:
+    """A book's chunks in a few flat arrays rather than one object per chunk.
+
+    Texts are concatenated into one UTF-8 buffer and chunk i is
+    ``text[offsets[i]:offsets[i + 1]]``. Pages, chapter ids and chunk ids are int32
+    columns, and each chapter title is stored once. Text is only decoded for the
+    chunks that are read, e.g. search hits. Like ``BM25Index``, chunks added during
+    ingestion are buffered and merged into the arrays on the next read (or
+    ``compact``). Saved stores are memory-mapped on load.
+    """
+
+    PAGE, CHAPTER, CHUNK_ID = range(3)  # Columns of the integer fields
+    TEXT_FILE = "chunks.bin"
+    OFFSETS_FILE = "chunk_offsets.npy"
+    FIELDS_FILE = "chunk_fields.npy"
+    CHAPTERS_FILE = "chapters.json"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._text = b""
+        self._offsets = np.zeros(1, dtype="int64")
+        self._fields = np.zeros((0, 3), dtype="int32")
+        self.chapters = []  # Interned chapter titles, indexed by the chapter column
+        self._chapter_ids = {}
+        self._pending = ([], [])  # Encoded texts, field rows
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        store = cls()
+        store.add(chunks)
+        store.compact()
+        return store
+
+    def __len__(self):
+        return len(self._fields) + len(self._pending[1])
+
+    def add(self, chunks):
+        with self._lock:
+            texts, rows = self._pending
+            for chunk in chunks:
+                chapter_id = self._chapter_ids.get(chunk.chapter)
+                if chapter_id is None:
+                    chapter_id = self._chapter_ids[chunk.chapter] = len(self.chapters)
+                    self.chapters.append(chunk.chapter)
+                texts.append(chunk.text.encode("utf-8"))
+                rows.append((chunk.page, chapter_id, chunk.chunk_id))
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        texts, rows = self._pending
+        if not rows:
+            return
+        ends = self._offsets[-1] + np.cumsum([len(t) for t in texts], dtype="int64")
+        self._text = b"".join([self._text, *texts])
+        self._offsets = np.concatenate([self._offsets, ends])
+        self._fields = np.concatenate([self._fields, np.asarray(rows, dtype="int32")])
+        self._pending = ([], [])
+
+    def _read(self, position):
+        """Text bytes of one chunk, and its position; the caller holds the lock"""
+        self._compact()
+        position = range(len(self._fields))[position]  # Bounds check, and negative positions
+        return self._text[self._offsets.item(position):self._offsets.item(position + 1)], position
+
+    def text(self, position):
+        with self._lock:
+            data, _ = self._read(position)
+        return data.decode("utf-8")
+
+    def texts(self):
+        """Every chunk text, in order"""
+        return [self.text(position) for position in range(len(self))]
+
+    def __getitem__(self, position):
+        with self._lock:
+            data, position = self._read(position)
+            fields = self._fields
+            page, chapter, chunk_id = (fields.item(position, column) for column in (self.PAGE, self.CHAPTER, self.CHUNK_ID))
+        return Chunk(data.decode("utf-8"), page, self.chapters[chapter], chunk_id)
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    def page_span(self, first_page, end_page=None):
+        """Positions ``[start, stop)`` of the chunks on pages ``first_page <= page < end_page``.
+
+        Chunks are stored in page order, so this is a binary search over the page column.
+        """
+        with self._lock:
+            self._compact()
+            pages = self._fields[:, self.PAGE]
+            start = int(np.searchsorted(pages, first_page, side="left"))
+            stop = len(pages) if end_page is None else int(np.searchsorted(pages, end_page, side="left"))
+        return start, max(start, stop)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            self._compact()
+            return (
+                len(self._text) + self._offsets.nbytes + self._fields.nbytes
+                + sum(len(chapter) for chapter in self.chapters)
+            )
+
+    def save(self, directory):
+        with self._lock:
+            self._compact()
+            with open(os.path.join(directory, self.TEXT_FILE), "wb") as f:
+                f.write(self._text)
+            np.save(os.path.join(directory, self.OFFSETS_FILE), np.asarray(self._offsets))
+            np.save(os.path.join(directory, self.FIELDS_FILE), np.asarray(self._fields))
+            with open(os.path.join(directory, self.CHAPTERS_FILE), "w", encoding="utf-8") as f:
+                json.dump(self.chapters, f)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map a saved store; its text and arrays stay in the page cache, off the heap"""
+        store = cls()
+        with open(os.path.join(directory, cls.TEXT_FILE), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            store._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        store._offsets = np.load(os.path.join(directory, cls.OFFSETS_FILE), mmap_mode="r")
+        store._fields = np.load(os.path.join(directory, cls.FIELDS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, cls.CHAPTERS_FILE), encoding="utf-8") as f:
+            store.chapters = json.load(f)
+        store._chapter_ids = {chapter: i for i, chapter in enumerate(store.chapters)}
+        if len(store._offsets) != len(store._fields) + 1 or store._offsets[-1] != size:
+            raise ValueError("Chunk store files do not match")
+        return store
+
+
+# Questions about a section as a whole, answered from its summary rather than by search:
+# "what does chapter 3 say", "summarize <section title>". The subject or object names the section
+BROAD_SECTION_QUESTION_PATTERN = re.compile(
+    r"^\s*(?:what (?:does|do|is) (?P<subject>.+?) (?:say|cover|discuss|about)"
+    r"|(?:summar(?:ise|ize)|(?:give (?:me )?)?(?:a |an |the )?(?:summary|overview|gist|main points|key points)"
+    r"(?: of| for)?) (?P<object>.+?))(?: in (?:the|this) book)?\s*[?.!]*\s*$"
+)
+# Roman numerals must be well-formed and end the word, and a lone "i" is the pronoun ("section i think")
+SECTION_REFERENCE_PATTERN = re.compile(
+    r"\b(chapter|section|part|unit)\s+"
+    r"(\d+(?:\.\d+)*\b|(?!i\b)(?=[ivxlc])c{0,3}(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})(?!\w))"
+)
+TOP_LEVEL_HEADING_PATTERN = re.compile(r"(chapter|part|unit)\s+\d+")
+
+
+def _normalize_title(text):
+    return " ".join(re.sub(r"[^a-z0-9.]+", " ", text.lower()).split())
+
+
+class SectionIndex:
+    """A book's chapters and sections as page intervals.
+
+    Built from the PDF outline when the PDF has one, otherwise from the headings
+    found while chunking, each carried forward until the next. Start pages are
+    ascending, so the section of a page is a binary search, and since chunks are
+    stored in page order a section's chunks are one contiguous ``ChunkStore`` range.
+    A section ends where the next one at the same or a higher level starts, so a
+    chapter spans its subsections. ``summaries`` holds, per section, the positions of
+    the chunks nearest its mean embedding: a precomputed extractive summary.
+    """
+
+    UNKNOWN = "Unknown Section"
+    FILE = "sections.json"
+
+    def __init__(self, source="headings"):
+        self.source = source  # "outline" or "headings"
+        self.titles = []
+        self.levels = []
+        self.ends = []  # Page where each section stops (None: end of the book)
+        self.starts = []  # First page of each section, ascending; appended last, so readers see whole entries
+        self.summaries = []
+        self._normalized = []
+        self._open = []  # Sections without an end yet, levels ascending
+
+    @classmethod
+    def from_outline(cls, entries):
+        """From ``pdf_outline`` entries: (page, level, title) in page order"""
+        sections = cls("outline")
+        for page, level, title in entries:
+            sections._append(page, level, title)
+        return sections
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _append(self, page, level, title):
+        while self._open and self.levels[self._open[-1]] >= level:
+            self.ends[self._open.pop()] = page
+        self._open.append(len(self.titles))
+        self.titles.append(title)
+        self.levels.append(level)
+        self.ends.append(None)
+        self._normalized.append(_normalize_title(title))
+        self.starts.append(page)
+
+    def add_heading(self, page, title):
+        """A heading found on ``page``; it labels the following pages until the next one"""
+        if self.titles and self.titles[-1] == title:
+            return  # A running header, or the same heading again
+        level = 0 if TOP_LEVEL_HEADING_PATTERN.match(title.lower()) else 1
+        self._append(page, level, title)
+
+    def section_at(self, page):
+        """Id of the innermost section containing ``page``, or None before the first one"""
+        position = bisect.bisect_right(self.starts, page) - 1
+        return position if position >= 0 else None
+
+    def title_at(self, page):
+        section = self.section_at(page)
+        return self.UNKNOWN if section is None else self.titles[section]
+
+    def chunk_span(self, section, chunks):
+        """Positions ``[start, stop)`` of the section's chunks in the book's ``ChunkStore``"""
+        return chunks.page_span(self.starts[section], self.ends[section])
+
+    def _numbered(self, kind, number):
+        reference = re.compile(rf"{kind}\s+{re.escape(number)}\b")
+        return {i for i, title in enumerate(self._normalized) if reference.match(title)}
+
+    def find(self, text):
+        """Ids of the sections ``text`` refers to, by "chapter 3" style reference or by title"""
+        text = _normalize_title(text)
+        found = set()
+        for kind, number in SECTION_REFERENCE_PATTERN.findall(text):
+            found |= self._numbered(kind, number)
+        if not found:
+            found.update(
+                i for i, title in enumerate(self._normalized)
+                if len(title) >= SECTION_TITLE_MIN_CHARS and title in text
+            )
+        return sorted(found)
+
+    def find_exact(self, reference):
+        """Ids of the sections ``reference`` names exactly: "chapter 3" or a whole section title"""
+        reference = _normalize_title(reference)
+        match = SECTION_REFERENCE_PATTERN.fullmatch(reference)
+        if match:
+            return sorted(self._numbered(*match.groups()))
+        return [i for i, title in enumerate(self._normalized) if title == reference]
+
+    def summarize(self, index, chunks, size=SECTION_SUMMARY_CHUNKS):
+        """Pick each section's summary chunks: the ones nearest its mean embedding.
+
+        ``index`` must support ``reconstruct_n`` (the flat index built during ingestion).
+        """
+        summaries = []
+        for section in range(len(self)):
+            start, stop = self.chunk_span(section, chunks)
+            if stop - start <= size:
+                summaries.append(list(range(start, stop)))
+                continue
+            vectors = index.reconstruct_n(start, stop - start)
+            distances = ((vectors - vectors.mean(axis=0)) ** 2).sum(axis=1)
+            summaries.append(sorted(start + int(p) for p in np.argpartition(distances, size)[:size]))
+        self.summaries = summaries
+
+    def save(self, directory):
+        with open(os.path.join(directory, self.FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "source": self.source,
+                "sections": [
+                    {"title": title, "level": level, "start": start, "end": end, "summary": summary}
+                    for title, level, start, end, summary in itertools.zip_longest(
+                        self.titles, self.levels, self.starts, self.ends, self.summaries[:len(self)]
+                    )
+                ],
+            }, f)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, cls.FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        sections = cls(data["source"])
+        for entry in data["sections"]:
+            sections._append(entry["start"], entry["level"], entry["title"])
+        sections.ends = [entry["end"] for entry in data["sections"]]
+        sections._open = []
+        sections.summaries = [entry["summary"] or [] for entry in data["sections"]]
+        return sections
+
+
+class BookIndexCache:
+    """Content-addressed on-disk store of processed books.
+
+    Each entry lives in ``<cache_dir>/<key>/`` and holds the FAISS index, the
+    ``ChunkStore`` files, the ``SectionIndex`` and the list of pages with text. The key is a SHA-256 over the PDF
+    bytes plus the chunker/embedding parameters, so changing any of them never
+    serves stale vectors. Entries are evicted least-recently-used once the cache
+    grows beyond ``max_bytes``.
+    """
+
+    INDEX_FILE = "index.faiss"
+    PAGES_FILE = "pages.json"
+    META_FILE = "meta.json"
+
+    def __init__(self, cache_dir=INDEX_CACHE_DIR, max_bytes=INDEX_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def index_params():
+        """Parameters that change the produced vectors or chunks"""
+        return {
+            "embedding_model": EMBEDDING_MODEL_NAME,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "separators": CHUNK_SEPARATORS,
+            "embedding_backend": EMBEDDING_BACKEND,
+            "index_backend": INDEX_BACKEND,
+            "vector_storage": VECTOR_STORAGE,
+            "format": INDEX_CACHE_FORMAT,
+        }
+
+    @staticmethod
+    def content_hash(pdf_bytes):
+        """SHA-256 of the raw PDF bytes"""
+        return hashlib.sha256(pdf_bytes).hexdigest()
+
+    def make_key(self, content_hash, params=None):
+        """Cache key for a PDF's content hash under the given (default: current) parameters"""
+        params = params if params is not None else self.index_params()
+        digest = hashlib.sha256(content_hash.encode("ascii"))
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), self.META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def contains(self, key):
+        return self._read_meta(key) is not None
+
+    def load(self, key):
+        """Load a cached book; returns (index, chunks, pages, sections) or None"""
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+        if meta.get("params") != self.index_params():
+            self.invalidate(key)
+            return None
+
+        entry_dir = self._entry_dir(key)
+        try:
+            index_path = os.path.join(entry_dir, self.INDEX_FILE)
+            try:
+                # Memory-map the vectors instead of copying them onto the heap
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                index = faiss.read_index(index_path)
+
+            chunks = ChunkStore.load(entry_dir)
+            sections = SectionIndex.load(entry_dir)
+            with open(os.path.join(entry_dir, self.PAGES_FILE), encoding="utf-8") as f:
+                pages = json.load(f)
+        except (OSError, ValueError, KeyError, RuntimeError):
+            # Partially written or corrupted entry
+            self.invalidate(key)
+            return None
+
+        if index.ntotal != len(chunks):
+            self.invalidate(key)
+            return None
+        configure_index_search(index)
+
+        # Record the access for LRU eviction
+        os.utime(os.path.join(entry_dir, self.META_FILE))
+        return index, chunks, pages, sections
+
+    def save(self, key, index, chunks, pages, sections, content_hash=None):
+        """Persist a processed book under ``key`` and enforce the size budget"""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{key[:16]}-", dir=self.cache_dir)
+        try:
+            # Row i of the index is chunk i of the store
+            faiss.write_index(index, os.path.join(tmp_dir, self.INDEX_FILE))
+            chunks.save(tmp_dir)
+            sections.save(tmp_dir)
+            with open(os.path.join(tmp_dir, self.PAGES_FILE), "w", encoding="utf-8") as f:
+                json.dump(pages, f)
+            # Meta is written last; its presence marks a complete entry
+            with open(os.path.join(tmp_dir, self.META_FILE), "w", encoding="utf-8") as f:
+                json.dump({
+                    "params": self.index_params(),
+                    "content_hash": content_hash,
+                    "chunks": len(chunks),
+                    "pages": len(pages),
+                    "created": time.time(),
+                }, f)
+
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.evict()
+
+    def _entries(self):
+        """List (key, size_bytes, last_access) for every complete entry"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry_dir, self.META_FILE)
+            if name.startswith(".") or not os.path.isfile(meta_path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, f))
+                for f in os.listdir(entry_dir)
+                if os.path.isfile(os.path.join(entry_dir, f))
+            )
+            entries.append((name, size, os.path.getmtime(meta_path)))
+        return entries
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits in ``max_bytes``"""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+    def invalidate(self, key):
+        """Remove a single entry"""
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def invalidate_stale(self):
+        """Remove entries built with a different embedding model or chunker settings"""
+        current = self.index_params()
+        stale = [key for key, _, _ in self._entries() if (self._read_meta(key) or {}).get("params") != current]
+        for key in stale:
+            self.invalidate(key)
+        return stale
+
+    def clear(self):
+        for key, _, _ in self._entries():
+            self.invalidate(key)
+
+
+@st.cache_resource
+def get_index_cache():
+    """One index cache per process; stale entries are pruned when it is created"""
+    cache = BookIndexCache()
+    cache.invalidate_stale()
+    return cache
+
+
+class Metrics:
+    """Process-wide timing histograms and counters.
+
+    ``span`` times a block into a histogram named after it. Inside ``request`` the
+    spans and counters of the current context (thread or asyncio task, including
+    work it hands to ``asyncio.to_thread``) are also collected into a per-request
+    trace, which is written to the ``ashok.metrics`` logger as one JSON line and
+    returned to the caller. ``prometheus_text`` renders everything in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._current = contextvars.ContextVar("ashok_metrics_trace", default=None)
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self.logger = logging.getLogger("ashok.metrics")
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def current_trace(self):
+        return self._current.get()
+
+    def bind(self, trace):
+        """Attribute this context's spans to ``trace``, e.g. from a task started elsewhere"""
+        self._current.set(trace)
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            position = bisect.bisect_left(self.buckets, seconds)
+            if position < len(self.buckets):
+                histogram[position] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        trace = self.current_trace()
+        if trace is not None:
+            trace["spans"].append({"name": name, "ms": round(seconds * 1000, 3), **labels})
+
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def incr(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = self.current_trace()
+        if trace is not None:
+            trace_key = ".".join([name, *map(str, labels.values())])  # e.g. answer_cache.hit
+            trace["counters"][trace_key] = trace["counters"].get(trace_key, 0) + value
+
+    @contextmanager
+    def request(self, kind, **fields):
+        """Collect this context's spans and counters into a trace for one request"""
+        trace = {"event": kind, "timestamp": time.time(), "spans": [], "counters": {}, **fields}
+        previous = self.current_trace()
+        self._current.set(trace)
+        start = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            self._current.set(previous)
+            total = time.perf_counter() - start
+            trace["total_ms"] = round(total * 1000, 3)
+            self.observe(kind, total)
+            self.logger.info(json.dumps(trace, default=str))
+
+    def prometheus_text(self):
+        def render_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        if histograms:
+            lines += ["# HELP ashok_span_seconds Time spent in instrumented code paths", "# TYPE ashok_span_seconds histogram"]
+        for (name, labels), values in sorted(histograms.items()):
+            labels = (("span", name),) + labels
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"ashok_span_seconds_bucket{render_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"ashok_span_seconds_bucket{render_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"ashok_span_seconds_sum{render_labels(labels)} {values[-2]}")
+            lines.append(f"ashok_span_seconds_count{render_labels(labels)} {values[-1]}")
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE ashok_{name}_total counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"ashok_{name}_total{render_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port):
+    """Expose ``/metrics`` for Prometheus scraping on a background thread"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would flood the console
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="ashok-metrics", daemon=True).start()
+    return server
+
+
+@st.cache_resource
+def get_metrics():
+    """One metrics registry per process; also sets up the JSON log and /metrics endpoint"""
+    metrics = Metrics()
+    if METRICS_LOG_FILE:
+        handler = logging.FileHandler(METRICS_LOG_FILE, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics.logger.addHandler(handler)
+        metrics.logger.setLevel(logging.INFO)
+        metrics.logger.propagate = False
+    if METRICS_PORT:
+        try:
+            serve_metrics(metrics, METRICS_PORT)
+        except OSError as e:
+            metrics.logger.warning(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+    return metrics
+
+
+def process_rss_bytes():
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Not Linux: fall back to the peak RSS (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _onnx_model_file(backend):
+    """ONNX export to load from the model repo for an ONNX embedding backend"""
+    if EMBEDDING_ONNX_FILE:
+        return EMBEDDING_ONNX_FILE
+    if backend == "onnx":
+        return "onnx/model.onnx"
+    # int8 exports are published per instruction set; AVX2 runs on any recent x86 CPU
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    return "onnx/model_qint8_avx2.onnx"
+
+
+def load_embedding_model(model_name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS):
+    """The sentence-transformers model on the given inference backend (CPU only)"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if backend == "torch":
+        if threads:
+            importlib.import_module("torch").set_num_threads(threads)
+        return hf_embeddings.HuggingFaceEmbeddings(model_name=model_name)
+
+    try:
+        onnxruntime = importlib.import_module("onnxruntime")
+    except ImportError as e:
+        raise ImportError(
+            f"The {backend} embedding backend needs onnxruntime: pip install 'optimum[onnxruntime]'"
+        ) from e
+    session_options = onnxruntime.SessionOptions()
+    if threads:
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1  # Requests are already serialized by SharedEmbeddings
+    return hf_embeddings.HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={
+            "backend": "onnx",
+            "model_kwargs": {
+                "file_name": _onnx_model_file(backend),
+                "provider": "CPUExecutionProvider",
+                "session_options": session_options,
+            },
+        },
+    )
+
+
+class EmbeddingCache:
+    """Embedding vectors keyed by model id and a hash of the whitespace-normalized text.
+
+    A bounded in-memory LRU sits in front of a SQLite table on disk, so re-uploading
+    a book (or another edition of it) only embeds the chunks whose text changed, and
+    a repeated question skips the model. The model id includes the inference backend,
+    since its vectors differ slightly. Rows read least recently are evicted beyond
+    ``max_entries``. If the database cannot be opened the cache is memory-only.
+    """
+
+    SQL_BATCH = 500  # Keys per SELECT, below SQLite's bound parameter limit
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, memory_entries=EMBEDDING_CACHE_MEMORY_ENTRIES,
+                 max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> float32 vector, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._rows = 0
+        try:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")  # Readers in other processes do not block writers
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            self._rows = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._db = db
+        except (OSError, sqlite3.Error) as e:
+            get_metrics().logger.warning(f"Embedding cache is memory-only, could not open {path}: {e}")
+
+    @staticmethod
+    def key(model_id, text):
+        return hashlib.sha256(f"{model_id}\n{' '.join(text.split())}".encode("utf-8")).digest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys):
+        """Vectors on disk for ``keys``, marking them as used; the caller holds the lock"""
+        found = {}
+        if self._db is None:
+            return found
+        now = time.time()
+        try:
+            for start in range(0, len(keys), self.SQL_BATCH):
+                batch = keys[start:start + self.SQL_BATCH]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((bytes(key), np.frombuffer(vector, dtype="float32")) for key, vector in rows)
+            if found:
+                self._db.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+        except sqlite3.Error as e:
+            get_metrics().logger.warning(f"Embedding cache read failed: {e}")
+        return found
+
+    def get_many(self, keys):
+        """Cached vectors for ``keys``, with None where a key is not cached"""
+        vectors = [None] * len(keys)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+            if missing:
+                for key, vector in self._load(list(missing)).items():
+                    self._remember(key, vector)
+                    for i in missing[key]:
+                        vectors[i] = vector
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return vectors
+
+    def put_many(self, keys, vectors):
+        """Store float32 vectors under ``keys``"""
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self._db is None:
+                return
+            now = time.time()
+            try:
+                cursor = self._db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), now) for key, vector in zip(keys, vectors)],
+                )
+                self._rows += max(0, cursor.rowcount)
+                overflow = self._rows - self.max_entries
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+                        (overflow,),
+                    )
+                    self._rows -= overflow
+            except sqlite3.Error as e:
+                get_metrics().logger.warning(f"Embedding cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "disk_entries": self._rows,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+@st.cache_resource
+def get_embedding_cache():
+    """One embedding cache per process, shared by ingestion and queries of every session"""
+    return EmbeddingCache()
+
+
+class SharedEmbeddings:
+    """One embedding model per process, shared by every session.
+
+    Inference requests from concurrent sessions are queued and run on a single worker
+    thread, so the backend never oversubscribes the CPU and only one copy of the
+    weights is resident. Queries that queue up behind each other are embedded
+    together in one batch. With a ``cache``, only texts it does not hold reach the
+    model.
+    """
+
+    # Queries jump ahead of queued ingestion batches
+    QUERY_PRIORITY = 0
+    DOCUMENT_PRIORITY = 1
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS,
+                 query_batch=EMBED_QUERY_BATCH, query_wait_ms=EMBED_QUERY_WAIT_MS, cache=None):
+        self.model_name = model_name
+        self.backend = backend
+        self.model_id = f"{model_name}:{backend}"  # Embedding cache namespace
+        self.cache = cache
+        self.query_batch = query_batch
+        self.query_wait = query_wait_ms / 1000
+        self._model = load_embedding_model(model_name, backend, threads)
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()  # FIFO order within a priority
+        self.query_batches = 0
+        self.queries_embedded = 0
+        self._worker = threading.Thread(target=self._run, name="embedding-worker", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            if jobs[0][0] == self.QUERY_PRIORITY:
+                jobs.extend(self._queued_queries())
+            self._execute(jobs)
+            for _ in jobs:
+                self._queue.task_done()
+
+    def _queued_queries(self):
+        """Take the queries waiting behind the first one, to embed them in the same batch"""
+        if self.query_wait:
+            time.sleep(self.query_wait)
+        jobs = []
+        while len(jobs) + 1 < self.query_batch:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job[0] != self.QUERY_PRIORITY:
+                # Queries sort first, so none are left: give the document batch back
+                self._queue.put(job)
+                self._queue.task_done()
+                break
+            jobs.append(job)
+        return jobs
+
+    def _execute(self, jobs):
+        jobs = [job for job in jobs if job[3].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        texts = [text for job in jobs for text in job[2]]
+        try:
+            vectors = self._model.embed_documents(texts)
+        except Exception as e:
+            for job in jobs:
+                job[3].set_exception(e)
+            return
+        if jobs[0][0] == self.QUERY_PRIORITY:
+            self.query_batches += 1
+            self.queries_embedded += len(jobs)
+        start = 0
+        for _, _, job_texts, future in jobs:
+            future.set_result(vectors[start:start + len(job_texts)])
+            start += len(job_texts)
+
+    def _submit(self, priority, texts):
+        future = Future()
+        self._queue.put((priority, next(self._sequence), texts, future))
+        return future.result()
+
+    def pending(self):
+        """Number of inference requests waiting in the queue"""
+        return self._queue.qsize()
+
+    def _embed(self, priority, texts, use_cache, stats):
+        """Vectors for ``texts``, taking what it can from the cache; counts hits into ``stats``"""
+        if self.cache is None or not use_cache:
+            return self._submit(priority, texts)
+        keys = [EmbeddingCache.key(self.model_id, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = {}  # key -> position of its first text, so a repeated text is embedded once
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, i)
+        if missing:
+            computed = [
+                np.asarray(vector, dtype="float32")
+                for vector in self._submit(priority, [texts[i] for i in missing.values()])
+            ]
+            self.cache.put_many(list(missing), computed)
+            computed = dict(zip(missing, computed))
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        hits = len(texts) - sum(1 for key in keys if key in missing)
+        metrics = get_metrics()
+        metrics.incr("embedding_cache", hits, result="hit")
+        metrics.incr("embedding_cache", len(texts) - hits, result="miss")
+        if stats is not None:
+            stats["hits"] = stats.get("hits", 0) + hits
+            stats["misses"] = stats.get("misses", 0) + len(texts) - hits
+        return vectors
+
+    def embed_documents(self, texts, use_cache=True, stats=None):
+        return self._embed(self.DOCUMENT_PRIORITY, list(texts), use_cache, stats)
+
+    def embed_query(self, text, use_cache=True):
+        # Same encoding as documents (the model has no query prompt), so queries batch with each other
+        return self._embed(self.QUERY_PRIORITY, [text], use_cache, None)[0]
+
+
+@st.cache_resource
+def get_shared_embeddings():
+    """Load the embedding model once per process"""
+    return SharedEmbeddings(cache=get_embedding_cache() if EMBEDDING_CACHE_ENABLED else None)
+
+
+class CrossEncoderReranker:
+    """Second-stage ranking with a cross-encoder, which reads the question and a chunk together.
+
+    That is much better at telling the best chunk from a merely similar one than
+    comparing embeddings, but costs a forward pass per chunk, so only the first
+    stage's best candidates are scored, in batches on the CPU. Like
+    ``SharedEmbeddings``, one model is shared by every session and runs one batch at
+    a time. Scores are cached per (question, book, chunk id), so a repeated or
+    retried question is not scored twice.
+    """
+
+    def __init__(self, model_name=RERANK_MODEL_NAME, batch_size=RERANK_BATCH_SIZE, max_tokens=RERANK_MAX_TOKENS,
+                 cache_entries=RERANK_CACHE_ENTRIES):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_entries = cache_entries
+        self._model = sentence_transformers.CrossEncoder(model_name, max_length=max_tokens, device="cpu")
+        self._model_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (question, book id, chunk id) -> score, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, query, candidates):
+        """Relevance scores, higher is better, for ``(book_id, chunk_id, text)`` candidates"""
+        question = " ".join(query.lower().split())
+        keys = [(question, book_id, chunk_id) for book_id, chunk_id, _ in candidates]
+        with self._lock:
+            scores = [self._cache.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._cache.move_to_end(key)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        metrics = get_metrics()
+        metrics.incr("rerank_cache", len(keys) - len(missing), result="hit")
+        metrics.incr("rerank_cache", len(missing), result="miss")
+        if missing:
+            pairs = [(query, candidates[i][2]) for i in missing]
+            with self._model_lock:
+                predicted = self._model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            with self._lock:
+                for i, score in zip(missing, predicted):
+                    scores[i] = float(score)
+                    self._cache[keys[i]] = scores[i]
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return scores
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+@st.cache_resource
+def get_reranker():
+    """Load the cross-encoder once per process"""
+    return CrossEncoderReranker()
+
+
+def warm_up():
+    """Import the lazily loaded dependencies and load the embedding (and reranking) model"""
+    with get_metrics().span("warm_up"):
+        for module in (faiss, text_splitters, google_exceptions, genai, glm):
+            module.load()
+        get_shared_embeddings().embed_query("warm up", use_cache=False)  # Run the model once
+        if RERANK_ENABLED:
+            get_reranker().score("warm up", [(None, None, "warm up")])
+
+
+@st.cache_resource
+def start_warm_up():
+    """Run ``warm_up`` on a background thread, once per process"""
+    def run():
+        try:
+            warm_up()
+        except Exception as e:  # The first question will load (and report) it instead
+            get_metrics().logger.warning(f"Background warm-up failed: {e}")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    if WARM_UP:
+        thread.start()
+    return thread
+
+
+class VectorStoreRegistry:
+    """Read-only processed books shared between sessions that uploaded the same PDF.
+
+    Books are keyed by their index cache key. Each book remembers which chatbots
+    currently use it (weakly, so abandoned sessions release it automatically) and
+    is dropped from memory once nobody holds it; the on-disk cache brings it back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._books = {}
+
+    def _prune(self):
+        for key in [k for k, book in self._books.items() if not book["owners"]]:
+            del self._books[key]
+
+    def acquire(self, key, owner):
+        """Return the shared book for ``key`` (registering ``owner``) or None"""
+        with self._lock:
+            book = self._books.get(key)
+            if book is not None:
+                book["owners"].add(owner)
+            return book
+
+    def publish(self, key, index, chunks, pages, owner, lexical=None, sections=None):
+        """Share a freshly loaded book; if another session won the race, reuse theirs"""
+        with self._lock:
+            self._prune()
+            book = self._books.get(key)
+            if book is None:
+                lexical = lexical or BM25Index.from_texts(chunks.texts())
+                book = {
+                    "key": key,
+                    "index": index,
+                    "lexical": lexical,
+                    "chunks": chunks,
+                    "sections": sections or SectionIndex(),
+                    "pages": pages,
+                    "owners": weakref.WeakSet(),
+                    "nbytes": self._estimate_nbytes(index, lexical, chunks),
+                }
+                self._books[key] = book
+            book["owners"].add(owner)
+            return book
+
+    def release(self, key, owner):
+        with self._lock:
+            book = self._books.get(key)
+            if book is not None:
+                book["owners"].discard(owner)
+            self._prune()
+
+    @staticmethod
+    def _estimate_nbytes(index, lexical, chunks):
+        return {"index": index_nbytes(index) + lexical.nbytes, "text": chunks.nbytes}
+
+    def memory_usage(self):
+        """Per-book memory accounting plus totals"""
+        with self._lock:
+            self._prune()
+            books = [
+                {
+                    "key": book["key"],
+                    "chunks": len(book["chunks"]),
+                    "pages": len(book["pages"]),
+                    "sessions": len(book["owners"]),
+                    "index_bytes": book["nbytes"]["index"],
+                    "text_bytes": book["nbytes"]["text"],
+                }
+                for book in self._books.values()
+            ]
+        return {
+            "books": books,
+            "index_bytes": sum(b["index_bytes"] for b in books),
+            "text_bytes": sum(b["text_bytes"] for b in books),
+            "rss_bytes": process_rss_bytes(),
+        }
+
+
+@st.cache_resource
+def get_vectorstore_registry():
+    """One registry of shared books per process"""
+    return VectorStoreRegistry()
+
+
+class SemanticResponseCache:
+    """Previous answers, looked up by question similarity.
+
+    An answer is only reused for a question whose embedding is within ``threshold``
+    cosine similarity of the original and whose retrieval returned the same chunks,
+    so a cached answer is always grounded in the same book passages. Entries expire
+    after ``ttl`` seconds and the least recently used ones are evicted beyond
+    ``max_entries``.
+    """
+
+    def __init__(self, threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Least recently used first
+        self._next_id = itertools.count()
+        self._matrix = None  # Normalized question vectors, rebuilt lazily after changes
+        self._matrix_ids = []
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_ids):
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+        if entry_ids:
+            self._matrix = None
+            self.evictions += len(entry_ids)
+
+    def _expire(self):
+        now = time.time()
+        self._remove([i for i, entry in self._entries.items() if now - entry["created"] > self.ttl])
+
+    def lookup(self, question_vector, chunk_keys):
+        """Cached answer for a similar question over the same chunks, or None"""
+        chunk_keys = frozenset(chunk_keys)
+        with self._lock:
+            self._expire()
+            if self._entries:
+                if self._matrix is None:
+                    self._matrix_ids = list(self._entries)
+                    self._matrix = np.stack([self._entries[i]["vector"] for i in self._matrix_ids])
+                similarities = self._matrix @ self._normalize(question_vector)
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    entry_id = self._matrix_ids[position]
+                    entry = self._entries[entry_id]
+                    if entry["chunk_keys"] == chunk_keys:
+                        self._entries.move_to_end(entry_id)
+                        entry["hits"] += 1
+                        self.hits += 1
+                        return entry["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, question, question_vector, chunk_keys, answer):
+        with self._lock:
+            self._entries[next(self._next_id)] = {
+                "question": question,
+                "vector": self._normalize(question_vector),
+                "chunk_keys": frozenset(chunk_keys),
+                "answer": answer,
+                "created": time.time(),
+                "hits": 0,
+            }
+            self._matrix = None
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                self._remove(list(self._entries)[:overflow])
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+@st.cache_resource
+def get_response_cache():
+    """One answer cache per process, shared by all sessions"""
+    return SemanticResponseCache()
+
+
+def pin_gemini_client(model, api_key, asynchronous=False):
+    """Give a ``genai.GenerativeModel`` its own service client for ``api_key``, unless it has one.
+
+    The SDK only takes a key through the process-wide ``genai.configure``, so the
+    model's private client slot is filled instead. This is the one place that relies
+    on SDK internals. It fails loudly on an SDK version it was not checked against,
+    rather than risk a request going out with another session's key.
+    """
+    version = tuple(int(part) for part in re.findall(r"\d+", genai.__version__)[:2])
+    attribute = "_async_client" if asynchronous else "_client"
+    if not GEMINI_SDK_VERSIONS[0] <= version < GEMINI_SDK_VERSIONS[1] or not hasattr(model, attribute):
+        raise RuntimeError(
+            f"google-generativeai {genai.__version__} is not supported (per-key clients need "
+            f">={'.'.join(map(str, GEMINI_SDK_VERSIONS[0]))},<{'.'.join(map(str, GEMINI_SDK_VERSIONS[1]))})"
+        )
+    if getattr(model, attribute) is None:
+        client_class = glm.GenerativeServiceAsyncClient if asynchronous else glm.GenerativeServiceClient
+        setattr(model, attribute, client_class(client_options={"api_key": api_key}))
+
+
+class GeminiClients:
+    """Process-wide Gemini model clients, one per API key.
+
+    Keys are only held as SHA-256 digests in the lookup tables. A key is checked
+    once with a (free) token count and the outcome is trusted for ``key_ttl``
+    seconds, so Streamlit reruns never hit the network. Each key gets its own
+    service client rather than going through ``genai.configure``, whose global
+    state would be shared by concurrent sessions using different keys.
+    """
+
+    def __init__(self, model_name=GEMINI_MODEL_NAME, key_ttl=GEMINI_KEY_TTL, max_retries=GEMINI_MAX_RETRIES):
+        self.model_name = model_name
+        self.key_ttl = key_ttl
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._models = {}
+        self._validated = {}  # key digest -> (ok, message, expires_at)
+        self.calls = 0
+        self.retries = 0
+
+    @staticmethod
+    def retryable_errors():
+        """Rate-limit and transient server errors (resolved lazily, with the Gemini SDK)"""
+        return (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+        )
+
+    @staticmethod
+    def _digest(api_key):
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    def model(self, api_key):
+        """The reusable model client for this key"""
+        digest = self._digest(api_key)
+        with self._lock:
+            model = self._models.get(digest)
+            if model is None:
+                model = genai.GenerativeModel(self.model_name, system_instruction=ASHOK_PERSONA)
+                pin_gemini_client(model, api_key)
+                self._models[digest] = model
+            return model
+
+    def validate(self, api_key):
+        """(ok, message) for the key, checked over the network at most once per TTL"""
+        digest = self._digest(api_key)
+        now = time.time()
+        with self._lock:
+            cached = self._validated.get(digest)
+        if cached and cached[2] > now:
+            return cached[0], cached[1]
+
+        try:
+            self.model(api_key).count_tokens("Test")
+            result = (True, "API key configured successfully!", now + self.key_ttl)
+        except Exception as e:
+            result = (False, f"Error configuring API: {str(e)}", now + GEMINI_KEY_RETRY_TTL)
+            with self._lock:
+                self._models.pop(digest, None)
+        with self._lock:
+            self._validated[digest] = result
+        return result[0], result[1]
+
+    @staticmethod
+    def _retry_after(error):
+        """Server-suggested delay in seconds for a rate-limit error, if any"""
+        for detail in getattr(error, "details", None) or ():
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None and (delay.seconds or delay.nanos):
+                return delay.seconds + delay.nanos / 1e9
+        match = re.search(r"retry in ([\d.]+)\s*s", str(error), re.IGNORECASE)
+        return float(match.group(1)) if match else None
+
+    async def generate_async(self, api_key, prompt, stream=False):
+        """``generate_content_async`` with exponential backoff on transient failures.
+
+        Rate-limit errors wait for the server's retry hint when it gives one. With
+        ``stream=True`` only establishing the stream is retried; the first chunk is
+        read eagerly by the SDK, so no partial answer has reached the caller yet.
+        Must run on one event loop only: the key's async service client is created
+        lazily on the loop that first uses it.
+        """
+        model = self.model(api_key)
+        pin_gemini_client(model, api_key, asynchronous=True)
+        for attempt in itertools.count():
+            try:
+                with self._lock:
+                    self.calls += 1
+                return await model.generate_content_async(prompt, stream=stream)
+            except self.retryable_errors() as e:
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    def _backoff(self, attempt, error):
+        """Seconds to wait before retrying ``error``; re-raises it once retries are used up"""
+        if attempt >= self.max_retries:
+            raise error
+        delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt)
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, GEMINI_BACKOFF_MAX))
+        with self._lock:
+            self.retries += 1
+        get_metrics().incr("gemini_retries", reason=type(error).__name__)
+        # Jitter keeps sessions sharing a key from retrying in lockstep
+        return delay * (0.5 + np.random.random() / 2)
+
+
+def record_gemini_usage(response):
+    """Count the prompt and output tokens Gemini reports for one call"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        metrics = get_metrics()
+        metrics.incr("gemini_tokens", usage.prompt_token_count or 0, kind="prompt")
+        metrics.incr("gemini_tokens", usage.candidates_token_count or 0, kind="output")
+
+
+class _MockGeminiResponse:
+    """Just enough of a Gemini response (text, usage and async chunk iteration) for the app"""
+
+    def __init__(self, text, prompt, chunk_delay=0.0):
+        self.text = text
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=estimate_tokens(prompt), candidates_token_count=estimate_tokens(text)
+        )
+        self._chunk_delay = chunk_delay
+        self._chunks = [types.SimpleNamespace(text=w) for w in re.findall(r"\S+\s*", text)]
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield chunk
+
+
+class MockGeminiClients(GeminiClients):
+    """Offline stand-in for Gemini, selected with ``ASHOK_GEMINI_BACKEND=mock``.
+
+    Any API key is accepted and every answer takes ``latency`` seconds (half before
+    the first token when streaming), so the rest of the app can be tested and
+    benchmarked without network access or quota.
+    """
+
+    def __init__(self, latency=MOCK_GEMINI_LATENCY, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def validate(self, api_key):
+        return True, "Mock Gemini backend: API key not checked"
+
+    def _response(self, prompt):
+        question = prompt.rsplit("User Question:", 1)[-1].strip()
+        references = prompt.count("**Reference ")
+        text = (
+            f"Acha yaar, this is a mock answer to: {question} "
+            f"(built from {references} book passage{'s' if references != 1 else ''})."
+        )
+        return _MockGeminiResponse(text, prompt, chunk_delay=self.latency / 2 / max(1, len(text.split())))
+
+    async def generate_async(self, api_key, prompt, stream=False):
+        with self._lock:
+            self.calls += 1
+        await asyncio.sleep(self.latency / 2 if stream else self.latency)
+        return self._response(prompt)
+
+
+@st.cache_resource
+def get_gemini_clients():
+    """One set of Gemini clients per process, shared by all sessions"""
+    if GEMINI_BACKEND == "mock":
+        return MockGeminiClients()
+    return GeminiClients()
+
+
+class AnswerEngine:
+    """Asynchronous question answering on a background event loop.
+
+    Retrieval runs in worker threads and Gemini is called through its async client,
+    so many questions (from several sessions, or a batch) are in flight at once
+    while each key has at most ``max_concurrency`` upstream calls. Identical
+    in-flight prompts for the same key are coalesced into a single call. Synchronous
+    callers such as the Streamlit script use ``run`` and ``stream``.
+    """
+
+    def __init__(self, clients=None, max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self.clients = clients or get_gemini_clients()
+        self.max_concurrency = max_concurrency
+        self.coalesced = 0
+        self._limiters = {}  # key digest -> asyncio.Semaphore; only touched on the loop
+        self._in_flight = {}  # (key digest, prompt digest) -> task of the shared call
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="ashok-answers", daemon=True).start()
+
+    # Bridging from synchronous code
+
+    async def _bound(self, trace, coro):
+        get_metrics().bind(trace)
+        return await coro
+
+    def submit(self, coro):
+        """Schedule ``coro`` on the engine loop; spans it records join the caller's trace"""
+        return asyncio.run_coroutine_threadsafe(self._bound(get_metrics().current_trace(), coro), self._loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    def stream(self, api_key, prompt, on_complete=None):
+        """Iterate over streamed Gemini chunks from synchronous code.
+
+        The stream is consumed on the engine loop under the key's limiter.
+        ``on_complete(response)`` is called with the finished response (for its usage
+        metadata) once the stream ends.
+        """
+        items = queue.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async with self._limiter(api_key):
+                    response = await self.clients.generate_async(api_key, prompt, stream=True)
+                    async for chunk in response:
+                        items.put(chunk)
+                if on_complete:
+                    on_complete(response)
+            except Exception as e:
+                items.put(e)
+            finally:
+                items.put(done)
+
+        future = self.submit(produce())
+        try:
+            while (item := items.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()  # The reader stopped early; stop pulling from Gemini
+
+    # Gemini calls
+
+    def _limiter(self, api_key):
+        digest = GeminiClients._digest(api_key)
+        limiter = self._limiters.get(digest)
+        if limiter is None:
+            limiter = self._limiters[digest] = asyncio.Semaphore(self.max_concurrency)
+        return limiter
+
+    async def _call(self, api_key, prompt):
+        async with self._limiter(api_key):
+            with get_metrics().span("gemini"):
+                response = await self.clients.generate_async(api_key, prompt)
+        # Once per upstream call, however many coalesced waiters share it
+        record_gemini_usage(response)
+        return response
+
+    async def generate(self, api_key, prompt):
+        """Gemini response for ``prompt``, sharing the call with identical in-flight prompts"""
+        key = (GeminiClients._digest(api_key), hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._call(api_key, prompt))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            get_metrics().incr("gemini_coalesced")
+        # A waiter that gives up must not cancel the call other waiters share
+        return await asyncio.shield(task)
+
+    # Answers
+
+    async def answer(self, chatbot, question, api_key, book_ids=None, use_cache=True, memory=None):
+        """Answer one question for ``chatbot``; returns response, cached flag and trace"""
+        metrics = get_metrics()
+        with metrics.request("answer", mode="async") as trace:
+            cached = False
+            try:
+                ready_response, context = await asyncio.to_thread(
+                    chatbot._prepare_answer, question, book_ids, use_cache, memory
+                )
+                if ready_response is not None:
+                    cached = context['cached']
+                    response_text = ready_response
+                else:
+                    response = await self.generate(api_key, context['prompt'])
+                    response_text = chatbot._finish_answer(context, response.text)
+            except Exception as e:
+                metrics.incr("errors", where="answer")
+                response_text = f"Sorry yaar, I encountered an error: {str(e)}. Please try again!"
+            trace["cached"] = cached
+        return {"response": response_text, "cached": cached, "trace": trace}
+
+    async def answer_many(self, chatbot, questions, api_key, book_ids=None, use_cache=True):
+        """Answer a list of questions concurrently, in order"""
+        return await asyncio.gather(
+            *(self.answer(chatbot, question, api_key, book_ids, use_cache) for question in questions)
+        )
+
+
+@st.cache_resource
+def get_answer_engine():
+    """One answer engine (and event loop) per process, shared by all sessions"""
+    return AnswerEngine()
+
+
+def choose_index_backend(n_vectors):
+    """Index type for a corpus of ``n_vectors`` when INDEX_BACKEND is "auto" """
+    if n_vectors < 10_000:
+        return "flat"  # Brute force is exact and still sub-millisecond
+    if n_vectors < 200_000:
+        return "hnsw"
+    if n_vectors < 1_000_000:
+        return "ivf_flat"
+    return "ivf_pq"  # Compressed codes once raw vectors stop fitting comfortably in RAM
+
+
+def _ivf_nlist(n_vectors):
+    # ~4*sqrt(n) inverted lists, keeping at least 39 training points per list
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def _pq_subquantizers(dim):
+    return next(m for m in (48, 32, 24, 16, 12, 8, 4, 2, 1) if dim % m == 0)
+
+
+def configure_index_search(index, nprobe=None, ef_search=None):
+    """Apply the query-time recall/latency knobs to an index of any backend"""
+    nprobe = INDEX_NPROBE if nprobe is None else nprobe
+    ef_search = INDEX_EF_SEARCH if ef_search is None else ef_search
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def index_backend_name(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if faiss.try_extract_index_ivf(index) is not None:
+        return "ivf_flat"
+    return "flat"
+
+
+def _scalar_quantizer_type(storage):
+    if storage == "float16":
+        return faiss.ScalarQuantizer.QT_fp16
+    if storage == "int8":
+        return faiss.ScalarQuantizer.QT_8bit
+    raise ValueError(f"Unknown vector storage: {storage}")
+
+
+def build_index(vectors, backend, storage=None):
+    """Build (and train, where needed) an L2 index of the given backend over ``vectors``.
+
+    ``storage`` (default VECTOR_STORAGE) is how flat, HNSW and IVF-flat indexes keep
+    the vectors: float32, or scalar quantized to float16 (half the memory) or int8
+    (a quarter). IVF-PQ always stores compressed codes.
+    """
+    storage = storage or VECTOR_STORAGE
+    if storage not in VECTOR_STORAGE_TYPES:
+        raise ValueError(f"Unknown vector storage: {storage}")
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n_vectors, dim = vectors.shape
+
+    # Fall back to simpler backends when there is too little data to train on
+    if backend == "ivf_pq" and n_vectors < 256 * 39:
+        backend = "ivf_flat"
+    if backend in ("ivf_flat", "ivf_pq") and n_vectors < 2 * 39:
+        backend = "flat"
+    quantized = storage != "float32" and backend != "ivf_pq"
+
+    if backend == "flat":
+        if quantized:
+            index = faiss.IndexScalarQuantizer(dim, _scalar_quantizer_type(storage), faiss.METRIC_L2)
+        else:
+            index = faiss.IndexFlatL2(dim)
+    elif backend == "hnsw":
+        if quantized:
+            index = faiss.IndexHNSWSQ(dim, _scalar_quantizer_type(storage), HNSW_M)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif backend == "ivf_flat":
+        if quantized:
+            index = faiss.IndexIVFScalarQuantizer(
+                faiss.IndexFlatL2(dim), dim, _ivf_nlist(n_vectors), _scalar_quantizer_type(storage), faiss.METRIC_L2
+            )
+        else:
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, _ivf_nlist(n_vectors))
+    elif backend == "ivf_pq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, _ivf_nlist(n_vectors), _pq_subquantizers(dim), 8)
+    else:
+        raise ValueError(f"Unknown index backend: {backend}")
+
+    if not index.is_trained:
+        index.train(vectors)  # IVF centroids, PQ codebooks and int8 value ranges
+    index.add(vectors)
+    return configure_index_search(index)
+
+
+def optimize_index(index, backend=None, storage=None):
+    """Rebuild an incrementally filled flat index as the configured backend and vector storage.
+
+    Returns the new index, or None if the flat index should be kept.
+    """
+    backend = backend or INDEX_BACKEND
+    storage = storage or VECTOR_STORAGE
+    if backend == "auto":
+        backend = choose_index_backend(index.ntotal)
+    if (backend == "flat" and storage == "float32") or index.ntotal == 0:
+        return None
+    return build_index(index.reconstruct_n(0, index.ntotal), backend, storage)
+
+
+def search_params_in_span(index, start, stop):
+    """FAISS search parameters restricting ``index`` to ids ``start <= id < stop``, keeping its search knobs"""
+    selector = faiss.IDSelectorRange(start, stop)
+    if isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    elif faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.try_extract_index_ivf(index).nprobe)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    params.selector_ref = selector  # The parameters do not keep the selector alive on their own
+    return params
+
+
+def index_nbytes(index):
+    """Approximate memory held by an index: vector codes, plus HNSW links and IVF ids"""
+    if isinstance(index, faiss.IndexHNSW):
+        links = index.ntotal * 2 * HNSW_M * 4  # Level 0 dominates: 2*M int32 neighbours per vector
+        return index_nbytes(faiss.downcast_index(index.storage)) + links
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return index.ntotal * (ivf.code_size + 8)
+    return index.ntotal * getattr(index, "code_size", index.d * 4)
+
+
+def index_recall_report(vectors, queries, k=10, configs=None):
+    """Recall@k and per-query latency of each backend/knob setting against exact search.
+
+    ``configs`` maps backend -> list of knob values (nprobe for IVF, efSearch for
+    HNSW). Returns one row per setting, the flat baseline first.
+    """
+    if configs is None:
+        configs = {
+            "ivf_flat": [1, 4, 8, 16, 32, 64],
+            "hnsw": [16, 32, 64, 128, 256],
+            "ivf_pq": [4, 8, 16, 32, 64],
+        }
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    k = min(k, len(vectors))
+
+    def measure(index):
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            _, ids = index.search(query[None, :], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(ids[0])
+        latencies.sort()
+        return found, {
+            "p50_ms": latencies[len(latencies) // 2],
+            "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "mean_ms": sum(latencies) / len(latencies),
+        }
+
+    start = time.perf_counter()
+    flat = build_index(vectors, "flat", "float32")
+    truth, timings = measure(flat)
+    rows = [{"backend": "flat", "knob": None, "recall": 1.0, "build_s": time.perf_counter() - start, **timings}]
+
+    for backend, knob_values in configs.items():
+        start = time.perf_counter()
+        index = build_index(vectors, backend)
+        build_s = time.perf_counter() - start
+        actual = index_backend_name(index)
+        if actual != backend:
+            rows.append({"backend": backend, "skipped": f"too few vectors, would fall back to {actual}"})
+            continue
+        for knob in knob_values:
+            if backend == "hnsw":
+                configure_index_search(index, ef_search=knob)
+            else:
+                configure_index_search(index, nprobe=knob)
+            found, timings = measure(index)
+            recall = sum(
+                len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth)
+            ) / (k * len(queries))
+            rows.append({"backend": backend, "knob": knob, "recall": recall, "build_s": build_s, **timings})
+    return rows
+
+
+LEXICAL_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+LEXICAL_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from had has have how i if in into is it its "
+    "me my of on or our should so than that the their them then there these they this to was we "
+    "were what when where which who why will with would you your".split()
+)
+
+
+def lexical_tokens(text):
+    return [t for t in LEXICAL_TOKEN_PATTERN.findall(text.lower()) if t not in LEXICAL_STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over a book's chunks, stored as compressed sparse rows.
+
+    Postings are three flat arrays (``indptr`` per term id, then document ids and
+    term frequencies) rather than per-term Python lists. Documents are the book's
+    chunks in ``book["chunks"]`` order. Chunks added during ingestion are buffered
+    and merged into the arrays on the next search (or ``compact``), so the index
+    stays searchable while the book is still being built.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._vocab = {}
+        self._indptr = np.zeros(1, dtype="int64")
+        self._doc_ids = np.zeros(0, dtype="int32")
+        self._tfs = np.zeros(0, dtype="uint16")
+        self._doc_lengths = np.zeros(0, dtype="float32")
+        self._norm = np.zeros(0, dtype="float32")  # k1 * (1 - b + b * len / avg_len) per document
+        self._pending = ([], [], [], [])  # term ids, doc ids, tfs, doc lengths
+
+    @classmethod
+    def from_texts(cls, texts):
+        index = cls()
+        index.add(texts)
+        index.compact()
+        return index
+
+    def __len__(self):
+        return len(self._doc_lengths) + len(self._pending[3])
+
+    def add(self, texts):
+        with self._lock:
+            terms, docs, tfs, lengths = self._pending
+            doc_id = len(self._doc_lengths) + len(lengths)
+            for text in texts:
+                tokens = lexical_tokens(text)
+                counts = {}
+                for token in tokens:
+                    term_id = self._vocab.setdefault(token, len(self._vocab))
+                    counts[term_id] = counts.get(term_id, 0) + 1
+                terms.extend(counts)
+                docs.extend([doc_id] * len(counts))
+                tfs.extend(counts.values())
+                lengths.append(len(tokens))
+                doc_id += 1
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        terms, docs, tfs, lengths = self._pending
+        if not lengths:
+            return
+        old_terms = np.repeat(np.arange(len(self._indptr) - 1, dtype="int32"), np.diff(self._indptr))
+        all_terms = np.concatenate([old_terms, np.asarray(terms, dtype="int32")])
+        order = np.argsort(all_terms, kind="stable")  # Stable keeps each posting list in doc order
+        self._doc_ids = np.concatenate([self._doc_ids, np.asarray(docs, dtype="int32")])[order]
+        self._tfs = np.concatenate([self._tfs, np.minimum(np.asarray(tfs), 65535).astype("uint16")])[order]
+        self._indptr = np.zeros(len(self._vocab) + 1, dtype="int64")
+        np.cumsum(np.bincount(all_terms, minlength=len(self._vocab)), out=self._indptr[1:])
+        self._doc_lengths = np.concatenate([self._doc_lengths, np.asarray(lengths, dtype="float32")])
+        average = self._doc_lengths.mean() or 1.0
+        self._norm = (self.k1 * (1 - self.b + self.b * self._doc_lengths / average)).astype("float32")
+        self._pending = ([], [], [], [])
+
+    def search(self, query, k, span=None):
+        """Top ``k`` (document index, score) pairs, best first; documents without a query term are left out.
+        
+        ``span`` limits the search to documents ``start <= index < stop``.
+        """
+        with self._lock:
+            self._compact()
+            term_ids = {self._vocab[t] for t in lexical_tokens(query) if t in self._vocab}
+            n_docs = len(self._doc_lengths)
+            if not term_ids or not n_docs:
+                return []
+            scores = np.zeros(n_docs, dtype="float32")
+            for term_id in term_ids:
+                start, end = self._indptr[term_id], self._indptr[term_id + 1]
+                if start == end:
+                    continue
+                docs = self._doc_ids[start:end]
+                tf = self._tfs[start:end].astype("float32")
+                idf = math.log(1 + (n_docs - (end - start) + 0.5) / (end - start + 0.5))
+                scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._norm[docs])
+        if span is not None:
+            scores[:span[0]] = 0
+            scores[span[1]:] = 0
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(int(doc), float(scores[doc])) for doc in matched]
+
+    @property
+    def nbytes(self):
+        arrays = (self._indptr, self._doc_ids, self._tfs, self._doc_lengths, self._norm)
+        return sum(a.nbytes for a in arrays)
+
+
+@st.cache_resource
+def get_search_pool():
+    """Threads that run lexical search alongside query embedding and vector search"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="ashok-search")
+
+
+class IngestionCheckpoint:
+    """An ingestion's progress on disk, so an interrupted ingestion resumes where it stopped.
+
+    Every ``every_pages`` pages, the chunks of the pages that are completely indexed
+    are appended to ``chunks.jsonl`` and their vectors to ``vectors.f32``. Then
+    ``progress.json`` is replaced atomically, recording how much of both files is
+    valid and the headings found so far. Anything written after the last progress
+    update (a crash mid-checkpoint) is truncated on resume.
+    """
+
+    CHUNKS_FILE = "chunks.jsonl"
+    VECTORS_FILE = "vectors.f32"
+    PROGRESS_FILE = "progress.json"
+
+    def __init__(self, directory, every_pages=INGESTION_CHECKPOINT_PAGES):
+        self.directory = directory
+        self.every_pages = every_pages
+        self.enabled = True  # Turned off if the directory cannot be written
+        self.last_page = 0  # Pages up to this one are saved
+        self._progress = {"chunks": 0, "chunks_bytes": 0, "vectors_bytes": 0, "last_page": 0, "headings": None}
+        self._pending = []  # (chunk, vector) indexed since the last checkpoint, in order
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def restore(self):
+        """What an earlier run saved: ``(chunks, vectors, headings)``, empty if nothing was.
+
+        ``headings`` are heading-built sections as (page, level, title); sections
+        from the PDF outline are not saved, since they are read again.
+        """
+        try:
+            with open(self._path(self.PROGRESS_FILE), encoding="utf-8") as f:
+                progress = json.load(f)
+            with open(self._path(self.CHUNKS_FILE), "r+b") as f:
+                f.truncate(progress["chunks_bytes"])
+                chunks = [Chunk(*json.loads(line)) for line in f.read().decode("utf-8").splitlines()]
+            with open(self._path(self.VECTORS_FILE), "r+b") as f:
+                f.truncate(progress["vectors_bytes"])
+            vectors = np.fromfile(self._path(self.VECTORS_FILE), dtype="float32")
+            if len(chunks) != progress["chunks"] or (chunks and vectors.size % len(chunks)):
+                raise ValueError("Checkpoint files do not match")
+        except (OSError, ValueError, KeyError, TypeError):
+            self.clear()  # Nothing saved, or unreadable: start over
+            return [], None, None
+        self._progress = progress
+        self.last_page = progress["last_page"]
+        return chunks, vectors.reshape(len(chunks), -1) if chunks else None, progress["headings"]
+
+    def record(self, chunks, vectors, sections):
+        """Note a batch that was just indexed; saves a checkpoint once enough pages are complete"""
+        if not self.enabled:
+            return
+        self._pending.extend(zip(chunks, vectors))
+        # Pages arrive in order, so every page before the batch's last one is complete
+        if chunks[-1].page - 1 - self.last_page >= self.every_pages:
+            self._save(chunks[-1].page, sections)
+
+    def _save(self, end_page, sections):
+        done = [item for item in self._pending if item[0].page < end_page]
+        chunk_data = "".join(json.dumps(list(chunk)) + "\n" for chunk, _ in done).encode("utf-8")
+        vector_data = np.asarray([vector for _, vector in done], dtype="float32").tobytes()
+        headings = None
+        if sections.source == "headings":
+            # Only headings of saved pages: later ones are found again on resume
+            headings = [
+                (sections.starts[i], sections.levels[i], sections.titles[i])
+                for i in range(len(sections)) if sections.starts[i] < end_page
+            ]
+        progress = {
+            "chunks": self._progress["chunks"] + len(done),
+            "chunks_bytes": self._progress["chunks_bytes"] + len(chunk_data),
+            "vectors_bytes": self._progress["vectors_bytes"] + len(vector_data),
+            "last_page": end_page - 1,
+            "headings": headings,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name, data in ((self.CHUNKS_FILE, chunk_data), (self.VECTORS_FILE, vector_data)):
+                with open(self._path(name), "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            temporary = self._path(self.PROGRESS_FILE + ".tmp")
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(progress, f)
+            os.replace(temporary, self._path(self.PROGRESS_FILE))
+        except OSError as e:
+            get_metrics().logger.warning(f"Ingestion checkpoints disabled, could not write {self.directory}: {e}")
+            self.enabled = False
+            self._pending = []
+            return
+        self._pending = self._pending[len(done):]
+        self._progress = progress
+        self.last_page = progress["last_page"]
+        get_metrics().incr("ingestion_checkpoints")
+
+    def clear(self):
+        for name in (self.CHUNKS_FILE, self.VECTORS_FILE, self.PROGRESS_FILE):
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+        self.last_page = 0
+        self._progress = {"chunks": 0, "chunks_bytes": 0, "vectors_bytes": 0, "last_page": 0, "headings": None}
+        self._pending = []
+
+
+class IngestionPipeline:
+    """Staged book ingestion: extract/chunk -> embed (batched) -> index.
+
+    Each stage runs on its own thread and hands work to the next through a bounded
+    queue, so only a few batches are in memory at once and embedding starts with the
+    first extracted pages. Chunks become searchable as soon as their batch is
+    indexed, while later pages are still being ingested.
+    """
+
+    _DONE = object()  # End of stream marker passed down the queues
+    _STOPPED = object()  # Returned by _get when the pipeline was cancelled or failed
+
+    def __init__(self, chatbot, book_id, pages, batch_size=EMBED_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE, outline=None,
+                 checkpoint=None):
+        self.chatbot = chatbot
+        self.book_id = book_id
+        self.pages = pages
+        self.outline = outline  # ``pdf_outline`` entries, or a callable returning them
+        self.checkpoint = checkpoint  # IngestionCheckpoint to resume from and save to
+        self.sections = SectionIndex()
+        self.batch_size = batch_size
+        self._chunk_queue = queue.Queue(maxsize=queue_size)
+        self._vector_queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._running_stages = 0
+        self.error = None
+        self.page_numbers = []  # Pages with text, in order
+        self.pages_done = 0
+        self.pages_total = None
+        self.chunks_created = 0
+        self.chunks_indexed = 0
+        self.pages_resumed = 0  # Pages restored from the checkpoint rather than ingested
+        self.embedding_cache = {"hits": 0, "misses": 0}  # Chunks found in / missing from the embedding cache
+        self.started_at = None
+        self.first_indexed_at = None
+        self.finished_at = None
+
+    # Stage plumbing
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return self._STOPPED
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            self.error = e
+            self._stop.set()
+            get_metrics().incr("errors", where="ingestion")
+        finally:
+            with self._lock:
+                self._running_stages -= 1
+                last = self._running_stages == 0
+            if last:
+                self.finished_at = time.perf_counter()
+                if self.error is None and not self._stop.is_set():
+                    self.chatbot._finish_ingestion(self, self.page_numbers)
+                self._done.set()
+
+    def on_page_progress(self, done, total):
+        """Progress callback for the page extractor"""
+        self.pages_done, self.pages_total = done, total
+
+    # Stages
+
+    def _chunk_stage(self):
+        metrics = get_metrics()
+        text_splitter = self.chatbot._make_text_splitter()
+        outline = self.outline() if callable(self.outline) else self.outline
+        if outline:
+            # Filled in place: the book already holds this SectionIndex
+            for page, level, title in outline:
+                self.sections._append(page, level, title)
+            self.sections.source = "outline"
+        if callable(self.pages):
+            # Page source factory that accepts our progress callback
+            self.pages = self.pages(self.on_page_progress)
+        try:
+            for page_info in self.pages:
+                if self._stop.is_set():
+                    return
+                self.page_numbers.append(page_info['page'])
+                with metrics.span("ingest.split"):
+                    chunks = self.chatbot._chunk_page(page_info, text_splitter, self.chunks_created, self.sections)
+                self.chunks_created += len(chunks)
+                if chunks and not self._put(self._chunk_queue, chunks):
+                    return
+        finally:
+            # Stop the extractor's worker pool if we bailed out early
+            close = getattr(self.pages, "close", None)
+            if close:
+                close()
+        self._put(self._chunk_queue, self._DONE)
+
+    def _embed_stage(self):
+        metrics = get_metrics()
+        embeddings = self.chatbot._get_embeddings()
+        batch = []
+        while True:
+            item = self._get(self._chunk_queue)
+            if item is self._STOPPED:
+                return
+            finished = item is self._DONE
+            if not finished:
+                batch.extend(item)
+            while len(batch) >= self.batch_size or (finished and batch):
+                current, batch = batch[:self.batch_size], batch[self.batch_size:]
+                with metrics.span("ingest.embed"):
+                    vectors = embeddings.embed_documents([chunk.text for chunk in current], stats=self.embedding_cache)
+                if not self._put(self._vector_queue, (current, vectors)):
+                    return
+            if finished:
+                self._put(self._vector_queue, self._DONE)
+                return
+
+    def _index_stage(self):
+        metrics = get_metrics()
+        while True:
+            item = self._get(self._vector_queue)
+            if item is self._STOPPED or item is self._DONE:
+                return
+            chunks, vectors = item
+            with metrics.span("ingest.index"):
+                self.chatbot._index_chunks(self, chunks, vectors)
+            self.chunks_indexed += len(chunks)
+            if self.checkpoint is not None:
+                with metrics.span("ingest.checkpoint"):
+                    self.checkpoint.record(chunks, vectors, self.sections)
+            if self.first_indexed_at is None:
+                self.first_indexed_at = time.perf_counter()
+
+    def _restore(self):
+        """Index what the checkpoint saved; the page source must start after ``checkpoint.last_page``"""
+        chunks, vectors, headings = self.checkpoint.restore()
+        for page, level, title in headings or ():
+            self.sections._append(page, level, title)
+        if chunks:
+            self.chatbot._index_chunks(self, chunks, vectors)
+            self.page_numbers = list(dict.fromkeys(chunk.page for chunk in chunks))
+            self.chunks_created = self.chunks_indexed = len(chunks)
+            self.pages_resumed = len(self.page_numbers)
+
+    # Control
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.checkpoint is not None:
+            self._restore()
+        stages = [("chunk", self._chunk_stage), ("embed", self._embed_stage), ("index", self._index_stage)]
+        self._running_stages = len(stages)
+        for name, stage in stages:
+            threading.Thread(target=self._run_stage, args=(stage,), name=f"ingest-{name}", daemon=True).start()
+        return self
+
+    def wait(self, timeout=None):
+        """Block until ingestion ends; returns False if still running after ``timeout``"""
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._stop.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def succeeded(self):
+        return self.done and self.error is None and not self._stop.is_set()
+
+    def stats(self):
+        elapsed = (self.finished_at or time.perf_counter()) - self.started_at if self.started_at else 0.0
+        looked_up = self.embedding_cache["hits"] + self.embedding_cache["misses"]
+        return {
+            "pages": len(self.page_numbers),
+            "chunks": self.chunks_indexed,
+            "pages_resumed": self.pages_resumed,
+            "seconds": elapsed,
+            "time_to_first_query": (self.first_indexed_at - self.started_at) if self.first_indexed_at else None,
+            "chunks_per_second": self.chunks_indexed / elapsed if elapsed else 0.0,
+            "embedding_cache_hit_ratio": self.embedding_cache["hits"] / looked_up if looked_up else 0.0,
+        }
+
+
+def _chunk_text(chunk):
+    """Text of a streamed Gemini chunk; chunks without text parts (e.g. safety-only) yield ''"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+# Question relevance keywords. Greetings are regexes; everything else is matched as whole words
+GREETING_PATTERNS = [
+    r'\b(hello|hi|hey|salam|assalam|namaste|adab|sat sri akal)\b',
+    r'\b(good morning|good evening|good afternoon|good night)\b',
+    r'\b(how are you|kaise ho|kya hal|sup|wassup|how r u)\b',
+    r'\b(what.*your name|tumhara naam|aap ka naam|name kya hai)\b',
+    r'\b(who are you|tum kaun|aap kaun|kaun ho)\b',
+    r'\b(nice to meet|pleasure to meet|glad to meet)\b'
+]
+
+# Expanded silly/irrelevant keywords
+SILLY_KEYWORDS = [
+    # Fun/entertainment
+    'stupid', 'dumb', 'idiot', 'fool', 'nonsense', 'bullshit', 'crap',
+    'joke', 'funny', 'lol', 'haha', 'hehe', 'lmao', 'rofl', 'lmfao',
+    # Personal preferences
+    'what color', 'favorite food', 'favorite movie', 'favorite song',
+    'favorite book', 'favorite actor', 'favorite place', 'best food',
+    # Entertainment
+    'weather', 'movie', 'song', 'game', 'sport', 'celebrity', 'actor',
+    'actress', 'singer', 'cricket', 'football', 'drama', 'tv show',
+    # Relationships/personal
+    'gossip', 'love', 'relationship', 'dating', 'marriage', 'girlfriend',
+    'boyfriend', 'crush', 'romance', 'flirt', 'beautiful', 'handsome',
+    'cute', 'sexy', 'hot', 'attract',
+    # Personal info
+    'age', 'old', 'young', 'birthday', 'party', 'dance', 'music',
+    'height', 'weight', 'appearance', 'look like',
+    # Social media
+    'facebook', 'instagram', 'twitter', 'tiktok', 'youtube', 'snapchat',
+    'whatsapp', 'telegram', 'social media',
+    # Politics/controversial
+    'politics', 'election', 'government', 'minister', 'president',
+    'prime minister', 'political party', 'vote', 'democracy',
+    # Random topics
+    'conspiracy', 'alien', 'ufo', 'ghost', 'magic', 'supernatural',
+    'religion', 'god', 'allah', 'prayer', 'temple', 'mosque', 'church'
+]
+
+# Abusive/inappropriate keywords (expanded)
+ABUSIVE_KEYWORDS = [
+    # English abusive
+    'fuck', 'shit', 'damn', 'hell', 'bitch', 'bastard', 'asshole',
+    'stupid', 'idiot', 'moron', 'retard', 'crazy', 'mad', 'loser',
+    'suck', 'sucks', 'cunt', 'dick', 'penis', 'vagina', 'sex',
+    # Urdu/Hindi abusive
+    'chutiya', 'madarchod', 'behenchod', 'gandu', 'randi', 'saala',
+    'kamina', 'harami', 'kutta', 'kutti', 'gadha', 'ullu', 'pagal',
+    'bhenchod', 'madarchodd', 'randii', 'gaandu', 'lodu', 'lawde',
+    'bhosdike', 'gaand', 'lauda', 'lund', 'choot', 'bhosda'
+]
+
+# Problem-solving related keywords (expanded and categorized)
+PROBLEM_SOLVING_KEYWORDS = [
+    # Core problem solving
+    'problem', 'solve', 'solution', 'issue', 'challenge', 'difficulty',
+    'dilemma', 'obstacle', 'hurdle', 'barrier', 'bottleneck',
+    # Methods and approaches
+    'strategy', 'approach', 'method', 'technique', 'framework',
+    'methodology', 'process', 'procedure', 'system', 'model',
+    # Analysis and thinking
+    'analysis', 'analyze', 'evaluate', 'assess', 'examine',
+    'investigate', 'research', 'study', 'review', 'consider',
+    # Decision making
+    'decision', 'choose', 'select', 'option', 'alternative',
+    'choice', 'decide', 'determine', 'conclude', 'judgment',
+    # Planning and execution
+    'plan', 'planning', 'goal', 'objective', 'target', 'aim',
+    'step', 'steps', 'phase', 'stage', 'milestone', 'timeline',
+    # Skills and improvement
+    'skill', 'ability', 'competence', 'improve', 'enhance',
+    'develop', 'learn', 'master', 'practice', 'train',
+    # Effectiveness and optimization
+    'effective', 'efficient', 'optimize', 'maximize', 'minimize',
+    'improve', 'enhance', 'better', 'best', 'optimal',
+    # Resolution and handling
+    'resolve', 'overcome', 'handle', 'manage', 'deal with',
+    'tackle', 'address', 'fix', 'repair', 'correct',
+    # Creative and critical thinking
+    'creative', 'innovation', 'brainstorm', 'idea', 'concept',
+    'thinking', 'critical thinking', 'logical', 'rational',
+    # Specific domains
+    'conflict', 'negotiation', 'communication', 'leadership',
+    'team', 'collaboration', 'productivity', 'workflow',
+    'project', 'task', 'deadline', 'priority', 'organize'
+]
+
+# Words that mark a proper question
+QUESTION_WORDS = [
+    'what', 'how', 'why', 'when', 'where', 'which', 'who',
+    'can', 'should', 'would', 'could', 'will', 'do', 'does',
+    'is', 'are', 'was', 'were', 'have', 'has', 'had',
+    'explain', 'describe', 'tell', 'show', 'help', 'suggest'
+]
+
+
+def _build_relevance_patterns():
+    """Per category: a compiled keyword pattern, and the keywords each keyword contains.
+
+    Keywords match whole words with an optional plural, so "hell" no longer fires on
+    "hello", "age" on "manage" nor "plan" on "planet". Categories are scanned
+    separately and a phrase also counts the keywords inside it, so overlapping
+    keywords all count, as they did in the word lists: "critical thinking" is two
+    problem-solving keywords, and "best food" is both silly and problem solving.
+    """
+    def keywords(terms):
+        terms = sorted(set(terms), key=len, reverse=True)  # Longest first, so phrases win
+        word = {term: re.compile(rf"\b{re.escape(term)}(?:s|es)?\b") for term in terms}
+        contained = {
+            term: frozenset({term} | {other for other in terms if other != term and word[other].search(term)})
+            for term in terms
+        }
+        alternation = "|".join(re.escape(term).replace(r"\ ", r"\s+") for term in terms)
+        return re.compile(rf"\b({alternation})(?:s|es)?\b"), contained
+
+    greetings = "|".join(f"(?:{pattern})" for pattern in GREETING_PATTERNS)
+    return {
+        "greeting": (re.compile(f"({greetings})"), {}),
+        "silly": keywords(SILLY_KEYWORDS),
+        "abusive": keywords(ABUSIVE_KEYWORDS),
+        "problem_solving": keywords(PROBLEM_SOLVING_KEYWORDS),
+        "question": keywords(QUESTION_WORDS),
+    }
+
+
+RELEVANCE_PATTERNS = _build_relevance_patterns()
+
+
+def has_relevance_keyword(question_lower, category):
+    return RELEVANCE_PATTERNS[category][0].search(question_lower) is not None
+
+
+def relevance_score(question_lower, category):
+    """Number of distinct keywords of ``category`` in the question"""
+    pattern, contained = RELEVANCE_PATTERNS[category]
+    matched = set()
+    for match in pattern.finditer(question_lower):
+        term = re.sub(r"\s+", " ", match.group(1))
+        matched.update(contained.get(term, (term,)))
+    return len(matched)
+
+
+def is_silly_or_irrelevant(question):
+    """Enhanced detection of silly, irrelevant, or abusive questions"""
+    # Convert to lowercase for checking
+    question_lower = question.lower().strip()
+    
+    # Very short questions or empty
+    if len(question_lower) < 3:
+        return True
+    
+    # Each category is only scanned once the decision needs it
+    # 1. Greetings and abusive keywords are flagged immediately
+    if has_relevance_keyword(question_lower, "greeting") or has_relevance_keyword(question_lower, "abusive"):
+        return True
+    
+    # 2. Multiple problem-solving keywords are a strong indicator of relevance
+    problem_solving_score = relevance_score(question_lower, "problem_solving")
+    if problem_solving_score >= 2:
+        return False
+    
+    # 3. Even one silly keyword is suspicious
+    if has_relevance_keyword(question_lower, "silly"):
+        return True
+    
+    # 4. Advanced heuristics
+    has_question_word = has_relevance_keyword(question_lower, "question")
+    word_count = len(question_lower.split())
+    
+    # Very short questions without context
+    if word_count < 4 and not has_question_word:
+        return True
+    
+    # Questions with reasonable length and structure
+    if word_count >= 5 and has_question_word:
+        # Check if it's a genuine question
+        if problem_solving_score >= 1 or '?' in question:
+            return False
+    
+    # Random statements or very short queries
+    if word_count < 6 and '?' not in question and not has_question_word:
+        return True
+    
+    # If unclear, err on the side of being helpful
+    return False
+
+
+# Ashok's standing instructions, sent as the model's system instruction rather than
+# repeated in every prompt
+ASHOK_PERSONA = """You are Ashok, a problem-solving expert with a distinctive Pakistani/Indian style. Your characteristics:
+
+1. **Language Style**: Mix English with Urdu words naturally - use words like "yaar", "acha", "bilkul", "samjha", "bas", "abhi", "phir", "waise", "matlab", "dekho", "suno"
+
+2. **Personality**:
+   - Enthusiastic and encouraging about good questions
+   - Practical and no-nonsense approach
+   - Supportive but direct
+   - Uses local expressions and cultural references
+
+3. **Response Pattern**:
+   - Start with appreciation: "Excellent question yaar!" or "Bahut acha sawal!" or "Bilkul sahi poocha!"
+   - Provide detailed, actionable advice
+   - Use examples and analogies
+   - ALWAYS reference the book content when available
+   - End with encouragement or next steps
+
+4. **Book Integration Rules**:
+   - ALWAYS use the book content provided with the question when it's relevant
+   - Reference the book title and specific chapters/sections and pages
+   - Quote or paraphrase from the book
+   - Acknowledge the book as the source: "According to the book..." or "As mentioned in Chapter X..."
+   - Don't just use book content - explain and expand on it
+
+5. **Urdu-English Integration**:
+   - Use them naturally in context
+   - Examples: "Dekho yaar, the book says...", "Bilkul theek approach hai ye", "Samjha na?"
+
+Instructions:
+- If book content is provided with the question, YOU MUST reference it in your response
+- Mention the book title and specific chapters, pages, or sections when citing a book
+- Expand on the book's content with your own insights
+- Provide practical, actionable advice
+- Use your characteristic English-Urdu mixed style
+- Be comprehensive but conversational"""
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English prose)"""
+    return len(text) // 4 + 1
+
+
+def _join_overlapping(first, second, max_overlap=None):
+    """Concatenate consecutive chunks, dropping the text the splitter repeated in both"""
+    max_overlap = 2 * CHUNK_OVERLAP if max_overlap is None else max_overlap  # Read now: benchmarks override it
+    for size in range(min(len(first), len(second), max_overlap), 19, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def _shingles(text, size=5):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def pack_context(results, token_budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD):
+    """Turn search results into prompt passages that fit ``token_budget``.
+
+    Results with consecutive ``chunk_id``s from the same book are merged into one
+    passage without their overlapping text, near-identical passages are dropped,
+    and passages are then taken best score first until the budget is spent (the
+    best one is truncated rather than dropped if it alone is too long).
+    """
+    passages = []
+    for result in sorted(results, key=lambda r: (r['book_id'], r['chunk_id'])):
+        previous = passages[-1] if passages else None
+        if previous and previous['book_id'] == result['book_id'] and previous['chunk_ids'][-1] + 1 == result['chunk_id']:
+            previous['content'] = _join_overlapping(previous['content'], result['content'])
+            previous['chunk_ids'].append(result['chunk_id'])
+            if result['page'] not in previous['pages']:
+                previous['pages'].append(result['page'])
+            previous['score'] = max(previous['score'], result['score'])
+        else:
+            passages.append({
+                'book': result['book'],
+                'book_id': result['book_id'],
+                'chapter': result['chapter'],
+                'pages': [result['page']],
+                'chunk_ids': [result['chunk_id']],
+                'content': result['content'],
+                'score': result['score'],
+            })
+    
+    packed = []
+    kept_shingles = []
+    remaining = token_budget
+    for passage in sorted(passages, key=lambda p: -p['score']):
+        shingles = _shingles(passage['content'])
+        if any(len(shingles & kept) / len(shingles | kept) >= dedup_threshold for kept in kept_shingles):
+            continue
+        tokens = estimate_tokens(passage['content'])
+        if tokens > remaining:
+            if packed:
+                continue
+            passage['content'] = passage['content'][:remaining * 4]
+            tokens = remaining
+        packed.append(passage)
+        kept_shingles.append(shingles)
+        remaining -= tokens
+    return packed
+
+
+def format_pages(pages):
+    return str(pages[0]) if len(pages) == 1 else f"{pages[0]}-{pages[-1]}"
+
+
+# Words that make a short question lean on the previous one ("can you give an example of that?")
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|more|example|examples|elaborate|else|again|above"
+    r"|previous|same|also|further|instead)\b"
+)
+REFERENCE_FOOTER_MARKER = "\n\n" + "=" * 50 + "\n"
+
+
+def _clip(text, tokens):
+    """``text`` cut to about ``tokens`` tokens (see ``estimate_tokens``)"""
+    text = " ".join(text.split())
+    limit = max(0, tokens) * 4
+    return text if len(text) <= limit else text[:max(0, limit - 3)].rstrip() + "..."
+
+
+class ConversationMemory:
+    """Bounded memory of one chat, so follow-up questions are understood.
+
+    The last ``window`` question/answer pairs are kept verbatim. Older turns are
+    folded into a running summary one at a time as they leave the window (the
+    question and the gist sentence of the answer), and the oldest summary lines
+    are dropped beyond half of ``token_budget``. ``context`` renders both within
+    ``token_budget``, so the prompt stays the same size however long the chat runs.
+    """
+
+    def __init__(self, window=MEMORY_WINDOW_TURNS, token_budget=MEMORY_TOKEN_BUDGET):
+        self.window = window
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self.turns = deque()  # (question, answer), oldest first
+        self.summary = deque()  # One line per turn that left the window
+        self._summary_tokens = 0
+        self.topic = None  # Last question that stood on its own
+        self.turn_count = 0
+
+    @classmethod
+    def from_messages(cls, messages, **kwargs):
+        """Memory of a chat given as ``{"role": "user"|"assistant", "content": ...}`` messages"""
+        memory = cls(**kwargs)
+        question = None
+        for message in messages:
+            if message.get("role") == "user":
+                question = message.get("content") or ""
+            elif message.get("role") == "assistant" and question is not None:
+                memory.add(question, message.get("content") or "")
+                question = None
+        return memory
+
+    def is_follow_up(self, question):
+        if self.topic is None:
+            return False
+        words = question.split()
+        return len(words) <= 4 or (len(words) <= FOLLOW_UP_MAX_WORDS and bool(FOLLOW_UP_PATTERN.search(question.lower())))
+
+    def retrieval_query(self, question):
+        """The question to search with: follow-ups get the topic they refer to folded in"""
+        with self._lock:
+            return f"{self.topic} {question}" if self.is_follow_up(question) else question
+
+    def add(self, question, answer):
+        """Record a finished turn (the reference footer is not kept)"""
+        answer = answer.split(REFERENCE_FOOTER_MARKER, 1)[0]
+        with self._lock:
+            if not self.is_follow_up(question):
+                self.topic = question
+            self.turns.append((question, answer))
+            self.turn_count += 1
+            while len(self.turns) > self.window:
+                self._fold(*self.turns.popleft())
+
+    def _fold(self, question, answer):
+        # First real sentence of the answer, past openers such as "Excellent question yaar!"
+        sentences = re.split(r"(?<=[.!?])\s", " ".join(answer.split()))
+        gist = next((sentence for sentence in sentences if len(sentence.split()) >= 6), sentences[0])
+        line = f"- Q: {_clip(question, 15)} A: {_clip(gist, 25)}"
+        self.summary.append(line)
+        self._summary_tokens += estimate_tokens(line)
+        while self._summary_tokens > self.token_budget // 2 and self.summary:
+            self._summary_tokens -= estimate_tokens(self.summary.popleft())
+
+    def context(self):
+        """The summary and recent turns as prompt text, within ``token_budget``"""
+        with self._lock:
+            summary = list(self.summary)
+            turns = list(self.turns)
+        if not summary and not turns:
+            return ""
+        text = "=== CONVERSATION SO FAR ===\n"
+        remaining = self.token_budget - estimate_tokens(text)
+        if summary:
+            earlier = "Earlier:\n" + "\n".join(summary) + "\n"
+            text += earlier
+            remaining -= estimate_tokens(earlier)
+        if turns:
+            text += "Recent:\n"
+            remaining -= 2
+            share = remaining // len(turns) - 4  # Equal share per turn, less the "User:"/"Ashok:" labels
+            for question, answer in turns:
+                text += f"User: {_clip(question, share // 3)}\nAshok: {_clip(answer, share - share // 3)}\n"
+        return text + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.turns.clear()
+            self.summary.clear()
+            self._summary_tokens = 0
+            self.topic = None
+            self.turn_count = 0
+
+    def stats(self):
+        with self._lock:
+            return {"turns": self.turn_count, "recent": len(self.turns), "summarized": len(self.summary)}
+
+
+class Answer:
+    """One answer to a question: the full ``response``, whether it was ``cached``, its
+    ``latency`` and ``trace``. A streamed answer iterates over its text as it is
+    written, and these are set once the iteration ends.
+    """
+
+    def __init__(self):
+        self.response = ""
+        self.cached = False
+        self.latency = None
+        self.trace = None
+        self._pieces = iter(())
+
+    def __iter__(self):
+        return self._pieces
+
+    def close(self):
+        """Stop a streamed answer early (e.g. the client went away)"""
+        close = getattr(self._pieces, "close", None)
+        if close:
+            close()
 
-# Custom CSS for better UI
-st.markdown("""
-<style>
-    .main-header {
-        text-align: center;
-        color: #2E86AB;
-        font-size: 2.5em;
-        margin-bottom: 0.5em;
-    }
-    .sub-header {
-        text-align: center;
-        color: #A23B72;
-        font-size: 1.2em;
-        margin-bottom: 2em;
-    }
-    .chat-message {
-        padding: 1rem;
-        border-radius: 10px;
-        margin-bottom: 1rem;
-        border-left: 4px solid #2E86AB;
-    }
-    .user-message {
-        background-color: #E8F4FD;
-        border-left-color: #2E86AB;
-    }
-    .assistant-message {
-        background-color: #F0F8FF;
-        border-left-color: #A23B72;
-    }
-    .sidebar .element-container {
-        margin-bottom: 1rem;
-    }
-    .book-reference {
-        background-color: #f0f8ff;
-        padding: 10px;
-        border-left: 4px solid #2E86AB;
-        margin: 10px 0;
-        border-radius: 5px;
-    }
-</style>
-""", unsafe_allow_html=True)
 
 class AshokChatbot:
     def __init__(self):
         self.embeddings = None
-        self.vectorstore = None
-        self.book_content = ""
-        self.book_chunks = []  # Store chunks with metadata
-        
+        self.books = {}  # Library of books by source id, in the order they were added
+        self.response_timings = deque(maxlen=100)  # Recent first-token / total latencies
+        self.request_traces = deque(maxlen=METRICS_RECENT_TRACES)  # Per-request span breakdowns
+        self.index_lock = threading.Lock()  # Guards the library and indexes still being built
+
+    def _get_embeddings(self):
+        """Use the process-wide embedding model (using free HuggingFace embeddings)"""
+        if self.embeddings is None:
+            self.embeddings = get_shared_embeddings()
+        return self.embeddings
+
+    @property
+    def book_chunks(self):
+        """Chunks of every book in the library (materialized; use ``chunk_count`` to count them)"""
+        return [chunk for book in list(self.books.values()) for chunk in book["chunks"]]
+
+    @property
+    def chunk_count(self):
+        return sum(len(book["chunks"]) for book in list(self.books.values()))
+
+    def _add_book(self, book_id, title, key=None, index=None, chunks=None, pages=None, sections=None):
+        book = {
+            "id": book_id,
+            "title": title or book_id,
+            "key": key,  # Index cache / shared registry key
+            "index": index,  # FAISS index; row i is chunk i
+            "lexical": BM25Index.from_texts(chunks.texts() if chunks is not None else []),
+            "chunks": chunks if chunks is not None else ChunkStore(),
+            "sections": sections if sections is not None else SectionIndex(),  # Page -> chapter/section
+            "pages": pages if pages is not None else [],  # Numbers of the pages with text
+            "ingestion": None,  # Pipeline while the book is still being built
+            "lock": self.index_lock,  # Guards the index while it is built: the building chatbot's lock
+            "shared": False,
+        }
+        with self.index_lock:
+            previous = self.books.get(book_id)
+            if previous is not None and previous["ingestion"] is not None and previous["ingestion"].chatbot is self:
+                previous["ingestion"].cancel()
+            self.books[book_id] = book
+        return book
+
+    def attach_ingesting_book(self, book):
+        """Search a book another chatbot (an ingestion job's) is still building, as it grows.
+
+        The book is shared rather than copied, and searched under its builder's lock.
+        Removing it from this library does not stop its ingestion.
+        """
+        with self.index_lock:
+            self.books[book["id"]] = book
+
+    def attach_shared_book(self, registry, key, book_id, title=None):
+        """Add a book another session already loaded; returns False if it isn't loaded"""
+        shared = registry.acquire(key, self)
+        if shared is None:
+            return False
+        book = self._add_book(book_id, title, key)
+        self._use_shared(book, shared)
+        return True
+
+    def share_book(self, registry, book_id):
+        """Publish a book this chatbot just loaded so other sessions can reuse it"""
+        book = self.books[book_id]
+        shared = registry.publish(
+            book["key"], book["index"], book["chunks"], book["pages"], self,
+            lexical=book["lexical"], sections=book["sections"],
+        )
+        self._use_shared(book, shared)
+
+    def _use_shared(self, book, shared):
+        with self.index_lock:
+            book["index"] = shared["index"]
+            book["lexical"] = shared["lexical"]
+            book["chunks"] = shared["chunks"]
+            book["sections"] = shared["sections"]
+            book["pages"] = shared["pages"]
+            book["shared"] = True
+
+    def remove_book(self, registry, book_id):
+        """Drop one book from the library; the other books are untouched"""
+        with self.index_lock:
+            book = self.books.pop(book_id, None)
+        if book is None:
+            return False
+        if book["ingestion"] is not None and book["ingestion"].chatbot is self:
+            book["ingestion"].cancel()
+        if book["shared"]:
+            registry.release(book["key"], self)
+        return True
+
+    def release_books(self, registry):
+        for book_id in list(self.books):
+            self.remove_book(registry, book_id)
+
     def configure_gemini(self, api_key):
-        """Configure Gemini API with the provided key"""
-        try:
-            genai.configure(api_key=api_key)
-            # Test the API key
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            test_response = model.generate_content("Test")
-            return True, "API key configured successfully!"
-        except Exception as e:
-            return False, f"Error configuring API: {str(e)}"
+        """Validate the Gemini API key; the result is cached per key"""
+        return get_gemini_clients().validate(api_key)
     
-    def extract_text_from_pdf(self, pdf_file):
+    def iter_pdf_pages(self, pdf_file, progress=None):
+        """Stream non-empty pages from the in-memory upload as they are extracted"""
+        return iter_pdf_pages(pdf_file.getvalue(), progress=progress)
+    
+    def extract_text_from_pdf(self, pdf_file, progress=None):
         """Extract text from uploaded PDF file with better structure preservation"""
         try:
-            # Create a temporary file to save the uploaded PDF
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                tmp_file.write(pdf_file.read())
-                tmp_file_path = tmp_file.name
-            
-            # Extract text from PDF with page information
-            reader = PdfReader(tmp_file_path)
-            text = ""
-            page_texts = []
-            
-            for page_num, page in enumerate(reader.pages, 1):
-                page_text = page.extract_text()
-                if page_text.strip():  # Only add non-empty pages
-                    page_texts.append({
-                        'page': page_num,
-                        'text': page_text,
-                        'word_count': len(page_text.split())
-                    })
-                    text += f"\n--- Page {page_num} ---\n{page_text}\n"
-            
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
-            
-            return text, page_texts
+            with get_metrics().span("extract_pdf"):
+                page_texts = list(self.iter_pdf_pages(pdf_file, progress=progress))
+            return join_page_texts(page_texts), page_texts
         except Exception as e:
+            get_metrics().incr("errors", where="extract_pdf")
             st.error(f"Error extracting text from PDF: {str(e)}")
             return None, []
     
-    def process_book_content(self, text, page_texts):
-        """Process the book content and create vector embeddings with better chunking"""
+    def _make_text_splitter(self):
+        # Create text splitter with better parameters for problem-solving content
+        return text_splitters.RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=len,
+            separators=CHUNK_SEPARATORS
+        )
+    
+    def _chunk_page(self, page_info, text_splitter, first_chunk_id, sections=None):
+        """Split one page into chunks; chunk ids continue from ``first_chunk_id``.
+        
+        With ``sections`` (pages must then arrive in order), chunks are labelled with
+        the section containing the page, and a heading-built index learns this page's
+        heading. Without it, only this page's own heading is used.
+        """
+        page_text = page_info['text']
+        
+        # Try to identify chapter/section titles
+        lines = page_text.split('\n')
+        chapter_title = self._extract_chapter_title(lines)
+        if sections is not None:
+            if sections.source == "headings" and chapter_title != SectionIndex.UNKNOWN:
+                sections.add_heading(page_info['page'], chapter_title)
+            chapter_title = sections.title_at(page_info['page'])
+        
+        return [
+            Chunk(text, page_info['page'], chapter_title, chunk_id)
+            for chunk_id, text in enumerate(text_splitter.split_text(page_text), first_chunk_id)
+        ]
+    
+    def _ingesting_book(self, pipeline):
+        """The book ``pipeline`` is building, unless it was removed or superseded"""
+        book = self.books.get(pipeline.book_id)
+        return book if book is not None and book["ingestion"] is pipeline else None
+    
+    def _index_chunks(self, pipeline, chunks, vectors):
+        """Add a batch of embedded chunks to the (possibly still growing) vector store"""
+        with self.index_lock:
+            book = self._ingesting_book(pipeline)
+            if book is None:
+                return
+            if book["index"] is None:
+                book["index"] = faiss.IndexFlatL2(len(vectors[0]))
+            book["index"].add(np.asarray(vectors, dtype="float32"))
+            book["chunks"].add(chunks)
+            book["lexical"].add([chunk.text for chunk in chunks])
+    
+    def _finish_ingestion(self, pipeline, pages):
+        book = self._ingesting_book(pipeline)
+        if book is None:
+            return
+        
+        book["lexical"].compact()
+        book["chunks"].compact()
+        if book["index"] is not None:
+            book["sections"].summarize(book["index"], book["chunks"])
+        
+        # Ingestion fills a flat index; once complete, train the configured ANN index
+        # (the flat one keeps serving queries until the swap)
+        optimized = optimize_index(book["index"]) if book["index"] is not None else None
+        
+        with self.index_lock:
+            book = self._ingesting_book(pipeline)
+            if book is None:
+                return
+            if optimized is not None:
+                book["index"] = optimized
+            book["pages"] = pages
+            book["ingestion"] = None
+    
+    def start_ingestion(self, page_texts, book_id=DEFAULT_BOOK_ID, title=None, key=None, batch_size=EMBED_BATCH_SIZE,
+                        outline=None, checkpoint=None):
+        """Start ingesting a book in the background; it is searchable as batches land.
+        
+        ``page_texts`` may be a generator (see ``iter_pdf_pages``), so chunking and
+        embedding start while later pages are still being extracted, or a callable
+        that takes a ``progress(done, total)`` callback and returns such a generator.
+        ``outline`` gives the book's sections (see ``pdf_outline``); without one they
+        are taken from page headings. With an ``IngestionCheckpoint``, what it saved
+        is indexed first and ``page_texts`` must only yield the pages after its
+        ``last_page`` (it is read once ``page_texts`` is called). Other books in the
+        library are not touched.
+        """
+        pipeline = IngestionPipeline(
+            self, book_id, page_texts, batch_size=batch_size, outline=outline, checkpoint=checkpoint
+        )
+        book = self._add_book(book_id, title, key, sections=pipeline.sections)
+        book["ingestion"] = pipeline
+        return pipeline.start()
+    
+    def start_pdf_ingestion(self, pdf_file, book_id, title=None, key=None):
+        """Ingest an uploaded PDF in the background with per-page progress"""
+        pdf_bytes = pdf_file.getvalue()
+        return self.start_ingestion(
+            lambda progress: iter_pdf_pages(pdf_bytes, progress=progress), book_id, title, key,
+            outline=lambda: pdf_outline(pdf_bytes),
+        )
+    
+    def process_book_content(self, text, page_texts, book_id=DEFAULT_BOOK_ID, title=None, key=None, outline=None):
+        """Process the book content and create vector embeddings with better chunking.
+        
+        ``text`` is the joined page text from ``extract_text_from_pdf``; it is not kept,
+        since the chunk store holds the book's text.
+        """
         try:
-            # Initialize embeddings (using free HuggingFace embeddings)
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2"
-            )
-            
-            # Create text splitter with better parameters for problem-solving content
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=800,  # Smaller chunks for better precision
-                chunk_overlap=150,  # More overlap for context
-                length_function=len,
-                separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]  # Better separators
-            )
+            with get_metrics().span("process_book"):
+                pipeline = self.start_ingestion(page_texts, book_id, title, key, outline=outline)
+                pipeline.wait()
+            if pipeline.error is not None:
+                raise pipeline.error
+            book = self.books.get(book_id)
+            if book is None or not book["chunks"]:
+                self.books.pop(book_id, None)
+                return False, "No extractable text found in the PDF"
             
-            # Create documents with better metadata
-            documents = []
-            for page_info in page_texts:
-                page_text = page_info['text']
-                
-                # Try to identify chapter/section titles
-                lines = page_text.split('\n')
-                chapter_title = self._extract_chapter_title(lines)
-                
-                # Create document with rich metadata
-                doc = Document(
-                    page_content=page_text,
-                    metadata={
-                        "source": "problem_solving_book",
-                        "page": page_info['page'],
-                        "chapter": chapter_title,
-                        "word_count": page_info['word_count']
-                    }
-                )
-                documents.append(doc)
-            
-            # Split documents into chunks
-            chunks = text_splitter.split_documents(documents)
-            
-            # Enhance chunks with additional metadata
-            for i, chunk in enumerate(chunks):
-                chunk.metadata['chunk_id'] = i
-                chunk.metadata['chunk_length'] = len(chunk.page_content)
-            
-            # Store chunks for reference
-            self.book_chunks = chunks
-            
-            # Create vector store
-            self.vectorstore = FAISS.from_documents(chunks, self.embeddings)
-            self.book_content = text
-            
-            return True, f"Successfully processed {len(chunks)} chunks from {len(page_texts)} pages!"
+            return True, f"Successfully processed {len(book['chunks'])} chunks from {len(book['pages'])} pages!"
         except Exception as e:
             return False, f"Error processing book content: {str(e)}"
     
+    def load_from_cache(self, index_cache, key, book_id, title=None):
+        """Load a previously processed book from the on-disk index cache"""
+        try:
+            cached = index_cache.load(key)
+            get_metrics().incr("index_cache", result="miss" if cached is None else "hit")
+            if cached is None:
+                return False, "Book not found in cache"
+            
+            index, chunks, pages, sections = cached
+            self._add_book(book_id, title, key, index, chunks, pages, sections)
+            return True, f"Loaded {len(chunks)} chunks from {len(pages)} pages from cache!"
+        except Exception as e:
+            return False, f"Error loading cached book: {str(e)}"
+    
+    def save_to_cache(self, index_cache, book_id, content_hash=None):
+        """Persist a processed book so later uploads of the same PDF skip processing"""
+        book = self.books.get(book_id)
+        if not book or book["index"] is None or not book["key"]:
+            return False
+        try:
+            index_cache.save(
+                book["key"], book["index"], book["chunks"], book["pages"], book["sections"], content_hash=content_hash
+            )
+            return True
+        except Exception as e:
+            st.warning(f"Could not cache processed book: {str(e)}")
+            return False
+    
     def _extract_chapter_title(self, lines):
         """Extract chapter or section title from page content"""
         for line in lines[:10]:  # Check first 10 lines
@@ -178,310 +3125,708 @@ class AshokChatbot:
                 # Look for title-like patterns (short lines in uppercase or title case)
                 if len(line) < 60 and (line.isupper() or line.istitle()):
                     return line
-        return "Unknown Section"
+        return SectionIndex.UNKNOWN
     
     def is_silly_or_irrelevant_question(self, question):
         """Enhanced detection of silly, irrelevant, or abusive questions"""
-        # Convert to lowercase for checking
-        question_lower = question.lower().strip()
-        
-        # Very short questions or empty
-        if len(question_lower) < 3:
-            return True
+        with get_metrics().span("relevance_check"):
+            return is_silly_or_irrelevant(question)
+    
+    def _lexical_search(self, query, books, k, spans=None):
+        """BM25 hits as (score, book, chunk position) across the given books, best first"""
+        hits = []
+        with get_metrics().span("search.lexical"):
+            for book in books:
+                indexed = len(book["chunks"])
+                for position, score in book["lexical"].search(query, k, span=(spans or {}).get(book["id"])):
+                    if position < indexed:
+                        hits.append((score, book, position))
+        hits.sort(key=lambda hit: -hit[0])
+        return hits[:k]
+    
+    @staticmethod
+    def _section_spans(books, text):
+        """Chunk position spans, per book id, of the sections ``text`` names"""
+        spans = {}
+        for book in books:
+            sections = book["sections"].find(text)
+            if sections:
+                spans[book["id"]] = [book["sections"].chunk_span(section, book["chunks"]) for section in sections]
+        return spans
+    
+    @staticmethod
+    def _result(book, position, score, distance=None, bm25=None, rerank=None):
+        """A search result for the chunk at ``position``; only its text is decoded"""
+        chunk = book["chunks"][position]
+        return {
+            'content': chunk.text,
+            'book': book['title'],
+            'book_id': book['id'],
+            'chunk_id': chunk.chunk_id,
+            'page': chunk.page,
+            'chapter': chunk.chapter,
+            'score': score,
+            'distance': distance,
+            'bm25': bm25,
+            'rerank': rerank,
+        }
+    
+    @staticmethod
+    def _rerank(query, ranked, dense, k):
+        """The first-stage ranking reordered by the cross-encoder, best first.
         
-        # Greeting patterns (more comprehensive)
-        greeting_patterns = [
-            r'\b(hello|hi|hey|salam|assalam|namaste|adab|sat sri akal)\b',
-            r'\b(good morning|good evening|good afternoon|good night)\b',
-            r'\b(how are you|kaise ho|kya hal|sup|wassup|how r u)\b',
-            r'\b(what.*your name|tumhara naam|aap ka naam|name kya hai)\b',
-            r'\b(who are you|tum kaun|aap kaun|kaun ho)\b',
-            r'\b(nice to meet|pleasure to meet|glad to meet)\b'
-        ]
+        Only the top ``RERANK_CANDIDATES`` are scored. When the k nearest chunks by
+        vector distance lead the next one by ``RERANK_MARGIN`` and are also the fused
+        top k, the first-stage order is kept and nothing is scored.
+        """
+        metrics = get_metrics()
+        if len(dense) > k and dense[k][0] - dense[k - 1][0] >= RERANK_MARGIN:
+            nearest = {(book["id"], position) for _, book, position in dense[:k]}
+            if nearest == {(entry["book"]["id"], entry["position"]) for entry in ranked[:k]}:
+                metrics.incr("rerank", result="skipped")
+                return ranked
+        pool = ranked[:RERANK_CANDIDATES]
+        with metrics.span("search.rerank"):
+            candidates = []
+            for entry in pool:
+                chunk = entry["book"]["chunks"][entry["position"]]
+                candidates.append((entry["book"]["id"], chunk.chunk_id, chunk.text))
+            for entry, score in zip(pool, get_reranker().score(query, candidates)):
+                entry["rerank"] = score
+        metrics.incr("rerank", result="scored")
+        return sorted(pool, key=lambda entry: -entry["rerank"])
+    
+    def search_book_content(self, query, k=5, book_ids=None, query_embedding=None, hybrid=None, section=None,
+                            boost_sections=True, rerank=None):
+        """Enhanced search for relevant content across the library (or the given books).
         
-        # Expanded silly/irrelevant keywords
-        silly_keywords = [
-            # Fun/entertainment
-            'stupid', 'dumb', 'idiot', 'fool', 'nonsense', 'bullshit', 'crap',
-            'joke', 'funny', 'lol', 'haha', 'hehe', 'lmao', 'rofl', 'lmfao',
-            # Personal preferences
-            'what color', 'favorite food', 'favorite movie', 'favorite song',
-            'favorite book', 'favorite actor', 'favorite place', 'best food',
-            # Entertainment
-            'weather', 'movie', 'song', 'game', 'sport', 'celebrity', 'actor',
-            'actress', 'singer', 'cricket', 'football', 'drama', 'tv show',
-            # Relationships/personal
-            'gossip', 'love', 'relationship', 'dating', 'marriage', 'girlfriend',
-            'boyfriend', 'crush', 'romance', 'flirt', 'beautiful', 'handsome',
-            'cute', 'sexy', 'hot', 'attract',
-            # Personal info
-            'age', 'old', 'young', 'birthday', 'party', 'dance', 'music',
-            'height', 'weight', 'appearance', 'look like',
-            # Social media
-            'facebook', 'instagram', 'twitter', 'tiktok', 'youtube', 'snapchat',
-            'whatsapp', 'telegram', 'social media',
-            # Politics/controversial
-            'politics', 'election', 'government', 'minister', 'president',
-            'prime minister', 'political party', 'vote', 'democracy',
-            # Random topics
-            'conspiracy', 'alien', 'ufo', 'ghost', 'magic', 'supernatural',
-            'religion', 'god', 'allah', 'prayer', 'temple', 'mosque', 'church'
-        ]
+        Vector search and BM25 keyword search run concurrently and their rankings are
+        merged by reciprocal rank fusion, so exact terms (framework names, acronyms)
+        are found even when the embedding misses them. ``score`` is the fused score;
+        ``distance`` and ``bm25`` are the retrievers' own scores (None if not retrieved).
         
-        # Abusive/inappropriate keywords (expanded)
-        abusive_keywords = [
-            # English abusive
-            'fuck', 'shit', 'damn', 'hell', 'bitch', 'bastard', 'asshole',
-            'stupid', 'idiot', 'moron', 'retard', 'crazy', 'mad', 'loser',
-            'suck', 'sucks', 'cunt', 'dick', 'penis', 'vagina', 'sex',
-            # Urdu/Hindi abusive
-            'chutiya', 'madarchod', 'behenchod', 'gandu', 'randi', 'saala',
-            'kamina', 'harami', 'kutta', 'kutti', 'gadha', 'ullu', 'pagal',
-            'bhenchod', 'madarchodd', 'randii', 'gaandu', 'lodu', 'lawde',
-            'bhosdike', 'gaand', 'lauda', 'lund', 'choot', 'bhosda'
-        ]
+        ``section`` ("chapter 3", or a section title) limits the search to that section
+        of each book that has it. With ``boost_sections``, chunks in a section the query
+        itself names rank higher.
         
-        # Problem-solving related keywords (expanded and categorized)
-        problem_solving_keywords = [
-            # Core problem solving
-            'problem', 'solve', 'solution', 'issue', 'challenge', 'difficulty',
-            'dilemma', 'obstacle', 'hurdle', 'barrier', 'bottleneck',
-            # Methods and approaches
-            'strategy', 'approach', 'method', 'technique', 'framework',
-            'methodology', 'process', 'procedure', 'system', 'model',
-            # Analysis and thinking
-            'analysis', 'analyze', 'evaluate', 'assess', 'examine',
-            'investigate', 'research', 'study', 'review', 'consider',
-            # Decision making
-            'decision', 'choose', 'select', 'option', 'alternative',
-            'choice', 'decide', 'determine', 'conclude', 'judgment',
-            # Planning and execution
-            'plan', 'planning', 'goal', 'objective', 'target', 'aim',
-            'step', 'steps', 'phase', 'stage', 'milestone', 'timeline',
-            # Skills and improvement
-            'skill', 'ability', 'competence', 'improve', 'enhance',
-            'develop', 'learn', 'master', 'practice', 'train',
-            # Effectiveness and optimization
-            'effective', 'efficient', 'optimize', 'maximize', 'minimize',
-            'improve', 'enhance', 'better', 'best', 'optimal',
-            # Resolution and handling
-            'resolve', 'overcome', 'handle', 'manage', 'deal with',
-            'tackle', 'address', 'fix', 'repair', 'correct',
-            # Creative and critical thinking
-            'creative', 'innovation', 'brainstorm', 'idea', 'concept',
-            'thinking', 'critical thinking', 'logical', 'rational',
-            # Specific domains
-            'conflict', 'negotiation', 'communication', 'leadership',
-            'team', 'collaboration', 'productivity', 'workflow',
-            'project', 'task', 'deadline', 'priority', 'organize'
-        ]
+        With ``rerank`` (default ``RERANK_ENABLED``) the best fused candidates are
+        rescored by a cross-encoder; ``score`` and ``rerank`` are then its score.
+        """
+        hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+        rerank = RERANK_ENABLED if rerank is None else rerank
+        with self.index_lock:
+            books = [
+                book for book_id, book in self.books.items()
+                if book["index"] is not None and (book_ids is None or book_id in book_ids)
+            ]
+        filters = None
+        if section:
+            filters = {book_id: spans[0] for book_id, spans in self._section_spans(books, section).items()}
+            books = [book for book in books if book["id"] in filters]
+        if not books:
+            return []
+        boosts = self._section_spans(books, query) if boost_sections else {}
         
-        # Test patterns and keywords
+        metrics = get_metrics()
+        start = time.perf_counter()
+        try:
+            candidates = max(k, HYBRID_CANDIDATES) if hybrid else k
+            if rerank:
+                candidates = max(candidates, RERANK_CANDIDATES)
+            # BM25 needs no embedding, so it runs while the query is embedded and searched; in a
+            # copy of this context, so its span lands in the request's trace
+            lexical = get_search_pool().submit(
+                contextvars.copy_context().run, self._lexical_search, query, books, candidates, filters
+            ) if hybrid else None
+            
+            # Embed outside the lock so a book that is still ingesting stays responsive
+            if query_embedding is None:
+                with metrics.span("search.embed"):
+                    query_embedding = self._get_embeddings().embed_query(query)
+            
+            # Search each selected book's own index and merge by distance; each under the book's
+            # lock, since a book attached from an ingestion job grows under its builder's lock
+            dense = []
+            query_vector = np.asarray([query_embedding], dtype="float32")
+            with metrics.span("search.dense"):
+                for book in books:
+                    with book["lock"]:
+                        if filters:
+                            params = search_params_in_span(book["index"], *filters[book["id"]])
+                            distances, positions = book["index"].search(query_vector, candidates, params=params)
+                        else:
+                            distances, positions = book["index"].search(query_vector, candidates)
+                    dense.extend(
+                        (float(distance), book, int(position))
+                        for distance, position in zip(distances[0], positions[0]) if position >= 0
+                    )
+            dense.sort(key=lambda hit: hit[0])
+            
+            # Reciprocal rank fusion over (book, chunk position) keys
+            fused = {}
+            for retriever, hits in (("distance", dense[:candidates]), ("bm25", lexical.result() if lexical else [])):
+                for rank, (score, book, position) in enumerate(hits, 1):
+                    key = (book["id"], position)
+                    entry = fused.setdefault(
+                        key, {"book": book, "position": position, "score": 0.0, "distance": None, "bm25": None, "rerank": None}
+                    )
+                    entry["score"] += 1.0 / (RRF_K + rank)
+                    entry[retriever] = float(score)
+            for entry in fused.values():
+                if any(lo <= entry["position"] < hi for lo, hi in boosts.get(entry["book"]["id"], ())):
+                    entry["score"] += SECTION_BOOST
+            ranked = sorted(fused.values(), key=lambda entry: -entry["score"])
+            if rerank and len(ranked) > 1:
+                ranked = self._rerank(query, ranked, dense, k)
+            
+            # Format results with metadata; only these chunks' texts are decoded
+            return [
+                self._result(
+                    entry["book"], entry["position"], entry["score"] if entry["rerank"] is None else entry["rerank"],
+                    entry["distance"], entry["bm25"], entry["rerank"],
+                )
+                for entry in ranked[:k]
+            ]
+        except Exception as e:
+            metrics.incr("errors", where="search")
+            st.error(f"Error searching book content: {str(e)}")
+            return []
+        finally:
+            metrics.observe("search", time.perf_counter() - start)
+    
+    def section_overview(self, question, book_ids=None):
+        """Precomputed summary chunks for a broad question about a named section, or None.
         
-        # 1. Check for greeting patterns
-        for pattern in greeting_patterns:
-            if re.search(pattern, question_lower):
-                return True
+        "What does chapter 3 say?" is answered from the summary chunks of that section
+        in each book, so no chunk is scanned or searched. The question must name the
+        section by number or by its whole title; returns None for other questions.
+        """
+        match = BROAD_SECTION_QUESTION_PATTERN.match(question.lower())
+        if match is None:
+            return None
+        reference = match.group("subject") or match.group("object")
+        with self.index_lock:
+            books = [
+                book for book_id, book in self.books.items()
+                if book["ingestion"] is None and (book_ids is None or book_id in book_ids)
+            ]
+        results = []
+        for book in books:
+            sections = book["sections"]
+            found = sections.find_exact(reference)
+            if found and found[0] < len(sections.summaries):
+                summary = sections.summaries[found[0]]
+                # Earlier passages score higher, so packing keeps the section's order
+                results.extend(self._result(book, position, 1.0 / (1 + i)) for i, position in enumerate(summary))
+        if not results:
+            return None
+        get_metrics().incr("section_overview")
+        return results
+    
+    def _prepare_answer(self, question, book_ids=None, use_cache=True, memory=None):
+        """Relevance check, retrieval and answer-cache lookup shared by all answer modes.
         
-        # 2. Check for abusive keywords (immediate flag)
-        if any(keyword in question_lower for keyword in abusive_keywords):
-            return True
+        Returns ``(ready_response, context)``: a response that needs no model call
+        (``context['cached']`` tells whether it came from the answer cache), or None
+        and the prompt and bookkeeping needed to ask Gemini and finish the answer.
+        Safe to call concurrently; it does not touch per-answer state on the chatbot.
         
-        # 3. Check for problem-solving keywords (strong indicator of relevance)
-        problem_solving_score = sum(1 for keyword in problem_solving_keywords 
-                                  if keyword in question_lower)
-        if problem_solving_score >= 2:  # Multiple problem-solving keywords
-            return False
+        With a ``ConversationMemory``, follow-up questions are searched together with
+        the question they follow, and the conversation so far goes into their prompt.
+        The memory is only read; the caller adds the finished turn.
+        """
+        # Check if question is silly or irrelevant
+        if self.is_silly_or_irrelevant_question(question):
+            # More varied "Abay Sallay" responses
+            silly_responses = [
+                "Abay Sallay! Don't waste my time with such bakwas. Ask me something related to problem solving yaar!",
+                "Abay Sallay! Ye kya timepass hai? I'm here to help with problem solving, not for chit-chat. Be serious!",
+                "Abay Sallay! Stop this nonsense and ask me something meaningful about problem solving techniques, samjha?",
+                "Abay Sallay! Mera time waste mat karo with such silly questions. Focus on real problems that need solving!",
+                "Abay Sallay! This is not the place for mazak. Ask me about problem-solving strategies and approaches!",
+                "Abay Sallay! Kya ye sawal hai? I'm a problem-solving expert, not your entertainment buddy. Ask something useful!",
+                "Abay Sallay! Tumhara dimagh kahan hai? Ask questions about problem solving, conflict resolution, ya decision making!",
+                "Abay Sallay! Ye koi game nahi hai. I'm here to share problem-solving wisdom, not for bakwas. Be focused!",
+                "Abay Sallay! Bilkul time waste kar rahe ho. Ask me about analytical thinking, planning, ya strategic approaches!",
+                "Abay Sallay! Pagal ho gaye ho kya? This is a problem-solving platform. Ask something related to challenges and solutions!"
+            ]
+            
+            import random
+            return random.choice(silly_responses), {'cached': False}
         
-        # 4. Check for silly keywords
-        silly_score = sum(1 for keyword in silly_keywords 
-                         if keyword in question_lower)
-        if silly_score >= 1:  # Even one silly keyword is suspicious
-            return True
+        # Embed the (follow-up aware) query once, for both retrieval and the answer cache
+        metrics = get_metrics()
+        query = memory.retrieval_query(question) if memory is not None else question
+        follow_up = memory is not None and (query != question or memory.is_follow_up(question))
+        if query != question:
+            metrics.incr("query_rewritten")
+        with metrics.span("question_embed"):
+            question_embedding = self._get_embeddings().embed_query(query)
         
-        # 5. Check for proper question structure
-        question_words = [
-            'what', 'how', 'why', 'when', 'where', 'which', 'who',
-            'can', 'should', 'would', 'could', 'will', 'do', 'does',
-            'is', 'are', 'was', 'were', 'have', 'has', 'had',
-            'explain', 'describe', 'tell', 'show', 'help', 'suggest'
-        ]
+        # Broad questions about a chapter use its precomputed summary; otherwise search
+        # for relevant content in the book. Either way, pack it into the context budget
+        relevant_results = self.section_overview(query, book_ids)
+        if relevant_results is None:
+            relevant_results = self.search_book_content(
+                query, k=CONTEXT_CANDIDATES, book_ids=book_ids, query_embedding=question_embedding
+            )
+        prompt_start = time.perf_counter()
+        passages = pack_context(relevant_results)
+        metrics.observe("context_pack", time.perf_counter() - prompt_start)
         
-        has_question_word = any(word in question_lower.split() for word in question_words)
+        # Reuse the answer to a near-identical question over the same chunks. Not for a
+        # follow-up: "give an example of that" depends on what came before, so only its
+        # prompt carries the conversation and self-contained questions stay cacheable
+        response_cache = get_response_cache()
+        conversation = memory.context() if follow_up else ""
+        use_cache = use_cache and RESPONSE_CACHE_ENABLED and not follow_up
+        chunk_keys = [(passage['book_id'], chunk_id) for passage in passages for chunk_id in passage['chunk_ids']]
+        if use_cache:
+            cached_response = response_cache.lookup(question_embedding, chunk_keys)
+            metrics.incr("answer_cache", result="miss" if cached_response is None else "hit")
+            if cached_response is not None:
+                return cached_response, {'cached': True}
+        else:
+            response_cache.record_bypass()
+            metrics.incr("answer_cache", result="bypass")
         
-        # 6. Advanced heuristics
-        word_count = len(question_lower.split())
+        # Format book context with references
+        prompt_start = time.perf_counter()
+        book_context = ""
+        book_references = []
         
-        # Very short questions without context
-        if word_count < 4 and not has_question_word:
-            return True
+        if passages:
+            book_context = "=== RELEVANT CONTENT FROM THE BOOK ===\n\n"
+            for i, passage in enumerate(passages, 1):
+                page = format_pages(passage['pages'])
+                book_context += (
+                    f"**Reference {i}** (Book: {passage['book']}, Chapter/Section: {passage['chapter']}, Page: {page}):\n"
+                    f"{passage['content']}\n\n"
+                )
+                book_references.append({
+                    'book': passage['book'],
+                    'chapter': passage['chapter'],
+                    'page': page,
+                    'content_preview': passage['content'][:200] + "..." if len(passage['content']) > 200 else passage['content']
+                })
         
-        # Questions with reasonable length and structure
-        if word_count >= 5 and has_question_word:
-            # Check if it's a genuine question
-            if problem_solving_score >= 1 or '?' in question:
-                return False
+        # The persona and standing instructions are the model's system instruction
+        prompt = f"{conversation}{book_context}User Question: {question}"
+        metrics.incr("context_tokens", estimate_tokens(prompt))
         
-        # Random statements or very short queries
-        if word_count < 6 and '?' not in question and not has_question_word:
-            return True
+        metrics.observe("prompt_build", time.perf_counter() - prompt_start)
         
-        # If unclear, err on the side of being helpful
-        return False
+        return None, {
+            'question': question,
+            'prompt': prompt,
+            'book_references': book_references,
+            'question_embedding': question_embedding,
+            'chunk_keys': chunk_keys,
+            'use_cache': use_cache,
+        }
+
+    def _reference_footer(self, book_references):
+        """Book references appended after the model's answer"""
+        if not book_references:
+            return ""
+        footer = "\n\n" + "="*50 + "\n"
+        footer += "📚 **References from the Book:**\n"
+        for ref in book_references:
+            footer += f"• {ref['book']}: {ref['chapter']} (Page {ref['page']})\n"
+        return footer
     
-    def search_book_content(self, query, k=5):
-        """Enhanced search for relevant content in the book"""
-        if not self.vectorstore:
-            return []
-        
-        try:
-            # Perform similarity search with more results
-            docs = self.vectorstore.similarity_search(query, k=k)
-            
-            # Format results with metadata
-            results = []
-            for doc in docs:
-                result = {
-                    'content': doc.page_content,
-                    'page': doc.metadata.get('page', 'Unknown'),
-                    'chapter': doc.metadata.get('chapter', 'Unknown Section'),
-                    'score': 0  # Placeholder for similarity score
-                }
-                results.append(result)
-            
-            return results
-        except Exception as e:
-            st.error(f"Error searching book content: {str(e)}")
-            return []
+    def _finish_answer(self, context, answer_text):
+        # Add book references to the response if available
+        final_response = answer_text + self._reference_footer(context['book_references'])
+        if context['use_cache']:
+            get_response_cache().store(
+                context['question'], context['question_embedding'], context['chunk_keys'], final_response
+            )
+        return final_response
+    
+    def _record_latency(self, start, first_token_at, cached):
+        """Time-to-first-token and total latency of an answer, also kept with the last answers'"""
+        end = time.perf_counter()
+        latency = {
+            'first_token_s': (first_token_at or end) - start,
+            'total_s': end - start,
+            'cached': cached,
+        }
+        self.response_timings.append(latency)
+        return latency
+    
+    def answer_question(self, question, api_key, book_ids=None, use_cache=True, memory=None):
+        """Answer a question without streaming; returns a complete ``Answer``"""
+        start = time.perf_counter()
+        engine = get_answer_engine()
+        result = engine.run(engine.answer(self, question, api_key, book_ids, use_cache, memory))
+        answer = Answer()
+        answer.response, answer.cached, answer.trace = result['response'], result['cached'], result['trace']
+        answer.latency = self._record_latency(start, None, answer.cached)
+        self.request_traces.append(answer.trace)
+        return answer
     
-    def generate_response(self, question, api_key):
+    def generate_response(self, question, api_key, book_ids=None, use_cache=True, memory=None):
         """Generate response using Gemini API with enhanced book integration"""
-        try:
-            # Check if question is silly or irrelevant
-            if self.is_silly_or_irrelevant_question(question):
-                # More varied "Abay Sallay" responses
-                silly_responses = [
-                    "Abay Sallay! Don't waste my time with such bakwas. Ask me something related to problem solving yaar!",
-                    "Abay Sallay! Ye kya timepass hai? I'm here to help with problem solving, not for chit-chat. Be serious!",
-                    "Abay Sallay! Stop this nonsense and ask me something meaningful about problem solving techniques, samjha?",
-                    "Abay Sallay! Mera time waste mat karo with such silly questions. Focus on real problems that need solving!",
-                    "Abay Sallay! This is not the place for mazak. Ask me about problem-solving strategies and approaches!",
-                    "Abay Sallay! Kya ye sawal hai? I'm a problem-solving expert, not your entertainment buddy. Ask something useful!",
-                    "Abay Sallay! Tumhara dimagh kahan hai? Ask questions about problem solving, conflict resolution, ya decision making!",
-                    "Abay Sallay! Ye koi game nahi hai. I'm here to share problem-solving wisdom, not for bakwas. Be focused!",
-                    "Abay Sallay! Bilkul time waste kar rahe ho. Ask me about analytical thinking, planning, ya strategic approaches!",
-                    "Abay Sallay! Pagal ho gaye ho kya? This is a problem-solving platform. Ask something related to challenges and solutions!"
-                ]
+        return self.answer_question(question, api_key, book_ids, use_cache, memory).response
+    
+    def generate_responses(self, questions, api_key, book_ids=None, use_cache=True):
+        """Answer many questions concurrently (e.g. to generate an FAQ); answers keep the input order"""
+        engine = get_answer_engine()
+        results = engine.run(engine.answer_many(self, questions, api_key, book_ids, use_cache))
+        return [result['response'] for result in results]
+    
+    def stream_response(self, question, api_key, book_ids=None, use_cache=True, memory=None):
+        """An ``Answer`` that yields the text as Gemini produces it, then the book reference footer.
+        
+        The complete response (as stored in the answer cache) and the rest of the
+        answer's state are set on it once it is exhausted. Nothing is kept on the
+        chatbot, which concurrent API requests share.
+        """
+        answer = Answer()
+        answer._pieces = self._stream_answer(answer, question, api_key, book_ids, use_cache, memory)
+        return answer
+    
+    def _stream_answer(self, answer, question, api_key, book_ids, use_cache, memory):
+        start = time.perf_counter()
+        first_token_at = None
+        metrics = get_metrics()
+        with metrics.request("answer", mode="stream") as trace:
+            try:
+                ready_response, context = self._prepare_answer(question, book_ids, use_cache, memory)
+                if ready_response is not None:
+                    answer.cached = context['cached']
+                    first_token_at = time.perf_counter()
+                    answer.response = ready_response
+                    yield ready_response
+                    return
                 
-                import random
-                return random.choice(silly_responses)
-            
-            # Configure Gemini
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            
-            # Search for relevant content in the book
-            relevant_results = self.search_book_content(question, k=3)
-            
-            # Format book context with references
-            book_context = ""
-            book_references = []
-            
-            if relevant_results:
-                book_context = "=== RELEVANT CONTENT FROM THE BOOK ===\n\n"
-                for i, result in enumerate(relevant_results, 1):
-                    chapter_info = f"Chapter/Section: {result['chapter']}"
-                    page_info = f"Page: {result['page']}"
-                    
-                    book_context += f"**Reference {i}** ({chapter_info}, {page_info}):\n"
-                    book_context += f"{result['content']}\n\n"
-                    
-                    book_references.append({
-                        'chapter': result['chapter'],
-                        'page': result['page'],
-                        'content_preview': result['content'][:200] + "..." if len(result['content']) > 200 else result['content']
-                    })
-            
-            # Create enhanced prompt
-            prompt = f"""
-            You are Ashok, a problem-solving expert with a distinctive Pakistani/Indian style. Your characteristics:
-            
-            1. **Language Style**: Mix English with Urdu words naturally - use words like "yaar", "acha", "bilkul", "samjha", "bas", "abhi", "phir", "waise", "matlab", "dekho", "suno"
-            
-            2. **Personality**: 
-               - Enthusiastic and encouraging about good questions
-               - Practical and no-nonsense approach
-               - Supportive but direct
-               - Uses local expressions and cultural references
-            
-            3. **Response Pattern**:
-               - Start with appreciation: "Excellent question yaar!" or "Bahut acha sawal!" or "Bilkul sahi poocha!"
-               - Provide detailed, actionable advice
-               - Use examples and analogies
-               - ALWAYS reference the book content when available
-               - End with encouragement or next steps
-            
-            4. **Book Integration Rules**:
-               - ALWAYS use the book content provided below when it's relevant
-               - Reference specific chapters/sections and pages
-               - Quote or paraphrase from the book
-               - Acknowledge the book as the source: "According to the book..." or "As mentioned in Chapter X..."
-               - Don't just use book content - explain and expand on it
-            
-            5. **Urdu-English Integration**: 
-               - Use them naturally in context
-               - Examples: "Dekho yaar, the book says...", "Bilkul theek approach hai ye", "Samjha na?"
-            
-            {book_context}
-            
-            User Question: {question}
-            
-            Instructions:
-            - If book content is provided above, YOU MUST reference it in your response
-            - Mention specific chapters, pages, or sections when citing the book
-            - Expand on the book's content with your own insights
-            - Provide practical, actionable advice
-            - Use your characteristic English-Urdu mixed style
-            - Be comprehensive but conversational
-            """
-            
-            response = model.generate_content(prompt)
-            
-            # Add book references to the response if available
-            final_response = response.text
-            
-            if book_references:
-                final_response += "\n\n" + "="*50 + "\n"
-                final_response += "📚 **References from the Book:**\n"
-                for ref in book_references:
-                    final_response += f"• {ref['chapter']} (Page {ref['page']})\n"
-            
-            return final_response
-            
+                parts = []
+                gemini_start = time.perf_counter()
+                for chunk in get_answer_engine().stream(api_key, context['prompt'], on_complete=record_gemini_usage):
+                    text = _chunk_text(chunk)
+                    if not text:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        metrics.observe("gemini.first_token", first_token_at - gemini_start)
+                    parts.append(text)
+                    yield text
+                metrics.observe("gemini", time.perf_counter() - gemini_start)
+                
+                answer.response = self._finish_answer(context, "".join(parts))
+                footer = self._reference_footer(context['book_references'])
+                if footer:
+                    yield footer
+                
+            except Exception as e:
+                metrics.incr("errors", where="answer")
+                error_message = f"Sorry yaar, I encountered an error: {str(e)}. Please try again!"
+                answer.response += error_message
+                yield error_message
+            finally:
+                answer.latency = self._record_latency(start, first_token_at, answer.cached)
+                trace["cached"] = answer.cached
+                answer.trace = trace
+                self.request_traces.append(trace)
+
+
+class IngestionJob:
+    """One book queued for, or being ingested by, an ``IngestionJobQueue``"""
+
+    QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+    META_FILE = "job.json"
+    PDF_FILE = "book.pdf"
+
+    def __init__(self, key, book_id, title, content_hash, directory):
+        self.key = key  # Index cache key: the book is there once the job is done
+        self.book_id = book_id
+        self.title = title
+        self.content_hash = content_hash
+        self.directory = directory  # The PDF, job metadata and checkpoint
+        self.status = self.QUEUED
+        self.pipeline = None  # While running
+        self.stats = None  # Pipeline stats, once done
+        self.error = None
+        self.owners = weakref.WeakSet()  # Sessions waiting for the book
+        self.cancelled = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def progress(self):
+        """``(pages_done, pages_total, chunks_indexed)``; the total is None until extraction starts"""
+        pipeline = self.pipeline
+        if pipeline is None:
+            return 0, None, 0
+        return pipeline.pages_done, pipeline.pages_total, pipeline.chunks_indexed
+
+
+class IngestionJobQueue:
+    """Background ingestion of uploaded books on a small process-wide worker pool.
+
+    Jobs are keyed by index cache key, so uploading a book that is already queued
+    (from another session, or again after a browser refresh) joins the existing job.
+    At most ``workers`` books are ingested at once and the rest wait in submission
+    order. Each job keeps its PDF and an ``IngestionCheckpoint`` under ``jobs_dir``
+    until the book is in the index cache, and unfinished jobs found there when the
+    queue starts are resumed, so a crash loses at most a checkpoint's worth of
+    pages. Sessions load finished books from the index cache.
+    """
+
+    def __init__(self, index_cache, workers=INGESTION_WORKERS, jobs_dir=INGESTION_JOBS_DIR,
+                 checkpoint_pages=INGESTION_CHECKPOINT_PAGES):
+        self.index_cache = index_cache
+        self.jobs_dir = jobs_dir
+        self.checkpoint_pages = checkpoint_pages
+        self._lock = threading.Lock()
+        self._jobs = {}  # key -> job, in submission order, until every waiting session has the book
+        self._queue = queue.Queue()
+        self._resume_unfinished()
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._run, name=f"ingestion-job-{i}", daemon=True).start()
+
+    def _resume_unfinished(self):
+        try:
+            keys = sorted(os.listdir(self.jobs_dir))
+        except OSError:
+            return
+        for key in keys:
+            directory = os.path.join(self.jobs_dir, key)
+            try:
+                with open(os.path.join(directory, IngestionJob.META_FILE), encoding="utf-8") as f:
+                    meta = json.load(f)
+                job = IngestionJob(key, meta["book_id"], meta["title"], meta["content_hash"], directory)
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(directory, ignore_errors=True)  # Left by a submit that did not complete
+                continue
+            if self.index_cache.contains(key):
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            self._jobs[key] = job
+            self._queue.put(job)
+            get_metrics().incr("ingestion_jobs", event="resumed")
+
+    def submit(self, key, book_id, title, pdf_bytes, content_hash, owner=None):
+        """Queue a book for ingestion, or join the job already ingesting it"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.status in (IngestionJob.FAILED, IngestionJob.CANCELLED):
+                job = IngestionJob(key, book_id, title, content_hash, os.path.join(self.jobs_dir, key))
+                os.makedirs(job.directory, exist_ok=True)
+                with open(os.path.join(job.directory, IngestionJob.PDF_FILE), "wb") as f:
+                    f.write(pdf_bytes)
+                with open(os.path.join(job.directory, IngestionJob.META_FILE), "w", encoding="utf-8") as f:
+                    json.dump({"book_id": book_id, "title": title, "content_hash": content_hash}, f)
+                self._jobs[key] = job
+                self._queue.put(job)
+                get_metrics().incr("ingestion_jobs", event="submitted")
+            if owner is not None:
+                job.owners.add(owner)
+            return job
+
+    def release(self, key, owner):
+        """``owner`` no longer wants the book; a job nobody waits for any more is cancelled"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.owners.discard(owner)
+            if not job.owners and not job.finished:
+                job.cancelled.set()
+
+    def collect(self, job, owner):
+        """``owner`` has taken the finished job's result; the job is forgotten once all have"""
+        with self._lock:
+            job.owners.discard(owner)
+            if not job.owners and self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def jobs(self):
+        """Jobs in submission order; finished ones that nobody waits for are dropped"""
+        with self._lock:
+            for key in [key for key, job in self._jobs.items() if job.finished and not job.owners]:
+                del self._jobs[key]
+            return list(self._jobs.values())
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._ingest(job)
+            finally:
+                self._queue.task_done()
+
+    def _ingest(self, job):
+        metrics = get_metrics()
+        if job.cancelled.is_set():
+            job.status = IngestionJob.CANCELLED
+            shutil.rmtree(job.directory, ignore_errors=True)
+            metrics.incr("ingestion_jobs", event="cancelled")
+            return
+        job.status = IngestionJob.RUNNING
+        checkpoint = IngestionCheckpoint(job.directory, every_pages=self.checkpoint_pages)
+        try:
+            with open(os.path.join(job.directory, IngestionJob.PDF_FILE), "rb") as f:
+                pdf_bytes = f.read()
+            chatbot = AshokChatbot()  # A private library; sessions load the book from the index cache
+            job.pipeline = chatbot.start_ingestion(
+                lambda progress: iter_pdf_pages(pdf_bytes, progress=progress, first_page=checkpoint.last_page + 1),
+                job.book_id, job.title, job.key, outline=lambda: pdf_outline(pdf_bytes), checkpoint=checkpoint,
+            )
+            while not job.pipeline.wait(0.5):
+                if job.cancelled.is_set():
+                    job.pipeline.cancel()
+            if job.cancelled.is_set():
+                job.status = IngestionJob.CANCELLED
+                shutil.rmtree(job.directory, ignore_errors=True)
+                metrics.incr("ingestion_jobs", event="cancelled")
+                return
+            if job.pipeline.error is not None:
+                raise job.pipeline.error
+            book = chatbot.books.get(job.book_id)
+            if book is None or not book["chunks"]:
+                raise ValueError("No extractable text found in the PDF")
+            self.index_cache.save(
+                job.key, book["index"], book["chunks"], book["pages"], book["sections"], content_hash=job.content_hash
+            )
+            job.stats = job.pipeline.stats()
+            job.status = IngestionJob.DONE
+            shutil.rmtree(job.directory, ignore_errors=True)
+            metrics.incr("ingestion_jobs", event="done")
         except Exception as e:
-            return f"Sorry yaar, I encountered an error: {str(e)}. Please try again!"
+            job.error = e
+            job.status = IngestionJob.FAILED
+            shutil.rmtree(job.directory, ignore_errors=True)  # The PDF copy and checkpoint
+            metrics.incr("ingestion_jobs", event="failed")
+        finally:
+            job.pipeline = None  # Let go of the private library
+
+
+@st.cache_resource
+def get_ingestion_jobs():
+    """One ingestion worker pool per process; jobs left unfinished by the last run resume"""
+    return IngestionJobQueue(get_index_cache())
+
+
+@st.fragment(run_every=1.0)
+def show_ingestion_progress():
+    """Poll ingestion jobs without rerunning the whole app, and add the books they build.
+
+    A running job's book is searchable from its first indexed batch: the session shares
+    the job's growing book, and replaces it with the cached copy once the job is done.
+    """
+    ingestions = st.session_state.ingestions
+    chatbot = st.session_state.chatbot
+    registry = get_vectorstore_registry()
+    jobs = get_ingestion_jobs()
+    rerun = False
+    
+    queued = 0
+    for job in jobs.jobs():
+        if job.finished:
+            continue
+        mine = job.book_id in ingestions and ingestions[job.book_id] is job
+        label = job.title if mine else f"{job.title} (background)"
+        pages_done, pages_total, chunks_indexed = job.progress()
+        if job.status == IngestionJob.QUEUED:
+            queued += 1
+            st.caption(f"⏳ {label}: queued ({queued - 1} ahead)" if queued > 1 else f"⏳ {label}: queued")
+        elif pages_total:
+            st.progress(
+                pages_done / pages_total,
+                text=f"{label}: page {pages_done}/{pages_total} · {chunks_indexed} chunks indexed"
+            )
+        else:
+            st.progress(0.0, text=f"{label}: processing PDF... (This will only happen once)")
+    
+    for book_id, job in list(ingestions.items()):
+        if not job.finished:
+            pipeline = job.pipeline
+            book = pipeline.chatbot.books.get(book_id) if pipeline is not None else None
+            if book is not None and book["index"] is not None and book_id not in chatbot.books:
+                chatbot.attach_ingesting_book(book)
+                rerun = True  # So the library overview lists it
+            continue
+        rerun = True
+        del ingestions[book_id]
+        jobs.collect(job, chatbot)
+        chatbot.remove_book(registry, book_id)  # The job's partial book; a finished one is loaded in full
+        if job.status == IngestionJob.CANCELLED:
+            continue
+        if job.status == IngestionJob.DONE:
+            loaded = chatbot.attach_shared_book(registry, job.key, book_id, job.title)
+            if not loaded:
+                loaded, message = chatbot.load_from_cache(get_index_cache(), job.key, book_id, job.title)
+                if loaded:
+                    chatbot.share_book(registry, book_id)
+            if not loaded:
+                st.session_state.failed_uploads.add(book_id)
+                st.session_state.ingestion_results.append((False, f"{job.title}: {message}"))
+                continue
+            stats = job.stats
+            resumed = f", resumed after {stats['pages_resumed']} pages" if stats['pages_resumed'] else ""
+            st.session_state.ingestion_results.append((
+                True,
+                f"{job.title}: processed {stats['chunks']} chunks from {stats['pages']} pages "
+                f"in {stats['seconds']:.1f}s ({stats['embedding_cache_hit_ratio']:.0%} of embeddings cached{resumed})!"
+            ))
+        else:
+            st.session_state.failed_uploads.add(book_id)
+            st.session_state.ingestion_results.append(
+                (False, f"{job.title}: error processing book content: {str(job.error)}")
+            )
+    
+    if rerun:
+        st.rerun()
+
 
 def main():
+    # Page configuration
+    st.set_page_config(
+        page_title="Ashok 2.0 - Problem Solving Assistant",
+        page_icon="🧠",
+        layout="wide"
+    )
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
+    
+    # Process-wide metrics (and the /metrics endpoint, when configured) start with the first session
+    get_metrics()
+    
     # Initialize the chatbot and session state
     if 'chatbot' not in st.session_state:
         st.session_state.chatbot = AshokChatbot()
     
-    # Initialize chat history
+    # Initialize chat history, the bounded memory the answers use, and how much history is shown
     if 'messages' not in st.session_state:
         st.session_state.messages = []
+    if 'memory' not in st.session_state:
+        st.session_state.memory = ConversationMemory()
+    if 'history_shown' not in st.session_state:
+        st.session_state.history_shown = CHAT_HISTORY_PAGE
     
     # Initialize PDF processing state
     if 'book_processed' not in st.session_state:
         st.session_state.book_processed = False
     
-    # Initialize processed file key
-    if 'processed_file_key' not in st.session_state:
-        st.session_state.processed_file_key = None
+    # Initialize background ingestion state (ingestion jobs this session waits for, per book id)
+    if 'ingestions' not in st.session_state:
+        st.session_state.ingestions = {}
+    if 'ingestion_results' not in st.session_state:
+        st.session_state.ingestion_results = []
+    if 'failed_uploads' not in st.session_state:
+        st.session_state.failed_uploads = set()  # Book ids of uploads that failed; retried once re-uploaded
+    if 'uploader_version' not in st.session_state:
+        st.session_state.uploader_version = 0
     
     # Main title
     st.markdown('<h1 class="main-header">🧠 Ashok 2.0</h1>', unsafe_allow_html=True)
     st.markdown('<p class="sub-header">Your Problem Solving Assistant</p>', unsafe_allow_html=True)
     
+    chatbot = st.session_state.chatbot
+    search_book_ids = None
+    
     # Sidebar for configuration
     with st.sidebar:
         st.header("⚙️ Configuration")
@@ -494,48 +3839,91 @@ def main():
         )
         
         # PDF upload
-        st.header("📚 Upload Problem Solving Book")
-        uploaded_file = st.file_uploader(
-            "Choose a PDF file",
+        st.header("📚 Upload Problem Solving Books")
+        uploaded_files = st.file_uploader(
+            "Choose PDF files",
             type="pdf",
-            help="Upload your boss's problem-solving book"
+            accept_multiple_files=True,
+            key=f"uploader_{st.session_state.uploader_version}",
+            help="Upload your boss's problem-solving books; removing a file removes it from the library"
         )
         
-        if uploaded_file is not None:
-            # Create a unique key for the uploaded file
-            file_key = f"{uploaded_file.name}_{uploaded_file.size}"
+        index_cache = get_index_cache()
+        registry = get_vectorstore_registry()
+        jobs = get_ingestion_jobs()
+        uploaded_ids = set()
+        
+        for uploaded_file in uploaded_files or []:
+            # Key the upload by its content (and the indexing parameters) rather than name/size
+            content_hash = BookIndexCache.content_hash(uploaded_file.getvalue())
+            file_key = index_cache.make_key(content_hash)
+            book_id = book_id_for(content_hash)
+            title = os.path.splitext(uploaded_file.name)[0]
+            uploaded_ids.add(book_id)
             
-            # Check if this file has already been processed
-            if 'processed_file_key' not in st.session_state or st.session_state.processed_file_key != file_key:
-                with st.spinner("Processing PDF... (This will only happen once)"):
-                    result = st.session_state.chatbot.extract_text_from_pdf(uploaded_file)
-                    if result[0]:  # Check if extraction was successful
-                        text, page_texts = result
-                        success, message = st.session_state.chatbot.process_book_content(text, page_texts)
-                        if success:
-                            st.success(message)
-                            # Store the file key to prevent reprocessing
-                            st.session_state.processed_file_key = file_key
-                            st.session_state.book_processed = True
-                            
-                            # Show book statistics
-                            st.info(f"📊 Book Stats: {len(page_texts)} pages processed")
-                        else:
-                            st.error(message)
+            # Books already in the library (or still ingesting) are left alone, and a failed
+            # upload is not retried until its file is removed and uploaded again
+            if (book_id in chatbot.books or book_id in st.session_state.ingestions
+                    or book_id in st.session_state.failed_uploads):
+                continue
+            
+            cached, message = False, ""
+            if chatbot.attach_shared_book(registry, file_key, book_id, title):
+                # Another session already has this book in memory
+                cached, message = True, f"Using shared copy of this book ({len(chatbot.books[book_id]['chunks'])} chunks)"
+            elif index_cache.contains(file_key):
+                with st.spinner(f"Loading {title} from cache..."):
+                    cached, message = chatbot.load_from_cache(index_cache, file_key, book_id, title)
+                if cached:
+                    chatbot.share_book(registry, book_id)
+            
+            if cached:
+                st.success(f"⚡ {title}: {message}")
             else:
-                # File already processed, show confirmation
-                st.success("✅ PDF already processed and ready to use!")
-                st.session_state.book_processed = True
-                
-                # Show book info
-                if hasattr(st.session_state.chatbot, 'book_chunks') and st.session_state.chatbot.book_chunks:
-                    st.info(f"📖 {len(st.session_state.chatbot.book_chunks)} content chunks available")
+                # Extract, chunk, embed and index as a background job (or join the job
+                # already ingesting this book); chatting continues with the other books
+                st.session_state.ingestions[book_id] = jobs.submit(
+                    file_key, book_id, title, uploaded_file.getvalue(), content_hash, owner=chatbot
+                )
+        
+        # Books whose file was removed from the uploader leave the library; the rest are untouched
+        for book_id in list(chatbot.books):
+            if book_id not in uploaded_ids:
+                chatbot.remove_book(registry, book_id)
+        for book_id in [book_id for book_id in st.session_state.ingestions if book_id not in uploaded_ids]:
+            jobs.release(st.session_state.ingestions.pop(book_id).key, chatbot)
+        st.session_state.failed_uploads &= uploaded_ids
+        
+        st.session_state.book_processed = bool(chatbot.books)
+        
+        if st.session_state.ingestions or any(not job.finished for job in jobs.jobs()):
+            show_ingestion_progress()
+        
+        # Report the outcome of background ingestions that finished since the last rerun
+        for ok, message in st.session_state.ingestion_results:
+            if ok:
+                st.success(message)
+            else:
+                st.error(message)
+        st.session_state.ingestion_results = []
+        
+        # Library overview and search filter
+        if chatbot.books:
+            st.info(f"📖 {len(chatbot.books)} book(s), {chatbot.chunk_count} content chunks available")
+            book_titles = {book_id: book['title'] for book_id, book in chatbot.books.items()}
+            search_book_ids = st.multiselect(
+                "Search in books:",
+                options=list(book_titles),
+                default=list(book_titles),
+                format_func=lambda book_id: book_titles[book_id],
+                help="Limit answers to a subset of the library"
+            )
         
         # Instructions
         st.header("📝 Instructions")
         st.markdown("""
         1. Enter your Gemini API key
-        2. Upload the problem-solving PDF book
+        2. Upload one or more problem-solving PDF books
         3. Ask questions about problem solving
         4. Get responses with book references!
         
@@ -550,9 +3938,94 @@ def main():
         
         # Show processing status
         if st.session_state.book_processed:
-            st.success("📖 Book is loaded and ready!")
+            st.success("📖 Library is loaded and ready!")
         else:
             st.info("📖 Please upload a PDF book to get started.")
+        
+        stream_answers = st.toggle(
+            "Stream answers",
+            value=True,
+            help="Show the answer as it is generated instead of waiting for the full text"
+        )
+        memory_stats = st.session_state.memory.stats()
+        if memory_stats["turns"]:
+            st.caption(
+                f"💬 {memory_stats['turns']} turns: last {memory_stats['recent']} remembered in full, "
+                f"{memory_stats['summarized']} earlier in summary"
+            )
+        timings = list(st.session_state.chatbot.response_timings)
+        if timings:
+            st.caption(
+                f"⏱️ Last {len(timings)} answers: first token "
+                f"{sum(t['first_token_s'] for t in timings) / len(timings):.1f}s avg, total "
+                f"{sum(t['total_s'] for t in timings) / len(timings):.1f}s avg"
+            )
+        
+        # Semantic answer cache, shared across all sessions in this process
+        with st.expander("⚡ Answer Cache"):
+            use_answer_cache = st.checkbox(
+                "Reuse answers to similar questions",
+                value=RESPONSE_CACHE_ENABLED,
+                disabled=not RESPONSE_CACHE_ENABLED,
+                help="Turn off to always ask Gemini for a fresh answer"
+            )
+            cache_stats = get_response_cache().stats()
+            st.caption(
+                f"Hit rate: {cache_stats['hit_rate']:.0%} "
+                f"({cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['bypassed']} bypassed)"
+            )
+            st.caption(f"Entries: {cache_stats['entries']} (evicted {cache_stats['evictions']})")
+            if st.button("Clear answer cache"):
+                get_response_cache().clear()
+        
+        # Memory shared across all sessions in this process
+        with st.expander("💾 Memory Usage"):
+            usage = get_vectorstore_registry().memory_usage()
+            mb = 1024 * 1024
+            st.caption(f"Process RSS: {usage['rss_bytes'] / mb:.1f} MB")
+            st.caption(
+                f"Shared books: {len(usage['books'])} "
+                f"(vectors {usage['index_bytes'] / mb:.1f} MB, text {usage['text_bytes'] / mb:.1f} MB)"
+            )
+            for book in usage['books']:
+                st.caption(
+                    f"• {book['key'][:12]}: {book['chunks']} chunks, "
+                    f"{(book['index_bytes'] + book['text_bytes']) / mb:.1f} MB, "
+                    f"{book['sessions']} session(s)"
+                )
+            if st.session_state.chatbot.embeddings is not None:  # Never load the model just to show this
+                embeddings = st.session_state.chatbot.embeddings
+                st.caption(f"Embedding queue: {embeddings.pending()} pending")
+                if embeddings.cache is not None:
+                    embedding_stats = embeddings.cache.stats()
+                    st.caption(
+                        f"Embedding cache: {embedding_stats['disk_entries']} vectors on disk, "
+                        f"hit rate {embedding_stats['hit_rate']:.0%}"
+                    )
+        
+        # Per-request timing breakdowns for this session
+        with st.expander("🐞 Debug"):
+            show_traces = st.checkbox("Show request timings", value=False)
+            traces = list(st.session_state.chatbot.request_traces)
+            if show_traces and not traces:
+                st.caption("Ask a question to see where the time goes.")
+            if show_traces:
+                for trace in reversed(traces[-5:]):
+                    st.caption(
+                        f"{time.strftime('%H:%M:%S', time.localtime(trace['timestamp']))} · "
+                        f"{trace.get('mode', trace['event'])} · {trace.get('total_ms', 0):.0f} ms"
+                        f"{' · cached' if trace.get('cached') else ''}"
+                    )
+                    st.table([{"span": span["name"], "ms": span["ms"]} for span in trace["spans"]])
+                    if trace["counters"]:
+                        st.caption(", ".join(f"{name}: {value}" for name, value in trace["counters"].items()))
+            st.download_button(
+                "Download metrics",
+                get_metrics().prometheus_text(),
+                file_name="ashok_metrics.txt",
+                mime="text/plain",
+                help="All counters and timing histograms in Prometheus text format"
+            )
     
     # Main chat interface
     if api_key:
@@ -562,8 +4035,13 @@ def main():
             st.error(message)
             return
         
-        # Display chat history
-        for message in st.session_state.messages:
+        # Display the latest page(s) of chat history, so reruns cost the same however long the chat is
+        messages = st.session_state.messages
+        hidden = len(messages) - st.session_state.history_shown
+        if hidden > 0 and st.button(f"⬆️ Show earlier messages ({hidden} hidden)"):
+            st.session_state.history_shown += CHAT_HISTORY_PAGE
+            st.rerun()
+        for message in messages[max(0, hidden):]:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
         
@@ -575,24 +4053,51 @@ def main():
                 st.markdown(prompt)
             
             # Generate response
+            chatbot = st.session_state.chatbot
+            memory = st.session_state.memory
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    response = st.session_state.chatbot.generate_response(prompt, api_key)
-                    st.markdown(response)
-                    
-                    # Add assistant response to chat history
-                    st.session_state.messages.append({"role": "assistant", "content": response})
+                if stream_answers:
+                    # Show tokens as Gemini produces them; the reference footer follows the stream
+                    answer = chatbot.stream_response(
+                        prompt, api_key, book_ids=search_book_ids, use_cache=use_answer_cache, memory=memory
+                    )
+                    st.write_stream(answer)
+                else:
+                    with st.spinner("Thinking..."):
+                        answer = chatbot.answer_question(
+                            prompt, api_key, book_ids=search_book_ids, use_cache=use_answer_cache, memory=memory
+                        )
+                        st.markdown(answer.response)
+                response = answer.response
+                
+                latency = answer.latency
+                if answer.cached:
+                    st.caption("⚡ Answered from cache")
+                elif latency:
+                    st.caption(f"⏱️ First token {latency['first_token_s']:.1f}s · total {latency['total_s']:.1f}s")
+                
+                # Add assistant response to chat history and the conversation memory
+                st.session_state.messages.append({"role": "assistant", "content": response})
+                memory.add(prompt, response)
+                del st.session_state.messages[:-CHAT_HISTORY_MAX]
         
         # Clear chat button
         if st.button("🗑️ Clear Chat"):
             st.session_state.messages = []
+            st.session_state.memory.clear()
+            st.session_state.history_shown = CHAT_HISTORY_PAGE
             st.rerun()
         
-        # Reset PDF button (in case user wants to upload a new PDF)
-        if st.button("🔄 Reset PDF"):
+        # Reset library button (in case user wants to start over with new PDFs)
+        if st.button("🔄 Reset Library"):
             st.session_state.book_processed = False
-            st.session_state.processed_file_key = None
+            for job in st.session_state.ingestions.values():
+                get_ingestion_jobs().release(job.key, st.session_state.chatbot)
+            st.session_state.ingestions = {}
+            st.session_state.failed_uploads = set()
+            st.session_state.chatbot.release_books(get_vectorstore_registry())
             st.session_state.chatbot = AshokChatbot()  # Reset chatbot
+            st.session_state.uploader_version += 1  # Clear the file uploader too
             st.rerun()
     
     else:
@@ -606,4 +4111,6 @@ def main():
         """)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    # The first page is out: load what the first question will need
+    start_warm_up()
\ No newline at end of file
@@ -0,0 +1,891 @@
+"""Offline benchmarks for Ashok 2.0.
+
+Nothing here calls Gemini; only the local embedding model is used. Every
+benchmark prints a JSON report (or writes it with --output) so runs can be diffed.
+The startup benchmark, and retrieval with --rerank, exit with status 1 when a latency
+budget is exceeded.
+
+Usage:
+    python benchmark.py index book1.pdf [book2.pdf ...] [--k 10] [--queries 200]
+    python benchmark.py relevance [--corpus questions.jsonl] [--repeat 200]
+    python benchmark.py retrieval book.pdf [...] --questions labels.jsonl [--k 1 3 5 10] [--rerank]
+    python benchmark.py context book.pdf [...] [--questions labels.jsonl] [--budget 600]
+    python benchmark.py api book.pdf [--requests 200] [--concurrency 8] [--gemini-latency 0.5]
+    python benchmark.py startup [--repeat 5] [--max-import-ms 1000] [--max-render-ms 3000]
+    python benchmark.py memory book.pdf [...] [--reads 2000]
+    python benchmark.py embeddings book.pdf [...] [--backends torch onnx onnx-int8] [--storage float32 float16 int8]
+
+Retrieval labels are JSON lines such as
+    {"question": "What is the five whys technique?", "pages": [42, 43], "book": "book.pdf"}
+where "book" (the PDF file name) is optional when only one book is ingested.
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ashok2
+from pdf_extraction import iter_pdf_pages, pdf_outline
+
+
+def ingest_pdfs(paths, index_backend="flat"):
+    """Build a chatbot library from PDF files on disk, bypassing the index cache"""
+    ashok2.INDEX_BACKEND = index_backend
+    chatbot = ashok2.AshokChatbot()
+    for path in paths:
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        book_id = ashok2.book_id_for(ashok2.BookIndexCache.content_hash(pdf_bytes))
+        success, message = chatbot.process_book_content(
+            None, iter_pdf_pages(pdf_bytes), book_id, path, outline=pdf_outline(pdf_bytes)
+        )
+        if not success:
+            raise SystemExit(f"{path}: {message}")
+    return chatbot
+
+
+def ingest_pdfs_timed(paths, index_backend="flat"):
+    """Like ``ingest_pdfs`` but through the app's extract-then-process path, timing each phase"""
+    ashok2.INDEX_BACKEND = index_backend
+    chatbot = ashok2.AshokChatbot()
+    chatbot._get_embeddings()  # Model load is not ingestion time
+    timings = {"pages": 0, "chunks": 0, "extract_s": 0.0, "process_s": 0.0}
+    for path in paths:
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        book_id = ashok2.book_id_for(ashok2.BookIndexCache.content_hash(pdf_bytes))
+        start = time.perf_counter()
+        text, page_texts = chatbot.extract_text_from_pdf(io.BytesIO(pdf_bytes))
+        extracted = time.perf_counter()
+        success, message = chatbot.process_book_content(
+            text, page_texts, book_id, os.path.basename(path), outline=pdf_outline(pdf_bytes)
+        )
+        if not success:
+            raise SystemExit(f"{path}: {message}")
+        timings["extract_s"] += extracted - start
+        timings["process_s"] += time.perf_counter() - extracted
+        timings["pages"] += len(page_texts)
+        timings["chunks"] += len(chatbot.books[book_id]["chunks"])
+    return chatbot, timings
+
+
+def sample_queries(chunks, n, seed=0):
+    """Short word windows from random chunks, standing in for user questions"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        words = rng.choice(chunks).text.split()
+        start = rng.randrange(max(1, len(words) - 12))
+        queries.append(" ".join(words[start:start + 12]))
+    return queries
+
+
+def run_index(args):
+    chatbot = ingest_pdfs(args.pdfs)
+    vectors = np.concatenate([
+        book["index"].reconstruct_n(0, book["index"].ntotal)
+        for book in chatbot.books.values()
+    ])
+    queries = sample_queries(chatbot.book_chunks, args.queries)
+    query_vectors = np.array(chatbot._get_embeddings().embed_documents(queries), dtype="float32")
+    return {
+        "benchmark": "index",
+        "pdfs": args.pdfs,
+        "vectors": len(vectors),
+        "auto_backend": ashok2.choose_index_backend(len(vectors)),
+        "k": args.k,
+        "queries": len(queries),
+        "results": ashok2.index_recall_report(vectors, query_vectors, k=args.k),
+    }
+
+
+# (question, is_silly) pairs; covers the substring false hits the old classifier made
+RELEVANCE_CORPUS = [
+    ("How can I improve my decision-making process?", False),
+    ("What are the steps for effective conflict resolution?", False),
+    ("How do I prioritize tasks when everything seems urgent?", False),
+    ("What techniques can help me think more creatively?", False),
+    ("How should a manager handle a team that keeps missing deadlines?", False),
+    ("What is the best framework for analyzing a complex problem?", False),
+    ("How do I manage stakeholders with conflicting goals?", False),
+    ("Explain root cause analysis with an example", False),
+    ("Which approach works better for breaking down large projects?", False),
+    ("How can our team communicate decisions more clearly?", False),
+    ("What should I do when two options look equally good?", False),
+    ("How do I overcome procrastination on important work?", False),
+    ("Describe the five whys technique", False),
+    ("How can I get better at negotiation with suppliers?", False),
+    ("What does the book say about managing risk in projects?", False),
+    ("How do experienced leaders make decisions under uncertainty?", False),
+    ("Can you suggest ways to brainstorm solutions with my colleagues?", False),
+    ("What are common mistakes when solving problems in groups?", False),
+    ("How to deal with a bottleneck in our workflow?", False),
+    ("Why do some strategies fail during execution?", False),
+    ("How can I manage my time during a heavy workload?", False),
+    ("What is the average time it takes to build a new habit?", False),
+    ("How should I handle feedback from my manager?", False),
+    ("What are the stages of a good planning process?", False),
+    ("How do I evaluate whether a solution actually worked?", False),
+    ("hello", True),
+    ("hi there", True),
+    ("Hey, how are you?", True),
+    ("What is your name?", True),
+    ("Who are you", True),
+    ("good morning ashok", True),
+    ("kya hal hai", True),
+    ("What is your favorite movie?", True),
+    ("What is the weather like today?", True),
+    ("Tell me a joke", True),
+    ("Who will win the cricket match?", True),
+    ("Do you have a girlfriend?", True),
+    ("How old are you?", True),
+    ("Is there life on aliens planets?", True),
+    ("Which political party should I vote for?", True),
+    ("you are stupid", True),
+    ("lol", True),
+    ("ok", True),
+    ("banana", True),
+    ("asdf qwer", True),
+    ("Recommend a good song for tonight", True),
+    ("What is your opinion about the president?", True),
+    ("Is instagram better than tiktok?", True),
+    ("Shell scripts keep failing in our deployment process, how do we fix them?", False),
+    ("How can I encourage my team to share ideas in meetings?", False),
+]
+
+
+def legacy_is_silly_or_irrelevant(question):
+    """The substring-scanning classifier the compiled matcher replaced, for comparison"""
+    question_lower = question.lower().strip()
+    if len(question_lower) < 3:
+        return True
+    for pattern in ashok2.GREETING_PATTERNS:
+        if re.search(pattern, question_lower):
+            return True
+    if any(keyword in question_lower for keyword in ashok2.ABUSIVE_KEYWORDS):
+        return True
+    problem_solving_score = sum(1 for keyword in ashok2.PROBLEM_SOLVING_KEYWORDS if keyword in question_lower)
+    if problem_solving_score >= 2:
+        return False
+    if sum(1 for keyword in ashok2.SILLY_KEYWORDS if keyword in question_lower) >= 1:
+        return True
+    has_question_word = any(word in question_lower.split() for word in ashok2.QUESTION_WORDS)
+    word_count = len(question_lower.split())
+    if word_count < 4 and not has_question_word:
+        return True
+    if word_count >= 5 and has_question_word:
+        if problem_solving_score >= 1 or '?' in question:
+            return False
+    if word_count < 6 and '?' not in question and not has_question_word:
+        return True
+    return False
+
+
+def load_relevance_corpus(path):
+    """JSON lines of {"question": ..., "silly": true|false}"""
+    with open(path, encoding="utf-8") as f:
+        return [(row["question"], bool(row["silly"])) for row in map(json.loads, f) if row]
+
+
+def run_relevance(args):
+    corpus = load_relevance_corpus(args.corpus) if args.corpus else RELEVANCE_CORPUS
+    results = {}
+    for name, classify in (("legacy", legacy_is_silly_or_irrelevant), ("compiled", ashok2.is_silly_or_irrelevant)):
+        predictions = [classify(question) for question, _ in corpus]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for question, _ in corpus:
+                classify(question)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "accuracy": sum(p == label for p, (_, label) in zip(predictions, corpus)) / len(corpus),
+            "questions_per_second": args.repeat * len(corpus) / elapsed,
+            "mean_us": elapsed / (args.repeat * len(corpus)) * 1e6,
+            "errors": [question for p, (question, label) in zip(predictions, corpus) if p != label],
+        }
+    return {
+        "benchmark": "relevance",
+        "questions": len(corpus),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def load_retrieval_labels(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles_ms(samples):
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "mean_ms": float(np.mean(samples)) * 1000}
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_retrieval(args):
+    if args.chunk_size:
+        ashok2.CHUNK_SIZE = args.chunk_size
+    if args.chunk_overlap is not None:
+        ashok2.CHUNK_OVERLAP = args.chunk_overlap
+    # Cached vectors would make ingestion look faster on every run after the first
+    ashok2.EMBEDDING_CACHE_ENABLED = args.embedding_cache
+    labels = load_retrieval_labels(args.questions)
+    chatbot, timings = ingest_pdfs_timed(args.pdfs, index_backend=args.index_backend)
+    embeddings = chatbot._get_embeddings()
+
+    # Embedding throughput on its own, separate from chunking and indexing
+    sample = [chunk.text for chunk in chatbot.book_chunks[:args.embed_sample]]
+    start = time.perf_counter()
+    embeddings.embed_documents(sample, use_cache=False)
+    embed_s = time.perf_counter() - start
+
+    quality, latencies = search_quality(chatbot, labels, args, rerank=False)
+    report = {
+        "benchmark": "retrieval",
+        "pdfs": args.pdfs,
+        "config": {
+            "embedding_model": ashok2.EMBEDDING_MODEL_NAME,
+            "chunk_size": ashok2.CHUNK_SIZE,
+            "chunk_overlap": ashok2.CHUNK_OVERLAP,
+            "index_backend": args.index_backend,
+            "hybrid": args.hybrid,
+            "embedding_cache": args.embedding_cache,
+        },
+        "questions": len(labels),
+        **quality,
+        "ingestion": {
+            "pages": timings["pages"],
+            "chunks": timings["chunks"],
+            "extract_pages_per_second": timings["pages"] / timings["extract_s"] if timings["extract_s"] else 0.0,
+            "process_chunks_per_second": timings["chunks"] / timings["process_s"] if timings["process_s"] else 0.0,
+            "embed_chunks_per_second": len(sample) / embed_s if embed_s else 0.0,
+        },
+        "query_latency": percentiles_ms(latencies),
+    }
+
+    if args.rerank:
+        ashok2.get_reranker().score("warm up", [(None, None, "warm up")])  # Load the model outside the timings
+        reranked, reranked_latencies = search_quality(chatbot, labels, args, rerank=True)
+        reranked["query_latency"] = percentiles_ms(reranked_latencies)
+        added_p95_ms = reranked["query_latency"]["p95_ms"] - report["query_latency"]["p95_ms"]
+        report["rerank"] = {
+            "model": ashok2.RERANK_MODEL_NAME,
+            "candidates": ashok2.RERANK_CANDIDATES,
+            "margin": ashok2.RERANK_MARGIN,
+            **reranked,
+            "added_p95_ms": added_p95_ms,
+            "budget_p95_ms": ashok2.RERANK_LATENCY_BUDGET_MS,
+        }
+        if added_p95_ms > ashok2.RERANK_LATENCY_BUDGET_MS:
+            report["regressions"] = [
+                f"reranking adds {added_p95_ms:.0f} ms at p95, over the {ashok2.RERANK_LATENCY_BUDGET_MS:.0f} ms budget"
+            ]
+
+    report["peak_rss_bytes"] = peak_rss_bytes()
+    return report
+
+
+def search_quality(chatbot, labels, args, rerank):
+    """Recall@k and MRR of the labelled questions, and the search latencies of ``args.repeat`` passes"""
+    max_k = max(args.k)
+    latencies = []
+    for _ in range(args.repeat):
+        if rerank:
+            ashok2.get_reranker().clear()  # Every pass scores its candidates, as new questions would
+        for label in labels:
+            start = time.perf_counter()
+            chatbot.search_book_content(label["question"], k=max_k, hybrid=args.hybrid, rerank=rerank)
+            latencies.append(time.perf_counter() - start)
+
+    hits_at = {k: 0 for k in args.k}
+    reciprocal_ranks = []
+    skipped = 0
+    for label in labels:
+        relevant_pages = set(label["pages"])
+        results = chatbot.search_book_content(label["question"], k=max_k, hybrid=args.hybrid, rerank=rerank)
+        skipped += all(result["rerank"] is None for result in results)
+        rank = next(
+            (
+                i for i, result in enumerate(results, 1)
+                if result["page"] in relevant_pages and label.get("book") in (None, result["book"])
+            ),
+            None,
+        )
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        for k in args.k:
+            hits_at[k] += rank is not None and rank <= k
+
+    quality = {
+        "recall_at_k": {str(k): hits_at[k] / len(labels) for k in args.k},
+        "mrr": float(np.mean(reciprocal_ranks)),
+    }
+    if rerank:
+        quality["early_exit_rate"] = skipped / len(labels)
+    return quality, latencies
+
+
+def legacy_context(results):
+    """The top-3 chunks pasted verbatim, as prompts were built before context packing"""
+    return "".join(
+        f"**Reference {i}** (Book: {r['book']}, Chapter/Section: {r['chapter']}, Page: {r['page']}):\n{r['content']}\n\n"
+        for i, r in enumerate(results[:3], 1)
+    )
+
+
+def run_context(args):
+    chatbot = ingest_pdfs(args.pdfs)
+    if args.questions:
+        questions = [label["question"] for label in load_retrieval_labels(args.questions)]
+    else:
+        questions = sample_queries(chatbot.book_chunks, args.queries)
+    # Before packing, every prompt also carried the persona, indented inside the f-string
+    persona_tokens = ashok2.estimate_tokens(ashok2.ASHOK_PERSONA)
+    legacy_persona_tokens = ashok2.estimate_tokens(
+        "\n".join("        " + line for line in ashok2.ASHOK_PERSONA.splitlines())
+    )
+    legacy, packed, merged, pack_times = [], [], 0, []
+    for question in questions:
+        results = chatbot.search_book_content(question, k=ashok2.CONTEXT_CANDIDATES)
+        legacy.append(legacy_persona_tokens + ashok2.estimate_tokens(legacy_context(results) + question))
+        start = time.perf_counter()
+        passages = ashok2.pack_context(results, token_budget=args.budget)
+        pack_times.append(time.perf_counter() - start)
+        merged += sum(len(p["chunk_ids"]) > 1 for p in passages)
+        packed.append(persona_tokens + ashok2.estimate_tokens("".join(p["content"] for p in passages) + question))
+    return {
+        "benchmark": "context",
+        "pdfs": args.pdfs,
+        "questions": len(questions),
+        "token_budget": args.budget,
+        "system_instruction_tokens": persona_tokens,
+        "legacy_prompt_tokens_mean": float(np.mean(legacy)),
+        "packed_prompt_tokens_mean": float(np.mean(packed)),
+        "token_reduction": 1 - float(np.mean(packed)) / float(np.mean(legacy)),
+        "merged_passages": merged,
+        "pack_latency": percentiles_ms(pack_times),
+    }
+
+
+def legacy_book(pdf_bytes, book_id):
+    """A book's text as it was held before ChunkStore: page dicts, the joined text,
+    one Document per chunk, and the Documents again in the FAISS docstore"""
+    from langchain.schema import Document
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    chatbot = ashok2.AshokChatbot()
+    text_splitter = chatbot._make_text_splitter()
+    page_texts = list(iter_pdf_pages(pdf_bytes, max_workers=1))
+    chunks = []
+    for page_info in page_texts:
+        chapter = chatbot._extract_chapter_title(page_info["text"].split("\n"))
+        doc = Document(page_content=page_info["text"], metadata={
+            "source": book_id, "page": page_info["page"], "chapter": chapter, "word_count": page_info["word_count"],
+        })
+        for chunk in text_splitter.split_documents([doc]):
+            chunk.metadata["chunk_id"] = len(chunks)
+            chunk.metadata["chunk_length"] = len(chunk.page_content)
+            chunks.append(chunk)
+    return {
+        "page_texts": page_texts,
+        "book_content": ashok2.join_page_texts(page_texts),
+        "chunks": chunks,
+        "docstore": InMemoryDocstore({
+            str(i): Document(page_content=chunk.page_content, metadata=chunk.metadata) for i, chunk in enumerate(chunks)
+        }),
+        "index_to_docstore_id": {i: str(i) for i in range(len(chunks))},
+    }
+
+
+def compact_book(pdf_bytes):
+    """A book's text as ingestion now holds it: a ChunkStore and the page numbers"""
+    chatbot = ashok2.AshokChatbot()
+    text_splitter = chatbot._make_text_splitter()
+    chunks, pages = ashok2.ChunkStore(), []
+    for page_info in iter_pdf_pages(pdf_bytes, max_workers=1):
+        pages.append(page_info["page"])
+        chunks.add(chatbot._chunk_page(page_info, text_splitter, len(chunks)))
+    chunks.compact()
+    return {"chunks": chunks, "pages": pages}
+
+
+def retained_bytes(build):
+    """Run ``build()``; returns its result and the heap bytes (numpy buffers included) still held"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def read_us(read, positions):
+    """Mean microseconds to materialize one chunk's text"""
+    start = time.perf_counter()
+    for position in positions:
+        read(position)
+    return (time.perf_counter() - start) / len(positions) * 1e6
+
+
+def run_memory(args):
+    rng = random.Random(0)
+    books = []
+    for path in args.pdfs:
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        # Built once untraced first, so imports and one-off caches are not counted as the book's memory
+        legacy_book(pdf_bytes, path), compact_book(pdf_bytes)
+        legacy, legacy_bytes = retained_bytes(lambda: legacy_book(pdf_bytes, path))
+        compact, compact_bytes = retained_bytes(lambda: compact_book(pdf_bytes))
+        store = compact["chunks"]
+        with tempfile.TemporaryDirectory() as directory:
+            store.save(directory)
+            file_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            mapped, mapped_bytes = retained_bytes(lambda: ashok2.ChunkStore.load(directory))
+            positions = [rng.randrange(len(store)) for _ in range(args.reads)]
+            reads = {
+                "legacy": read_us(lambda i: legacy["chunks"][i].page_content, positions),
+                "compact": read_us(lambda i: store[i].text, positions),
+                "mmap": read_us(lambda i, mapped=mapped: mapped[i].text, positions),
+            }
+            del mapped  # Unmap before the directory is removed
+        books.append({
+            "pdf": path,
+            "pages": len(compact["pages"]),
+            "chunks": len(store),
+            "chapters": len(store.chapters),
+            "legacy_bytes": legacy_bytes,
+            "compact_bytes": compact_bytes,
+            "mmap_heap_bytes": mapped_bytes,
+            "mmap_file_bytes": file_bytes,
+            "reduction_factor": legacy_bytes / compact_bytes if compact_bytes else None,
+            "read_us": reads,
+        })
+    return {
+        "benchmark": "memory",
+        "note": "Python heap bytes held per book for chunk text and metadata; the FAISS and BM25 indexes are the same in both layouts",
+        "books": books,
+    }
+
+
+def embed_chunks_timed(embeddings, texts, batch_size=ashok2.EMBED_BATCH_SIZE):
+    """Embed ``texts`` in ingestion-sized batches; returns the vectors and the seconds taken"""
+    vectors = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(texts), batch_size):
+        vectors.extend(embeddings.embed_documents(texts[batch_start:batch_start + batch_size]))
+    return np.array(vectors, dtype="float32"), time.perf_counter() - start
+
+
+def query_latencies(embeddings, queries, concurrency):
+    """Per-query embedding latency with ``concurrency`` sessions asking at once"""
+    def timed(query):
+        start = time.perf_counter()
+        embeddings.embed_query(query)
+        return time.perf_counter() - start
+
+    batches, embedded = embeddings.query_batches, embeddings.queries_embedded
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed, queries))
+    elapsed = time.perf_counter() - start
+    batches = embeddings.query_batches - batches
+    return {
+        **percentiles_ms(latencies),
+        "queries_per_second": len(queries) / elapsed,
+        "mean_batch_size": (embeddings.queries_embedded - embedded) / batches if batches else 0.0,
+    }
+
+
+def neighbour_recall(found, truth):
+    """Fraction of the reference top-k neighbours that were also found"""
+    return sum(len(set(f) & set(t)) for f, t in zip(found.tolist(), truth.tolist())) / truth.size
+
+
+def run_embeddings(args):
+    chunks, chunk_pages = [], []
+    for path in args.pdfs:
+        with open(path, "rb") as f:
+            store = compact_book(f.read())["chunks"]
+        chunks.extend(store)
+        chunk_pages.extend((os.path.basename(path), chunk.page) for chunk in store)
+    if args.chunks:
+        chunks, chunk_pages = chunks[:args.chunks], chunk_pages[:args.chunks]
+    texts = [chunk.text for chunk in chunks]
+    labels = load_retrieval_labels(args.questions) if args.questions else None
+    queries = [label["question"] for label in labels] if labels else sample_queries(chunks, args.queries)
+    k = min(args.k, len(texts))
+
+    reference = None  # Top-k chunk ids from the first backend at float32: the current setup
+    rows = []
+    for backend in args.backends:
+        start = time.perf_counter()
+        try:
+            embeddings = ashok2.SharedEmbeddings(backend=backend, threads=args.threads)
+        except (ImportError, OSError, ValueError) as e:
+            rows.append({"backend": backend, "error": str(e)})
+            continue
+        load_s = time.perf_counter() - start
+        embeddings.embed_documents(texts[:8])  # Warm-up, so one-off graph set-up is not timed
+
+        vectors, embed_s = embed_chunks_timed(embeddings, texts)
+        sequential = query_latencies(embeddings, queries, 1)
+        concurrent = query_latencies(embeddings, queries, args.concurrency)
+        query_vectors = np.array(embeddings.embed_documents(queries), dtype="float32")
+
+        if reference is None:
+            _, reference = ashok2.build_index(vectors, "flat", "float32").search(query_vectors, k)
+        storage_rows = []
+        for storage in args.storage:
+            index = ashok2.build_index(vectors, "flat", storage)
+            start = time.perf_counter()
+            _, found = index.search(query_vectors, k)
+            search_s = time.perf_counter() - start
+            row = {
+                "storage": storage,
+                "index_bytes": ashok2.index_nbytes(index),
+                "recall_vs_reference": neighbour_recall(found, reference),
+                "search_ms_per_query": search_s / len(queries) * 1000,
+            }
+            if labels:
+                hits = sum(
+                    any(
+                        chunk_pages[i][1] in label["pages"] and label.get("book") in (None, chunk_pages[i][0])
+                        for i in ids if i >= 0
+                    )
+                    for label, ids in zip(labels, found.tolist())
+                )
+                row["labelled_recall_at_k"] = hits / len(labels)
+            storage_rows.append(row)
+
+        rows.append({
+            "backend": backend,
+            "load_s": load_s,
+            "chunks_per_second": len(texts) / embed_s if embed_s else 0.0,
+            "query_latency": sequential,
+            "concurrent_query_latency": concurrent,
+            "storage": storage_rows,
+        })
+        del embeddings, vectors
+
+    return {
+        "benchmark": "embeddings",
+        "pdfs": args.pdfs,
+        "config": {
+            "embedding_model": ashok2.EMBEDDING_MODEL_NAME,
+            "threads": args.threads,
+            "concurrency": args.concurrency,
+            "query_batch": ashok2.EMBED_QUERY_BATCH,
+            "query_wait_ms": ashok2.EMBED_QUERY_WAIT_MS,
+        },
+        "chunks": len(texts),
+        "queries": len(queries),
+        "k": k,
+        "reference": f"{args.backends[0]} embeddings, float32 flat index",
+        "results": rows,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def benchmark_questions(args, chatbot):
+    if args.questions:
+        return [label["question"] for label in load_retrieval_labels(args.questions)]
+    # Phrased as problem-solving questions so they pass the relevance check
+    return [f"How can I solve the problem described here: {q}?" for q in sample_queries(chatbot.book_chunks, 50)]
+
+
+def _post_json(url, payload):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", "X-Gemini-Key": "benchmark"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def bench_api_server(pdf_path, questions, args):
+    """Requests/sec and latency of /answer on the headless server, with concurrent clients"""
+    import api_server
+
+    service = api_server.AshokService()
+    service.warm_up()
+    with open(pdf_path, "rb") as f:
+        service.add_book(f.read(), os.path.basename(pdf_path), wait=True)
+    server = api_server.make_server(service, port=0, workers=args.concurrency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/answer"
+
+    def ask(i):
+        start = time.perf_counter()
+        _post_json(url, {"question": questions[i % len(questions)], "use_cache": False})
+        return time.perf_counter() - start
+
+    try:
+        ask(0)  # First request pays for lazy set-up
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as clients:
+            latencies = list(clients.map(ask, range(args.requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {"requests": len(latencies), "concurrency": args.concurrency,
+            "requests_per_second": len(latencies) / elapsed, "latency": percentiles_ms(latencies)}
+
+
+def bench_streamlit_app(pdf_path, questions, args):
+    """Seconds per question when driving the Streamlit script itself (one rerun per question)"""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(ashok2.__file__, default_timeout=600).run()
+    app.sidebar.text_input[0].input("benchmark").run()
+    with open(pdf_path, "rb") as f:
+        app.sidebar.file_uploader[0].set_value((os.path.basename(pdf_path), f.read(), "application/pdf")).run()
+    # The book is ingested by a background job; each rerun moves finished jobs into the library
+    while app.session_state["ingestions"] and not app.exception:
+        time.sleep(0.5)
+        app.run()
+    if app.exception or app.error:
+        failure = app.exception[0] if app.exception else app.error[0]
+        raise SystemExit(f"Streamlit app failed to ingest {pdf_path}: {failure.value}")
+    app.sidebar.toggle[0].set_value(False)  # Whole answers, like the API's /answer
+    for checkbox in app.sidebar.checkbox:
+        if checkbox.label.startswith("Reuse answers"):
+            checkbox.uncheck()
+    app.run()
+
+    latencies = []
+    for i in range(min(args.requests, args.streamlit_requests)):
+        start = time.perf_counter()
+        app.chat_input[0].set_value(questions[i % len(questions)]).run()
+        latencies.append(time.perf_counter() - start)
+    if app.exception:
+        raise SystemExit(f"Streamlit app failed: {app.exception[0].value}")
+    elapsed = sum(latencies)
+    return {"requests": len(latencies), "concurrency": 1,
+            "requests_per_second": len(latencies) / elapsed, "latency": percentiles_ms(latencies),
+            "note": "in-process AppTest reruns; a browser session adds websocket and rendering time on top"}
+
+
+def run_api(args):
+    # Both sides answer with the offline mock backend, so only the serving path differs
+    os.environ["ASHOK_GEMINI_BACKEND"] = "mock"
+    ashok2.GEMINI_BACKEND = "mock"
+    ashok2.get_gemini_clients().latency = args.gemini_latency
+    chatbot = ingest_pdfs(args.pdfs[:1])
+    questions = benchmark_questions(args, chatbot)
+    report = {
+        "benchmark": "api",
+        "pdf": args.pdfs[0],
+        "questions": len(questions),
+        "mock_gemini_latency_s": args.gemini_latency,
+        "api_server": bench_api_server(args.pdfs[0], questions, args),
+    }
+    if not args.skip_streamlit:
+        report["streamlit_app"] = bench_streamlit_app(args.pdfs[0], questions, args)
+    return report
+
+
+# Heavy dependencies that must only be imported on first use, never by the app's start-up
+STARTUP_LAZY_MODULES = (
+    "torch", "transformers", "sentence_transformers", "langchain_huggingface", "langchain_community",
+    "langchain_text_splitters", "langchain_core", "google.generativeai", "faiss", "PyPDF2",
+)
+
+FIRST_RENDER_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=120).run()
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "exceptions": [e.value for e in app.exception]}))
+"""
+
+
+def parse_importtime(stderr):
+    """Rows of ``python -X importtime`` output: (module, self seconds, cumulative seconds, depth)"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return rows
+
+
+def app_subprocess(script_args):
+    """Run Python in a fresh interpreter next to ashok2.py, without background warm-up"""
+    app_dir = os.path.dirname(os.path.abspath(ashok2.__file__))
+    env = dict(os.environ, ASHOK_WARM_UP="0")
+    return subprocess.run(
+        [sys.executable, *script_args], cwd=app_dir, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def measure_import():
+    """Import ashok2 in a fresh interpreter; returns (seconds, importtime rows, modules loaded)"""
+    result = app_subprocess(["-X", "importtime", "-c", "import ashok2, json, sys; print(json.dumps(sorted(sys.modules)))"])
+    rows = parse_importtime(result.stderr)
+    total = next(cumulative for name, _, cumulative, depth in rows if name == "ashok2" and depth == 0)
+    return total, rows, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_first_render():
+    """Seconds from a fresh interpreter to the app's first complete script run"""
+    result = app_subprocess(["-c", FIRST_RENDER_SCRIPT, os.path.abspath(ashok2.__file__)])
+    outcome = json.loads(result.stdout.strip().splitlines()[-1])
+    if outcome["exceptions"]:
+        raise SystemExit(f"First render failed: {outcome['exceptions'][0]}")
+    return outcome["seconds"]
+
+
+def run_startup(args):
+    import_seconds, renders = [], []
+    for _ in range(args.repeat):
+        seconds, rows, modules = measure_import()
+        import_seconds.append(seconds)
+        renders.append(measure_first_render())
+
+    # Breakdown from the last run: what ashok2 imports directly, most expensive first.
+    # Rows are listed children first, so ashok2's imports are the nested rows just above it.
+    end = next(i for i, (name, _, _, depth) in enumerate(rows) if name == "ashok2" and depth == 0)
+    start = end
+    while start > 0 and rows[start - 1][3] > 0:
+        start -= 1
+    direct = sorted(
+        ((name, cumulative) for name, _, cumulative, depth in rows[start:end] if depth == 1),
+        key=lambda row: row[1], reverse=True,
+    )
+    eager = [name for name in STARTUP_LAZY_MODULES if name in modules]
+    report = {
+        "benchmark": "startup",
+        "repeat": args.repeat,
+        "import_ms": {"median": statistics.median(import_seconds) * 1000, "min": min(import_seconds) * 1000},
+        "first_render_ms": {"median": statistics.median(renders) * 1000, "min": min(renders) * 1000},
+        "top_imports_ms": {name: cumulative * 1000 for name, cumulative in direct[:args.top]},
+        "modules_loaded": len(modules),
+        "eager_heavy_modules": eager,
+    }
+
+    regressions = [f"{name} is imported at start-up" for name in eager]
+    if args.max_import_ms and report["import_ms"]["median"] > args.max_import_ms:
+        regressions.append(f"import took {report['import_ms']['median']:.0f} ms (budget {args.max_import_ms:.0f} ms)")
+    if args.max_render_ms and report["first_render_ms"]["median"] > args.max_render_ms:
+        regressions.append(f"first render took {report['first_render_ms']['median']:.0f} ms (budget {args.max_render_ms:.0f} ms)")
+    report["regressions"] = regressions
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Ashok 2.0")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Recall vs latency of ANN index backends against flat search")
+    index_parser.add_argument("pdfs", nargs="+", help="PDF books forming the corpus")
+    index_parser.add_argument("--k", type=int, default=10)
+    index_parser.add_argument("--queries", type=int, default=200)
+    index_parser.set_defaults(run=run_index)
+
+    relevance_parser = subparsers.add_parser("relevance", help="Throughput and accuracy of the question relevance classifier")
+    relevance_parser.add_argument("--corpus", help="Labelled questions as JSON lines (default: built-in corpus)")
+    relevance_parser.add_argument("--repeat", type=int, default=200)
+    relevance_parser.set_defaults(run=run_relevance)
+
+    retrieval_parser = subparsers.add_parser("retrieval", help="Recall@k, MRR, ingestion throughput and query latency")
+    retrieval_parser.add_argument("pdfs", nargs="+", help="PDF books to ingest")
+    retrieval_parser.add_argument("--questions", required=True, help="Labelled question -> page JSON lines")
+    retrieval_parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    retrieval_parser.add_argument("--repeat", type=int, default=5, help="Passes over the questions for latency")
+    retrieval_parser.add_argument("--embed-sample", type=int, default=512, help="Chunks re-embedded to time the model")
+    retrieval_parser.add_argument("--chunk-size", type=int, help=f"Override CHUNK_SIZE ({ashok2.CHUNK_SIZE})")
+    retrieval_parser.add_argument("--chunk-overlap", type=int, help=f"Override CHUNK_OVERLAP ({ashok2.CHUNK_OVERLAP})")
+    retrieval_parser.add_argument("--index-backend", default="flat", choices=ashok2.INDEX_BACKENDS + ("auto",))
+    retrieval_parser.add_argument("--no-hybrid", dest="hybrid", action="store_false", help="Vector search only")
+    retrieval_parser.add_argument("--embedding-cache", action="store_true",
+                                  help="Reuse cached chunk and query vectors during ingestion and search")
+    retrieval_parser.add_argument("--rerank", action="store_true",
+                                  help="Also search with the cross-encoder reranker and check its p95 latency budget")
+    retrieval_parser.set_defaults(run=run_retrieval)
+
+    context_parser = subparsers.add_parser("context", help="Estimated prompt tokens before and after context packing")
+    context_parser.add_argument("pdfs", nargs="+", help="PDF books to ingest")
+    context_parser.add_argument("--questions", help="Question JSON lines (default: sampled from the books)")
+    context_parser.add_argument("--queries", type=int, default=100, help="Sampled questions when --questions is not given")
+    context_parser.add_argument("--budget", type=int, default=ashok2.CONTEXT_TOKEN_BUDGET)
+    context_parser.set_defaults(run=run_context)
+
+    api_parser = subparsers.add_parser("api", help="Headless API server vs the Streamlit app, with a mock Gemini")
+    api_parser.add_argument("pdfs", nargs=1, help="PDF book to serve")
+    api_parser.add_argument("--questions", help="Question JSON lines (default: generated from the book)")
+    api_parser.add_argument("--requests", type=int, default=200)
+    api_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent API clients (and server workers)")
+    api_parser.add_argument("--streamlit-requests", type=int, default=20, help="Questions asked through the app")
+    api_parser.add_argument("--gemini-latency", type=float, default=0.5, help="Seconds per mock Gemini answer")
+    api_parser.add_argument("--skip-streamlit", action="store_true")
+    api_parser.set_defaults(run=run_api)
+
+    memory_parser = subparsers.add_parser("memory", help="Per-book memory of the chunk store vs LangChain Documents")
+    memory_parser.add_argument("pdfs", nargs="+", help="PDF files to measure")
+    memory_parser.add_argument("--reads", type=int, default=2000, help="Random chunk reads to time")
+    memory_parser.set_defaults(run=run_memory)
+
+    embeddings_parser = subparsers.add_parser(
+        "embeddings", help="Embedding backends and vector storage: chunks/sec, query latency and recall"
+    )
+    embeddings_parser.add_argument("pdfs", nargs="+", help="PDF books to embed")
+    embeddings_parser.add_argument("--backends", nargs="+", default=list(ashok2.EMBEDDING_BACKENDS),
+                                   choices=ashok2.EMBEDDING_BACKENDS, help="The first is the recall reference")
+    embeddings_parser.add_argument("--storage", nargs="+", default=list(ashok2.VECTOR_STORAGE_TYPES),
+                                   choices=ashok2.VECTOR_STORAGE_TYPES)
+    embeddings_parser.add_argument("--questions", help="Labelled question -> page JSON lines (adds labelled recall)")
+    embeddings_parser.add_argument("--queries", type=int, default=200, help="Sampled questions when --questions is not given")
+    embeddings_parser.add_argument("--chunks", type=int, default=0, help="Embed only the first N chunks (0: all)")
+    embeddings_parser.add_argument("--k", type=int, default=10)
+    embeddings_parser.add_argument("--threads", type=int, default=ashok2.EMBEDDING_THREADS, help="Intra-op threads (0: default)")
+    embeddings_parser.add_argument("--concurrency", type=int, default=8, help="Sessions embedding queries at once")
+    embeddings_parser.set_defaults(run=run_embeddings)
+
+    startup_parser = subparsers.add_parser("startup", help="Import-time breakdown and time to first render")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to time (median reported)")
+    startup_parser.add_argument("--top", type=int, default=15, help="Direct imports listed in the breakdown")
+    startup_parser.add_argument("--max-import-ms", type=float, default=0, help="Fail above this median import time")
+    startup_parser.add_argument("--max-render-ms", type=float, default=0, help="Fail above this median first render")
+    startup_parser.set_defaults(run=run_startup)
+
+    args = parser.parse_args(argv)
+    result = args.run(args)
+    report = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if result.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Parallel, streaming PDF text extraction, and the PDF outline.
+
+Kept separate from the Streamlit app so the extraction workers only need PyPDF2,
+which is itself imported on first use to keep it off the app's start-up path.
+"""
+import io
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+PDF_EXTRACT_BATCH_PAGES = int(os.environ.get("ASHOK_PDF_BATCH_PAGES", "16"))
+PDF_EXTRACT_WORKERS = int(os.environ.get("ASHOK_PDF_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# Set in each worker process by _init_worker, so the PDF is parsed once per worker
+_worker_reader = None
+
+
+def _pdf_reader(pdf_bytes):
+    from PyPDF2 import PdfReader
+    return PdfReader(io.BytesIO(pdf_bytes))
+
+
+def _init_worker(pdf_path):
+    global _worker_reader
+    from PyPDF2 import PdfReader
+    _worker_reader = PdfReader(pdf_path)
+
+
+def _extract_batch(start, end):
+    """Extract pages [start, end) in a worker; page numbers are 1-based"""
+    return [
+        (page_index + 1, _worker_reader.pages[page_index].extract_text() or "")
+        for page_index in range(start, end)
+    ]
+
+
+def count_pdf_pages(pdf_bytes):
+    return len(_pdf_reader(pdf_bytes).pages)
+
+
+def pdf_outline(pdf_bytes):
+    """The PDF's bookmarks as (page, level, title) in page order; empty if it has none.
+
+    Pages are 1-based and level 0 is the top of the outline. Bookmarks that do not
+    point at a page are skipped.
+    """
+    reader = _pdf_reader(pdf_bytes)
+    entries = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):  # Children of the preceding bookmark
+                walk(item, level + 1)
+                continue
+            try:
+                page_index = reader.get_destination_page_number(item)
+            except Exception:
+                continue
+            title = " ".join((getattr(item, "title", None) or "").split())
+            if title and page_index is not None and page_index >= 0:
+                entries.append((page_index + 1, level, title))
+
+    try:
+        walk(reader.outline, 0)
+    except Exception:  # Malformed outlines are common; fall back to headings
+        return []
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+def _page_info(page_num, page_text):
+    return {
+        'page': page_num,
+        'text': page_text,
+        'word_count': len(page_text.split())
+    }
+
+
+def iter_pdf_pages(pdf_bytes, progress=None, batch_size=PDF_EXTRACT_BATCH_PAGES, max_workers=PDF_EXTRACT_WORKERS,
+                   first_page=1):
+    """Yield non-empty pages in page order as soon as they are extracted.
+
+    Pages are extracted in batches of ``batch_size`` on a process pool, with at most
+    two batches per worker in flight so memory stays bounded on very large books.
+    ``progress(done, total)`` is called after every page, including empty ones.
+    Pages before ``first_page`` (e.g. already ingested ones) are skipped and count
+    as done.
+    """
+    reader = _pdf_reader(pdf_bytes)
+    total = len(reader.pages)
+    first_index = min(max(first_page - 1, 0), total)
+
+    # Small books are not worth the process start-up cost
+    if max_workers <= 1 or total - first_index <= 2 * batch_size:
+        for page_index in range(first_index, total):
+            page_text = reader.pages[page_index].extract_text() or ""
+            if page_text.strip():  # Only yield non-empty pages
+                yield _page_info(page_index + 1, page_text)
+            if progress:
+                progress(page_index + 1, total)
+        return
+
+    batches = [(start, min(start + batch_size, total)) for start in range(first_index, total, batch_size)]
+    # Spawn, never fork: by now the app runs many threads (Streamlit, the embedding worker,
+    # the answer loop, SQLite connections), and a forked child could inherit a lock held by
+    # one of them. Workers get the PDF as a temporary file rather than pickled bytes each.
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+        pdf_file.write(pdf_bytes)
+    try:
+        done = first_index
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(batches)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(pdf_file.name,),
+        ) as pool:
+            in_flight = []
+            next_batch = 0
+            try:
+                while next_batch < len(batches) or in_flight:
+                    while next_batch < len(batches) and len(in_flight) < 2 * max_workers:
+                        in_flight.append(pool.submit(_extract_batch, *batches[next_batch]))
+                        next_batch += 1
+                    # Results are consumed in submission order to keep pages ordered
+                    for page_num, page_text in in_flight.pop(0).result():
+                        if page_text.strip():
+                            yield _page_info(page_num, page_text)
+                        done += 1
+                        if progress:
+                            progress(done, total)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+    finally:
+        os.remove(pdf_file.name)